@@ -5,7 +5,10 @@ import numpy as np
 import os
 
 from kilosort import run_kilosort, DEFAULT_SETTINGS
-from kilosort.io import load_probe, save_preprocessing, load_ops
+from kilosort.io import (
+    load_probe, save_preprocessing, load_ops, find_binary, find_spikeglx_meta,
+    spikeglx_settings
+    )
 
 def kilosort_h2p(save_path,probe_path,run_type='unleashed',probe_type='np',tmax=None):
 
@@ -16,8 +19,16 @@ def kilosort_h2p(save_path,probe_path,run_type='unleashed',probe_type='np',tmax=
 
     settings = DEFAULT_SETTINGS
     settings['probe']      =  probe
-    settings['n_chan_bin'] =  probe['n_chan']+1
-    settings['fs']         =  30000
+    # Channel count and sampling rate come from the SpikeGLX .meta file, when
+    # there is one, instead of assuming a single sync channel at 30kHz.
+    binary_path = find_binary(SAVE_PATH.parent)
+    if find_spikeglx_meta(binary_path) is not None:
+        meta_settings = spikeglx_settings(binary_path)
+        settings['n_chan_bin'] = meta_settings['n_chan_bin']
+        settings['fs']         = meta_settings['fs']
+    else:
+        settings['n_chan_bin'] =  probe['n_chan']+1
+        settings['fs']         =  30000
 
     if probe_type == 'np': #assuming NHP-Long probe
      
@@ -7,5 +7,5 @@ except importlib.metadata.PackageNotFoundError:
     pass
 
 from .utils import PROBE_DIR, DOWNLOADS_DIR
-from .run_kilosort import run_kilosort
+from .run_kilosort import run_kilosort, run_kilosort_multi
 from .parameters import DEFAULT_SETTINGS
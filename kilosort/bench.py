@@ -1,5 +1,5 @@
-import torch, os
-from kilosort import preprocessing
+import torch, os, time
+from kilosort import preprocessing, io
 dev = torch.device('cuda:0')
 import numpy as np
 from torch.fft import fft, ifft, fftshift
@@ -258,4 +258,90 @@ def load_phy(filename, fpath, ops):
 
     yclu_new, Wsub = clu_ypos(filename, ops, st_new - 20, clu_new)
 
-    return st_new, clu_new, yclu_new, Wsub
\ No newline at end of file
+    return st_new, clu_new, yclu_new, Wsub
+
+def detect_peaks(X, threshold=6):
+    """Negative peaks below `threshold` robust standard deviations, per channel.
+
+    Returns sorted keys `channel * X.shape[1] * 10 + sample`, so that peaks on
+    different channels are never matched by `nmatch`.
+    """
+    sd = torch.median(X.abs(), 1)[0] / 0.6745
+    Xn = -X / sd.clamp(min=1e-6).unsqueeze(1)
+    is_peak = (Xn > threshold) & (Xn == torch.nn.functional.max_pool1d(
+        Xn.unsqueeze(0), 2*5+1, stride=1, padding=5)[0])
+    ichan, isamp = torch.nonzero(is_peak, as_tuple=True)
+    keys = ichan.cpu().numpy().astype('int64') * X.shape[1] * 10 \
+           + isamp.cpu().numpy()
+    return np.sort(keys)
+
+def benchmark_car(bfile, methods=None, n_batches=5, threshold=6, n_repeats=3,
+                  dt=2):
+    """Compare cost and effect on detection of CAR methods for `bfile`.
+
+    For `n_batches` batches spread across the recording, times
+    `preprocessing.common_reference` for each method and detects threshold
+    crossings in the fully preprocessed data. Detections are compared to
+    those with the exact median ('median').
+
+    Parameters
+    ----------
+    bfile : kilosort.io.BinaryFiltered
+        Data to test, with the desired preprocessing (filter, whitening).
+        `bfile.car_method` is restored afterward.
+    methods : list of str; optional.
+        Defaults to `preprocessing.CAR_METHODS`, skipping 'shank' if
+        `bfile.car_groups` is None.
+
+    Returns
+    -------
+    results : dict
+        For each method, mean seconds per batch ('time'), number of detected
+        peaks ('n_peaks'), fraction of median peaks that were also detected
+        ('recall') and fraction of peaks matched to a median peak
+        ('precision').
+
+    """
+    if methods is None:
+        methods = [m for m in preprocessing.CAR_METHODS
+                   if m != 'shank' or bfile.car_groups is not None]
+    if 'median' not in methods:
+        methods = ['median'] + list(methods)
+    batches = np.unique(np.linspace(0, bfile.n_batches-1, n_batches).astype(int))
+
+    original_method = bfile.car_method
+    times = {m: 0.0 for m in methods}
+    peaks = {m: [] for m in methods}
+    try:
+        for ibatch in batches:
+            # raw data, without any filtering
+            X = io.BinaryRWFile.padded_batch_to_torch(bfile, ibatch)
+            Xc = X[bfile.chan_map] if bfile.chan_map is not None else X
+            Xc = Xc - Xc.mean(1).unsqueeze(1)
+            for m in methods:
+                for _ in range(n_repeats):
+                    if Xc.is_cuda:
+                        torch.cuda.synchronize()
+                    tic = time.time()
+                    _ = preprocessing.common_reference(Xc, m, bfile._car_group_idx)
+                    if Xc.is_cuda:
+                        torch.cuda.synchronize()
+                    times[m] += (time.time() - tic) / n_repeats
+                bfile.car_method = m
+                peaks[m].append(detect_peaks(bfile.filter(X), threshold))
+    finally:
+        bfile.car_method = original_method
+
+    results = {}
+    for m in methods:
+        n0 = n_ref = n_new = 0
+        for ss0, ss in zip(peaks['median'], peaks[m]):
+            if len(ss0) > 0 and len(ss) > 0:
+                n0 += nmatch(ss0, ss, dt=dt)[0]
+            n_ref += len(ss0)
+            n_new += len(ss)
+        results[m] = {
+            'time': times[m] / len(batches), 'n_peaks': n_new,
+            'recall': n0 / max(n_ref, 1), 'precision': n0 / max(n_new, 1)
+            }
+    return results
@@ -12,7 +12,7 @@ import faiss
 from tqdm import tqdm 
 
 from kilosort import hierarchical, swarmsplitter
-from kilosort.utils import log_performance
+from kilosort.utils import log_performance, run_rng
 
 logger = logging.getLogger(__name__)
 
@@ -144,7 +144,9 @@ def cluster(Xd, iclust = None, kn = None, nskip = 20, n_neigh = 10, nclust = 200
     tones2 = torch.ones((NN, n_neigh), device = device)
 
     if iclust is None:
-        iclust_init =  kmeans_plusplus(Xg, niter = nclust, seed = seed, device=device)
+        # seeds and draws from the global numpy and torch generators
+        with run_rng():
+            iclust_init =  kmeans_plusplus(Xg, niter = nclust, seed = seed, device=device)
         iclust = iclust_init.clone()
     else:
         iclust_init = iclust.clone()
@@ -413,7 +415,8 @@ def get_nearest_centers(xy, xcent, ycent):
         + (xy[1,:] - ycent_pos.unsqueeze(-1))**2
         )
     # Add some randomness in case of ties
-    center_distance += 1e-20*torch.rand(center_distance.shape)
+    with run_rng():
+        center_distance += 1e-20*torch.rand(center_distance.shape)
     # Get flattened index of x-y center that is closest to template
     minimum_distance = torch.min(center_distance, 0).indices
 
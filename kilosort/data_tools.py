@@ -1,8 +1,135 @@
+from functools import cached_property, lru_cache
 from pathlib import Path
 import numpy as np
 from kilosort import io
 
 
+class SortingResults:
+    """Lazy, memory-mapped access to saved Kilosort4 sorting results.
+
+    Every `<name>.npy` file in `results_dir` is available as attribute `name`,
+    for example `results.spike_times` or `results.templates`. Files are
+    opened with `np.load(..., mmap_mode=mmap_mode)` the first time they are
+    accessed and then reused, so only the parts of each array that are used
+    are read from disk. Derived values, like the spike indices for each cluster
+    and the best channel for each template, are computed once and cached.
+
+    Instances can be passed in place of `results_dir` to the other functions
+    in this module.
+
+    Parameters
+    ----------
+    results_dir : str or Path
+        Path to directory where Kilosort4 sorting results were saved.
+    mmap_mode : str or None; default='r'.
+        Memory-map mode passed to `np.load`. If None, arrays are read into
+        memory in full the first time they are accessed.
+
+    Examples
+    --------
+    >>> results = SortingResults('/path/to/kilosort4')
+    >>> spike_idx = results.cluster_spikes(5)
+    >>> spike_times = results.spike_times[spike_idx]
+    >>> chan = results.best_channels[5]
+
+    """
+
+    def __init__(self, results_dir, mmap_mode='r'):
+        self.results_dir = Path(results_dir)
+        self.mmap_mode = mmap_mode
+        self._arrays = {}
+
+    def __repr__(self):
+        return f'SortingResults({str(self.results_dir)!r})'
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't found the normal way.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self._arrays:
+            filename = self.results_dir / f'{name}.npy'
+            if not filename.is_file():
+                raise AttributeError(
+                    f'{name!r} not found, {filename} does not exist.'
+                    )
+            self._arrays[name] = np.load(filename, mmap_mode=self.mmap_mode)
+        return self._arrays[name]
+
+    @cached_property
+    def ops(self):
+        """Settings and results loaded from `ops.npy`."""
+        return io.load_ops(self.results_dir / 'ops.npy')
+
+    @cached_property
+    def bfile(self):
+        """Filtered data file object created from `ops`."""
+        return io.bfile_from_ops(self.ops)
+
+    @cached_property
+    def best_channels(self):
+        """Channel with the largest template norm, for each cluster."""
+        return (np.asarray(self.templates)**2).sum(axis=1).argmax(axis=-1)
+
+    @cached_property
+    def _cluster_index(self):
+        # Spike indices grouped by cluster, in ascending order within each
+        # cluster. Clusters are sorted, with `offsets[i]:offsets[i+1]` giving
+        # the range of `order` for `cluster_ids[i]`.
+        spike_clusters = np.asarray(self.spike_clusters)
+        order = np.argsort(spike_clusters, kind='stable')
+        cluster_ids, offsets = np.unique(
+            spike_clusters[order], return_index=True
+            )
+        offsets = np.append(offsets, order.size)
+        return order, cluster_ids, offsets
+
+    @property
+    def cluster_ids(self):
+        """Sorted ids of all clusters with at least one spike."""
+        return self._cluster_index[1]
+
+    def cluster_spikes(self, cluster_id):
+        """Indices of spikes assigned to `cluster_id`, in ascending order.
+
+        Equivalent to `(spike_clusters == cluster_id).nonzero()[0]`, but the
+        spike index for all clusters is only computed once.
+
+        """
+        order, cluster_ids, offsets = self._cluster_index
+        i = np.searchsorted(cluster_ids, cluster_id)
+        if i == cluster_ids.size or cluster_ids[i] != cluster_id:
+            return np.zeros(0, dtype=order.dtype)
+        return order[offsets[i]:offsets[i+1]]
+
+
+def load_results(results_dir, mmap_mode='r'):
+    """Get a `SortingResults` object for `results_dir`.
+
+    Objects are reused for repeated calls with the same directory, as long as
+    the results files have not been modified since. If `results_dir` is
+    already a `SortingResults` object, it is returned as-is.
+
+    """
+    if isinstance(results_dir, SortingResults):
+        return results_dir
+    results_dir = Path(results_dir).resolve()
+    # Include modification times so that re-sorting or re-curating the
+    # results in the same directory is not hidden by the cache.
+    mtimes = tuple(
+        f.stat().st_mtime_ns if f.is_file() else None
+        for f in [results_dir / 'spike_clusters.npy',
+                  results_dir / 'templates.npy',
+                  results_dir / 'ops.npy',
+                  results_dir / 'ops' / 'ops.json']
+        )
+    return _cached_results(results_dir, mtimes, mmap_mode)
+
+
+@lru_cache(maxsize=4)
+def _cached_results(results_dir, mtimes, mmap_mode):
+    return SortingResults(results_dir, mmap_mode=mmap_mode)
+
+
 def mean_waveform(cluster_id, results_dir, n_spikes=np.inf, bfile=None, best=True):
     """Get mean waveform for `n_spikes` random spikes assigned to `cluster_id`.
 
@@ -12,7 +139,7 @@ def mean_waveform(cluster_id, results_dir, n_spikes=np.inf, bfile=None, best=Tru
         Cluster index to reference from `spike_clusters.npy` in the results
         directory. Only waveforms from spikes assigned to this cluster will
         be used.
-    results_dir : str or Path
+    results_dir : str, Path or SortingResults
         Path to directory where Kilosort4 sorting results were saved.
     n_spikes : int; default=np.inf
         Number of spikes to use for computing mean. By default, all spikes
@@ -37,7 +164,7 @@ def mean_waveform(cluster_id, results_dir, n_spikes=np.inf, bfile=None, best=Tru
         were used (in ascending order of spike time).
     
     """
-    results_dir = Path(results_dir)
+    results_dir = load_results(results_dir)
     if best:
         chan = get_best_channels(results_dir)[cluster_id]
     else:
@@ -57,7 +184,7 @@ def mean_waveform_with_bounds(cluster_id, results_dir, n_spikes=np.inf, bfile=No
     ----------
     cluster_id : int
         Cluster index to reference from `spike_clusters.npy` in the results directory.
-    results_dir : str or Path
+    results_dir : str, Path or SortingResults
         Path to directory where Kilosort4 sorting results were saved.
     n_spikes : int; default=np.inf
         Number of spikes to use for computing mean. All if np.inf.
@@ -79,7 +206,7 @@ def mean_waveform_with_bounds(cluster_id, results_dir, n_spikes=np.inf, bfile=No
     spike_subset : np.ndarray
         Indices of randomly selected spikes used to compute mean.
     """
-    results_dir = Path(results_dir)
+    results_dir = load_results(results_dir)
     if best:
         chan = get_best_channels(results_dir)[cluster_id]
     else:
@@ -105,27 +232,23 @@ def mean_waveform_with_bounds(cluster_id, results_dir, n_spikes=np.inf, bfile=No
 
 def get_best_channels(results_dir):
     """Get channel numbers with largest template norm for each cluster."""
-    templates = np.load(results_dir / 'templates.npy')
-    best_chans = (templates**2).sum(axis=1).argmax(axis=-1)
-    return best_chans
+    return load_results(results_dir).best_channels
 
 def get_best_channel(results_dir, cluster_id):
     return get_best_channels(results_dir)[cluster_id]
 
 def get_cluster_spikes(cluster_id, results_dir, n_spikes=np.inf):
     """Get `n_spikes` random spike times assigned to `cluster_id`."""
-    spike_times = np.load(results_dir / 'spike_times.npy')
-    spike_clusters = np.load(results_dir / 'spike_clusters.npy')
-    spike_idx = (spike_clusters == cluster_id).nonzero()[0]
+    results_dir = load_results(results_dir)
+    spike_idx = results_dir.cluster_spikes(cluster_id)
     if n_spikes != np.inf:
         spike_subset = np.random.choice(
             np.arange(spike_idx.size), min(spike_idx.size, n_spikes), replace=False
             )
     else:
         spike_subset = np.arange(spike_idx.size)
-    spike_idx = spike_idx[spike_subset]
-    spike_idx.sort()
-    spikes = spike_times[spike_idx]
+    spike_idx = np.sort(spike_idx[spike_subset])
+    spikes = results_dir.spike_times[spike_idx]
 
     return spikes, spike_subset
 
@@ -138,7 +261,7 @@ def get_spike_waveforms(spikes, results_dir, bfile=None, chan=None):
     spikes : list or array-like
         Spike times (in units of samples) for the desired waveforms, from
         `spike_times.npy`.
-    results_dir : str or Path
+    results_dir : str, Path or SortingResults
         Path to directory where Kilosort4 sorting results were saved.
     bfile : kilosort.io.BinaryFiltered; optional
         Kilosort4 data file object. By default, this will be loaded using the
@@ -156,10 +279,10 @@ def get_spike_waveforms(spikes, results_dir, bfile=None, chan=None):
     if isinstance(spikes, int):
         spikes = [spikes]
 
+    results_dir = load_results(results_dir)
     if bfile is None:
-        ops = io.load_ops(results_dir / 'ops.npy')
-        bfile = io.bfile_from_ops(ops)
-    whitening_mat_inv = np.load(results_dir / 'whitening_mat_inv.npy')
+        bfile = results_dir.bfile
+    whitening_mat_inv = np.asarray(results_dir.whitening_mat_inv)
 
     waves = []
     for t in spikes:
@@ -193,7 +316,7 @@ def cluster_templates(cluster_id, results_dir, mean=False, best=False, spike_sub
     cluster_id : int
         Cluster index to reference from `spike_clusters.npy` in the results
         directory.
-    results_dir : str or Path
+    results_dir : str, Path or SortingResults
         Path to directory where Kilosort4 sorting results were saved.
     mean : bool; default=False
         If True, return the mean 'template' across spikes.
@@ -218,9 +341,8 @@ def cluster_templates(cluster_id, results_dir, mean=False, best=False, spike_sub
         then `n_channels=1`.
         
     """
-    results_dir = Path(results_dir)
-    spike_clusters = np.load(results_dir / 'spike_clusters.npy')
-    spike_idx = (spike_clusters == cluster_id).nonzero()[0]
+    results_dir = load_results(results_dir)
+    spike_idx = results_dir.cluster_spikes(cluster_id)
     if spike_subset is not None:
         spike_idx = spike_idx[spike_subset]
     temps = get_templates(spike_idx, results_dir)
@@ -240,7 +362,7 @@ def get_templates(spike_idx, results_dir):
     ----------
     spike_idx : int or array-like
         Index or list/array of indices into `spike_times.npy`
-    results_dir : str or Path
+    results_dir : str, Path or SortingResults
         Path to directory where Kilosort4 sorting results were saved.
     
     Returns
@@ -251,16 +373,15 @@ def get_templates(spike_idx, results_dir):
         unwhitened spike waveforms.
 
     """
-    results_dir = Path(results_dir)
+    results_dir = load_results(results_dir)
     if isinstance(spike_idx, int):
         spike_idx = [spike_idx]
-    templates = np.load(results_dir / 'templates.npy')
+    spike_idx = np.asarray(spike_idx)
     # Note that spike_clusters.npy is identical to spike_templates.npy for KS4
-    spike_templates = np.load(results_dir / 'spike_clusters.npy')
-    amplitudes = np.load(results_dir / 'amplitudes.npy')
-    template_idx = spike_templates[spike_idx]
-    temps = templates[template_idx, :, :]
-    scaled = amplitudes[spike_idx, np.newaxis, np.newaxis] * temps
+    template_idx = results_dir.spike_clusters[spike_idx]
+    temps = results_dir.templates[template_idx, :, :]
+    amplitudes = results_dir.amplitudes[spike_idx]
+    scaled = amplitudes[:, np.newaxis, np.newaxis] * temps
 
     return scaled
 
@@ -281,6 +402,8 @@ def get_good_cluster(results_dir, n=1):
 
 def get_labels(results_dir):
     """Load good/mua labels as a list of ['cluster', 'label'] pairs."""
+    if isinstance(results_dir, SortingResults):
+        results_dir = results_dir.results_dir
     results_dir = Path(results_dir)
     filename = results_dir / 'cluster_KSLabel.tsv'
     with open(filename) as f:
@@ -1,16 +1,21 @@
 import logging
 logger = logging.getLogger(__name__)
+import os
+import shutil
+import tempfile
+from pathlib import Path
 
-from scipy.sparse import coo_matrix
 import numpy as np
 from scipy.ndimage import gaussian_filter
 import torch
 
-from kilosort import spikedetect
+from kilosort import spikedetect, io
+from kilosort.utils import run_rng, get_rng_state, set_rng_state
 import medicine
 
-def bin_spikes(ops, st):
+def bin_spikes(ops, st, n_batches=None):
     """ for each batch, the spikes in that batch are binned to a 2D matrix by amplitude and depth
+    batches are numbered by st[:,4], from 0 to n_batches-1 (ops['Nbatches'] by default)
     """
 
     # the bin edges are based on min and max of channel y positions
@@ -24,38 +29,36 @@ def bin_spikes(ops, st):
     # dmax is how many bins to use
     dmax = 1 + np.ceil((ymax-dmin)/dd).astype('int32')
 
-    Nbatches = ops['Nbatches']
-    
-    batch_id = st[:,4].copy()
+    Nbatches = ops['Nbatches'] if n_batches is None else n_batches
 
-    # always use 20 bins for amplitude binning
-    F = np.zeros((Nbatches, dmax, 20))
-    for t in range(ops['Nbatches']):
-        # consider only spikes from this batch
-        ix = (batch_id==t).nonzero()[0]
-        sst = st[ix]
+    # consider only spikes from batches 0 to Nbatches-1
+    batch_id = st[:,4].astype('int64')
+    ix = ((batch_id >= 0) & (batch_id < Nbatches)).nonzero()[0]
+    sst = st[ix]
 
-        # their depth relative to the minimum
-        dep = sst[:,1] - dmin
+    # their depth relative to the minimum
+    dep = sst[:,1] - dmin
 
-        # the amplitude binnning is logarithmic, goes from the Th_universal minimum value to 100. 
-        amp = np.log10(np.minimum(99, sst[:,2])) - np.log10(ops['Th_universal'])
+    # the amplitude binnning is logarithmic, goes from the Th_universal minimum value to 100. 
+    amp = np.log10(np.minimum(99, sst[:,2])) - np.log10(ops['Th_universal'])
 
-        # amplitudes get normalized from 0 to 1
-        amp = amp / (np.log10(100)-np.log10(ops['Th_universal']))
+    # amplitudes get normalized from 0 to 1
+    amp = amp / (np.log10(100)-np.log10(ops['Th_universal']))
 
-        # rows are divided by the vertical binning depth
-        rows = (dep/dd).astype('int32')
+    # rows are divided by the vertical binning depth
+    rows = (dep/dd).astype('int32')
 
-        # columns are from 0 to 20
-        cols = (1e-5 + amp * 20).astype('int32')
+    # columns are from 0 to 20
+    cols = (1e-5 + amp * 20).astype('int32')
 
-        # for efficient binning, use sparse matrix computation in scipy
-        cou = np.ones(len(ix))
-        M = coo_matrix((cou, (rows, cols)), (dmax, 20))
+    # all spikes are counted at once in (batch, depth, amplitude) bins, always
+    # using 20 bins for amplitude. ravel_multi_index raises an error for
+    # out-of-range bins instead of counting them in a neighboring batch.
+    idx = np.ravel_multi_index((batch_id[ix], rows, cols), (Nbatches, dmax, 20))
+    F = np.bincount(idx, minlength=Nbatches*dmax*20).reshape(Nbatches, dmax, 20)
 
-        # the 2D histogram counts are transformed to logarithm
-        F[t] = np.log2(1+M.todense())
+    # the 2D histogram counts are transformed to logarithm
+    F = np.log2(1 + F)
 
     # center of each vertical sampling bin
     ysamp = dmin + dd * np.arange(dmax) - dd/2
@@ -63,13 +66,65 @@ def bin_spikes(ops, st):
     return F, ysamp
 
 
-def align_block2(F, ysamp, ops, device=torch.device('cuda')):
+def shift_correlation(F, F0, n):
+    """Dot products of fingerprints `F` with `F0`, for vertical shifts -n to n.
+
+    Equivalent to `(torch.roll(F, s, 1) * F0).mean(-1).mean(-1)` for each
+    shift `s`, but all shifts are computed at once as a circular
+    cross-correlation along depth, using FFTs.
+
+    Parameters
+    ----------
+    F : torch.Tensor
+        Fingerprints with shape (n_batches, n_depth_bins, n_amplitude_bins).
+    F0 : torch.Tensor
+        Template fingerprint with shape (n_depth_bins, n_amplitude_bins).
+    n : int
+        Maximum shift, in units of depth bins.
+
+    Returns
+    -------
+    dc : torch.Tensor
+        Dot products with shape (2*n+1, n_batches).
+
+    """
+    nd = F.shape[1]
+    # amplitude bins are summed in the frequency domain, so only one inverse
+    # transform per batch is needed
+    X = (torch.fft.rfft(F0, dim=0) * torch.fft.rfft(F, dim=1).conj()).sum(-1)
+    c = torch.fft.irfft(X, n=nd, dim=1) / (nd * F.shape[2])
+    dt = torch.arange(-n, n+1, device=F.device) % nd
+
+    return c[:, dt].T
+
 
-    Nbatches = ops['Nbatches']
+def shift_fingerprints(F, shifts):
+    """Circularly shift each batch of `F` along depth, like `torch.roll`.
+
+    Parameters
+    ----------
+    F : torch.Tensor
+        Fingerprints with shape (n_batches, n_depth_bins, n_amplitude_bins).
+    shifts : array-like
+        Integer shift for each batch, in units of depth bins.
+
+    """
+    nd = F.shape[1]
+    shifts = torch.as_tensor(shifts, device=F.device).long()
+    idx = (torch.arange(nd, device=F.device) - shifts.unsqueeze(1)) % nd
+    return torch.gather(F, 1, idx.unsqueeze(-1).expand_as(F))
+
+
+def align_block2(F, ysamp, ops, device=torch.device('cuda'), nskip=1):
+
+    Nbatches = F.shape[0]
     
     # n is the maximum vertical shift allowed, in units of bins
-    n = 15
-    dc = np.zeros((2*n+1, Nbatches))
+    max_shift = ops.get('max_drift_shift', None)
+    if max_shift is None:
+        n = 15
+    else:
+        n = int(np.ceil(max_shift / ops['binning_depth']))
     dt = np.arange(-n,n+1,1)
 
     # batch fingerprints are mean subtracted along depth
@@ -86,22 +141,16 @@ def align_block2(F, ysamp, ops, device=torch.device('cuda')):
     # Fg is incrementally modified, and cumulative shifts are accumulated over iterations
     for iter in range(niter):
         # for each vertical shift in the range -n to n, compute the dot product
-        for t in range(len(dt)):
-            Fs = torch.roll(Fg, dt[t], 1)
-            dc[t] = (Fs * F0).mean(-1).mean(-1).cpu().numpy()
+        dc = shift_correlation(Fg, F0, n).cpu().numpy()
 
         # for all but the last iteration, align the batches 
         if iter<niter-1:
             # the maximum dot product is the best match for each batch
             imax = np.argmax(dc, 0)
 
-            for t in range(len(dt)):
-                # for batches which have the maximum at dt[t]
-                ib = imax==t
-
-                # roll the fingerprints for those batches by dt[t]
-                Fg[ib] = torch.roll(Fg[ib], dt[t], 1)
-                dall[iter, ib] = dt[t]
+            # shift the fingerprints of each batch by its best shift
+            dall[iter] = dt[imax]
+            Fg = shift_fingerprints(Fg, dall[iter])
 
         # take the mean of the aligned batches. This will be the new fingerprint template. 
         F0 = Fg.mean(0)
@@ -129,10 +178,7 @@ def align_block2(F, ysamp, ops, device=torch.device('cuda')):
         yblk[j] = ysamp[isub].mean()
 
         Fsub = Fg[:, isub]
-
-        for t in range(len(dt)):
-            Fs = torch.roll(Fsub, dt[t], 1)
-            dcs[t, :, j] = (Fs * F0[isub]).mean(-1).mean(-1).cpu().numpy()
+        dcs[:, :, j] = shift_correlation(Fsub, F0[isub], n).cpu().numpy()
 
     # upsamples the dot-product matrices by 10 to get finer estimates of vertica ldrift
     dtup = np.linspace(-n,n,2*n*10+1)
@@ -141,7 +187,11 @@ def align_block2(F, ysamp, ops, device=torch.device('cuda')):
     Kn = kernelD(dt,dtup,1) 
 
     # smooth the dot-product matrices across correlation, batches, and vertical offsets
-    dcs = gaussian_filter(dcs, ops['drift_smoothing'])
+    # if only every nskip-th batch was used, batch smoothing is scaled so that it
+    # spans the same amount of time
+    sig = list(ops['drift_smoothing'])
+    sig[1] = sig[1] / nskip
+    dcs = gaussian_filter(dcs, sig)
 
     # for each block, upsample the dot-product matrix and find new max
     imin = np.zeros((Nbatches, nblocks))
@@ -160,9 +210,7 @@ def align_block2(F, ysamp, ops, device=torch.device('cuda')):
     imax = dall[:niter-1].sum(0)
 
     # Fg gets aligned again to compute the non-mean subtracted fingerprint    
-    for t in range(len(dt)):
-        ib = imax==dt[t]
-        Fg[ib] = torch.roll(Fg[ib], dt[t], 1)
+    Fg = shift_fingerprints(Fg, imax)
     F0m = Fg.mean(0)
 
     return imin, yblk, F0, F0m
@@ -183,6 +231,147 @@ def kernel2D(x, y, sig = 1):
     Kn = np.exp(-ds / (2*sig**2))
     return Kn
 
+# settings that change the spikes detected for motion estimation
+DETECTION_SETTINGS = [
+    'fs', 'nt', 'nt0min', 'Th_universal', 'templates_from_data',
+    'min_template_size', 'template_sizes', 'nearest_chans', 'nearest_templates',
+    'max_channel_distance', 'n_pcs', 'Th_single_ch', 'dmin', 'dminx',
+    'x_centers', 'precision'
+    ]
+# settings that change the kilosort drift estimate for the same spikes
+DRIFT_SETTINGS = [
+    'nblocks', 'binning_depth', 'drift_smoothing', 'max_drift_shift',
+    'drift_nskip'
+    ]
+MEDICINE_KWARGS = {'training_steps': 2000}
+
+
+def motion_cache_dir(ops, bfile):
+    """Directory for cached motion estimates, or None if caching is disabled.
+
+    Caching is also skipped if `bfile` doesn't read its data directly from
+    `bfile.filename`, like for a `file_object` from SpikeInterface, since
+    the cache key can't identify the data.
+
+    """
+    settings = ops.get('settings', {})
+    if not settings.get('cache_motion', False):
+        return None
+    f = getattr(bfile, 'file', None)
+    if not (isinstance(f, (np.memmap, io.CompressedBinary))
+            and f.filename is not None and bfile.filename is not None
+            and Path(f.filename).resolve() == Path(bfile.filename).resolve()):
+        logger.info('Data are not read from a binary file, so the motion '
+                    'estimate will not be cached.')
+        return None
+    cache_dir = settings.get('motion_cache_dir', None)
+    if cache_dir is None:
+        cache_dir = _results_dir(ops) / '.motion_cache'
+    return Path(cache_dir)
+
+
+def _results_dir(ops):
+    results_dir = ops['settings'].get('results_dir', None)
+    if results_dir is None:
+        results_dir = Path(ops['data_dir']) / 'kilosort4'
+    return Path(results_dir)
+
+
+def motion_cache_key(ops, bfile, method):
+    """Hash of the data, time range and settings that determine motion estimates."""
+    state = [
+        method, bfile.filename, bfile.n_chan_bin, bfile.dtype, bfile.NT,
+        bfile.nt, bfile.imin, bfile.imax, bfile.shift, bfile.scale,
+        bfile.offset, bfile.chan_map, bfile.hp_filter, bfile.whiten_mat,
+        bfile.do_CAR, bfile.car_method, bfile.car_groups, bfile.invert_sign,
+        bfile.artifact_threshold, ops['xc'], ops['yc']
+        ]
+    if bfile.filename is not None and Path(bfile.filename).is_file():
+        # a modified data file gets a new key
+        stat = os.stat(bfile.filename)
+        state.extend([stat.st_size, stat.st_mtime_ns])
+    names = DETECTION_SETTINGS
+    if method == 'kilosort':
+        names = names + DRIFT_SETTINGS
+    else:
+        state.append(MEDICINE_KWARGS)
+    state.extend([ops['settings'].get(k, None) for k in names])
+
+    return io.hash_state(state)
+
+
+def load_cached_motion(cache_dir, key):
+    """Load arrays saved by `save_cached_motion`, or return None if missing."""
+    path = Path(cache_dir) / key
+    if not path.is_dir():
+        return None
+    logger.info(f'Using cached motion estimate from {path}')
+    return {f.stem: np.load(f) for f in path.glob('*.npy')}
+
+
+def save_rng_state(output_dir):
+    """Save random number generator states to `output_dir`.
+
+    Motion estimation uses the numpy and torch generators (through KMeans
+    and MEDiCINe training), so their states are restored along with a cached
+    estimate to get the same sorting results as without the cache. For runs
+    from `run_kilosort_multi`, this is the run's own state (see
+    `utils.run_rng`), not that of the global generators.
+
+    """
+    state = get_rng_state()
+    _, key, pos, has_gauss, gauss = state['numpy']
+    np.save(output_dir / 'np_rng_key.npy', key)
+    np.save(output_dir / 'np_rng_pos.npy', np.array([pos, has_gauss, gauss]))
+    np.save(output_dir / 'torch_rng.npy', state['torch'].numpy())
+
+
+def restore_rng_state(cached):
+    """Restore random number generator states saved by `save_rng_state`."""
+    pos, has_gauss, gauss = cached['np_rng_pos']
+    set_rng_state({
+        'numpy': ('MT19937', cached['np_rng_key'], int(pos), int(has_gauss),
+                  float(gauss)),
+        'torch': torch.from_numpy(cached['torch_rng'])
+        })
+
+
+def save_cached_motion(cache_dir, key, write):
+    """Call `write(directory)` to save a motion estimate to the cache.
+
+    Files are written to a temporary directory first, which is then renamed,
+    so that concurrent runs never see partial results. If another run already
+    saved the same key, the new copy is discarded. If the cache can't be
+    written to, like on read-only storage, a warning is logged and the
+    estimate is not cached.
+
+    Returns
+    -------
+    bool
+        True if the estimate is in the cache.
+
+    """
+    cache_dir = Path(cache_dir)
+    tmp_dir = None
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(
+            tempfile.mkdtemp(prefix=f'{key}.', suffix='.tmp', dir=cache_dir)
+            )
+        write(tmp_dir)
+        tmp_dir.rename(cache_dir / key)
+        logger.info(f'Saved motion estimate to {cache_dir / key}')
+    except OSError as e:
+        if not (cache_dir / key).is_dir():
+            logger.warning(f'Could not save motion estimate to {cache_dir}, '
+                           f'continuing without caching: {e}')
+            return False
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return True
+
+
 def run_medicine(ops, bfile, device=torch.device('cuda'), progress_bar=None,
         clear_cache=False):
     
@@ -191,22 +380,43 @@ def run_medicine(ops, bfile, device=torch.device('cuda'), progress_bar=None,
         logger.info('nblocks = 0, skipping drift correction')
         return ops, None
 
-    # Extract spikes
-    st, _, ops  = spikedetect.run(
-        ops, bfile, device=device, progress_bar=progress_bar,
-        clear_cache=clear_cache,
-    )
-
-    # Run MEDiCINe to estimate motion
-    medicine_output_dir = ops['data_dir'] / 'medicine_output'
-    medicine.run_medicine(
-        peak_amplitudes=st[:, 2],
-        peak_depths=st[:, 1],
-        peak_times=st[:, 0],
-        output_dir=medicine_output_dir,
-        training_steps=2000,
-    )
-    motion = np.mean(np.load(medicine_output_dir / 'motion.npy'), axis=1)
+    cache_dir = motion_cache_dir(ops, bfile)
+    cached = None
+    if cache_dir is not None:
+        key = motion_cache_key(ops, bfile, 'medicine')
+        cached = load_cached_motion(cache_dir, key)
+
+    if cached is not None:
+        st, motion = cached['st'], cached['motion']
+        restore_rng_state(cached)
+    else:
+        # Extract spikes
+        st, _, ops  = spikedetect.run(
+            ops, bfile, device=device, progress_bar=progress_bar,
+            clear_cache=clear_cache,
+        )
+
+        # Run MEDiCINe to estimate motion, training draws from the global
+        # torch generator
+        medicine_output_dir = _results_dir(ops) / 'medicine_output'
+        with run_rng():
+            medicine.run_medicine(
+                peak_amplitudes=st[:, 2],
+                peak_depths=st[:, 1],
+                peak_times=st[:, 0],
+                output_dir=medicine_output_dir,
+                **MEDICINE_KWARGS
+            )
+        motion = np.load(medicine_output_dir / 'motion.npy')
+
+        if cache_dir is not None:
+            def write(output_dir):
+                shutil.copytree(medicine_output_dir, output_dir, dirs_exist_ok=True)
+                np.save(output_dir / 'st.npy', st)
+                save_rng_state(output_dir)
+            save_cached_motion(cache_dir, key, write)
+
+    motion = np.mean(motion, axis=1)
     dshift_indices = np.linspace(0, len(motion), ops['Nbatches'] + 1)
     dshift_indices = np.floor(dshift_indices).astype(int)[:-1]
     dshift = motion[dshift_indices]
@@ -221,33 +431,80 @@ def run_medicine(ops, bfile, device=torch.device('cuda'), progress_bar=None,
 
     return ops, st
 
-def run(ops, bfile, device=torch.device('cuda'), progress_bar=None,
-        clear_cache=False):
-    """ this step computes a drift correction model
-    it returns vertical correction amplitudes for each batch, and for multiple blocks in a batch if nblocks > 1. 
+def estimate_drift(ops, bfile, device=torch.device('cuda'), progress_bar=None,
+                   clear_cache=False):
+    """ detects spikes and aligns batch fingerprints to estimate drift
+    returns the spikes, the shift of each block in each batch in microns, and the block centers
     """
-    
-    if ops['nblocks']<1:
-        ops['dshift'] = None 
-        logger.info('nblocks = 0, skipping drift correction')
-        return ops, None
-    
+
+    # drift is estimated from every nskip-th batch, and interpolated for the rest
+    nskip = ops.get('drift_nskip', 1)
+    ib = np.arange(0, ops['Nbatches'], nskip)
+    if nskip > 1:
+        logger.info(f'Estimating drift from {len(ib)} of {ops["Nbatches"]} batches')
+
     # the first step is to extract all spikes using the universal templates
     st, _, ops  = spikedetect.run(
         ops, bfile, device=device, progress_bar=progress_bar,
-        clear_cache=clear_cache
+        clear_cache=clear_cache, batch_indices=ib
         )
 
     # spikes are binned by amplitude and y-position to construct a "fingerprint" for each batch
-    F, ysamp = bin_spikes(ops, st)
+    # fingerprints are numbered by position in ib, not by batch index
+    sts = st.copy()
+    sts[:,4] = np.searchsorted(ib, st[:,4])
+    F, ysamp = bin_spikes(ops, sts, n_batches=len(ib))
 
     # the fingerprints are iteratively aligned to each other vertically
-    imin, yblk, _, _ = align_block2(F, ysamp, ops, device=device)
+    imin, yblk, _, _ = align_block2(F, ysamp, ops, device=device, nskip=nskip)
+
+    if nskip > 1:
+        # shifts for skipped batches are linearly interpolated, separately for each block
+        imin = np.stack([
+            np.interp(np.arange(ops['Nbatches']), ib, imin[:,j])
+            for j in range(imin.shape[1])
+            ], axis=1)
 
     # imin contains the shifts for each batch, in units of discrete bins
     # multiply back with binning_depth for microns
     dshift = imin * ops['binning_depth']
 
+    return st, dshift, yblk
+
+def run(ops, bfile, device=torch.device('cuda'), progress_bar=None,
+        clear_cache=False):
+    """ this step computes a drift correction model
+    it returns vertical correction amplitudes for each batch, and for multiple blocks in a batch if nblocks > 1. 
+    """
+    
+    if ops['nblocks']<1:
+        ops['dshift'] = None 
+        logger.info('nblocks = 0, skipping drift correction')
+        return ops, None
+
+    # drift estimates are re-used from previous runs with the same data and settings
+    cache_dir = motion_cache_dir(ops, bfile)
+    cached = None
+    if cache_dir is not None:
+        key = motion_cache_key(ops, bfile, 'kilosort')
+        cached = load_cached_motion(cache_dir, key)
+
+    if cached is not None:
+        st, dshift, yblk = cached['st'], cached['dshift'], cached['yblk']
+        restore_rng_state(cached)
+    else:
+        st, dshift, yblk = estimate_drift(
+            ops, bfile, device=device, progress_bar=progress_bar,
+            clear_cache=clear_cache
+            )
+        if cache_dir is not None:
+            def write(output_dir):
+                np.save(output_dir / 'st.npy', st)
+                np.save(output_dir / 'dshift.npy', dshift)
+                np.save(output_dir / 'yblk.npy', yblk)
+                save_rng_state(output_dir)
+            save_cached_motion(cache_dir, key, write)
+
     # we save the variables needed for drift correction during the data preprocessing step
     ops['yblk'] = yblk
     ops['dshift'] = dshift 
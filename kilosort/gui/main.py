@@ -374,12 +374,18 @@ class KilosortGUI(QtWidgets.QMainWindow):
         xc = self.probe_layout["xc"]
         yc = self.probe_layout["yc"]
         nskip = self.params["nskip"]
+        whitening_tol = self.params["whitening_tol"]
+        whitening_max_batches = self.params["whitening_max_batches"]
         data_dtype = self.params["data_dtype"]
         tmin = self.params['tmin']
         tmax = self.params['tmax']
         artifact = self.params['artifact_threshold']
         shift = self.params['shift']
         scale = self.params['scale']
+        offset = self.params['byte_offset']
+        car_method = self.params['car_method']
+        fused = self.params['fused_preprocessing']
+        kcoords = self.probe_layout['kcoords']
 
         if chan_map.max() >= n_channels:
             raise ValueError(
@@ -399,7 +405,11 @@ class KilosortGUI(QtWidgets.QMainWindow):
             artifact_threshold=artifact,
             shift=shift,
             scale=scale,
-            file_object=self.file_object
+            file_object=self.file_object,
+            offset=offset,
+            car_method=car_method,
+            car_groups=kcoords,
+            fused=fused
         )
 
         self.context.binary_file = binary_file
@@ -423,13 +433,19 @@ class KilosortGUI(QtWidgets.QMainWindow):
             artifact_threshold=artifact,
             shift=shift,
             scale=scale,
-            file_object=self.file_object
+            file_object=self.file_object,
+            offset=offset,
+            car_method=car_method,
+            car_groups=kcoords,
+            fused=fused
         ) as bin_file:
             self.context.whitening_matrix = preprocessing.get_whitening_matrix(
                 f=bin_file,
                 xc=xc,
                 yc=yc,
                 nskip=nskip,
+                tol=whitening_tol,
+                max_batches=whitening_max_batches
             )
 
         filt_binary_file = BinaryFiltered(
@@ -446,7 +462,11 @@ class KilosortGUI(QtWidgets.QMainWindow):
             artifact_threshold=artifact,
             shift=shift,
             scale=scale,
-            file_object=self.file_object
+            file_object=self.file_object,
+            offset=offset,
+            car_method=car_method,
+            car_groups=kcoords,
+            fused=fused
         )
 
         self.context.filt_binary_file = filt_binary_file
@@ -536,7 +536,8 @@ class SettingsBox(QtWidgets.QGroupBox):
             return False
 
         none_allowed = [
-            'dmin', 'nt0min', 'x_centers', 'shift', 'scale', 'max_channel_distance'
+            'dmin', 'nt0min', 'x_centers', 'shift', 'scale', 'max_channel_distance',
+            'whitening_max_batches', 'max_drift_shift'
             ]
         for k, v in self.settings.items():
             if v is None and k not in none_allowed:
@@ -911,6 +912,8 @@ def _check_parameter(sender_obj, main_obj, k, p):
             v = _str_to_type(value, p['type'])
             if isinstance(v, bool) or isinstance(v, list):
                 pass
+            elif isinstance(v, str):
+                assert v in p['options']
             else:
                 assert v >= p['min']
                 assert v <= p['max']
@@ -929,11 +932,17 @@ def _check_parameter(sender_obj, main_obj, k, p):
         main_obj.disable_load()
 
     except AssertionError:
-        logger.exception(
-            f"Invalid inputs!\n {p['gui_name']} must be in the range:\n"
-            f"{p['min']} <= {p['gui_name']} <= {p['max']},\n"
-            f"{p['gui_name']} != {p['exclude']}"
-        )
+        if p['type'] is str:
+            logger.exception(
+                f"Invalid inputs!\n {p['gui_name']} must be one of: "
+                f"{p['options']}"
+            )
+        else:
+            logger.exception(
+                f"Invalid inputs!\n {p['gui_name']} must be in the range:\n"
+                f"{p['min']} <= {p['gui_name']} <= {p['max']},\n"
+                f"{p['gui_name']} != {p['exclude']}"
+            )
         main_obj.disable_load()
 
     finally:
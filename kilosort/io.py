@@ -3,20 +3,31 @@ from pathlib import Path
 from typing import Tuple, Union
 import os, shutil
 import warnings
-from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import bisect
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
+import queue
+import threading
 import time
+import zlib
 import logging
 logger = logging.getLogger(__name__)
 
 from scipy.io import loadmat
 import numpy as np
 import torch
-from torch.fft import fft, ifft, fftshift
+from torch.fft import fft, ifft, fftshift, rfft, irfft
 
 from kilosort import CCG
-from kilosort.preprocessing import get_drift_matrix, fft_highpass
+from kilosort.parameters import DEFAULT_SETTINGS
+from kilosort.preprocessing import (
+    get_drift_matrix, get_drift_matrices, fft_highpass, common_reference,
+    CAR_METHODS
+    )
 from kilosort.postprocessing import (
-    remove_duplicates, compute_spike_positions, make_pc_features
+    remove_duplicates, compute_spike_positions, save_pc_features
     )
 
 _torch_warning = ".*PyTorch does not support non-writable tensors"
@@ -27,11 +38,12 @@ def find_binary(data_dir: Union[str, os.PathLike]) -> Path:
 
     data_dir = Path(data_dir)
     filenames = list(data_dir.glob('*.bin')) + list(data_dir.glob('*.bat')) \
-                + list(data_dir.glob('*.dat')) + list(data_dir.glob('*.raw'))
+                + list(data_dir.glob('*.dat')) + list(data_dir.glob('*.raw')) \
+                + list(data_dir.glob('*.ksc'))
     if len(filenames) == 0:
         raise FileNotFoundError(
             f'No binary file found in {data_dir}. Expected extensions are:\n'
-            '*.bin, *.bat, *.dat, or *.raw.'
+            '*.bin, *.bat, *.dat, *.raw, or *.ksc (compressed).'
             )
 
     # TODO: Why give this preference? Not all binary files will have this tag.
@@ -48,6 +60,91 @@ def find_binary(data_dir: Union[str, os.PathLike]) -> Path:
     return filenames[0]
 
 
+def find_spikeglx_meta(filename):
+    """Get path to the SpikeGLX `.meta` file for `filename`, or None."""
+    filename = Path(filename)
+    meta_path = filename if filename.suffix == '.meta' \
+        else filename.with_suffix('.meta')
+    return meta_path if meta_path.is_file() else None
+
+
+def read_spikeglx_meta(filename):
+    """Load key-value pairs from a SpikeGLX `.meta` file.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Path to the `.meta` file, or to the binary file next to it
+        (e.g. `run_g0_t0.imec0.ap.bin` for `run_g0_t0.imec0.ap.meta`).
+
+    Returns
+    -------
+    meta : dict
+        All values are strings. Leading '~' characters are removed from keys.
+
+    """
+    meta_path = find_spikeglx_meta(filename)
+    if meta_path is None:
+        raise FileNotFoundError(f'No SpikeGLX .meta file found for {filename}.')
+
+    meta = {}
+    with open(meta_path) as f:
+        for line in f.read().splitlines():
+            if '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            meta[key.strip().lstrip('~')] = value.strip()
+
+    return meta
+
+
+def spikeglx_settings(filename):
+    """Get binary file settings from the SpikeGLX `.meta` file for `filename`.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Path to the `.meta` file, or to the binary file next to it.
+
+    Returns
+    -------
+    info : dict
+        'n_chan_bin' : Number of channels saved in the binary file.
+        'fs' : Sampling rate in Hz.
+        'sync_channel' : Index of the sync (or first digital) channel in the
+            binary file, or None if there isn't one.
+        'n_samples' : Number of samples, according to `fileSizeBytes`.
+
+    Examples
+    --------
+    >>> info = spikeglx_settings('/data/run_g0_t0.imec0.ap.bin')
+    >>> settings = {'n_chan_bin': info['n_chan_bin'], 'fs': info['fs']}
+
+    """
+    meta = read_spikeglx_meta(filename)
+    n_chan_bin = int(meta['nSavedChans'])
+    sync_channel = None
+    if meta.get('typeThis', 'imec' if 'imSampRate' in meta else 'nidq') == 'imec':
+        fs = float(meta['imSampRate'])
+        # Counts of AP, LFP and sync channels, which are saved in that order.
+        if 'snsApLfSy' in meta:
+            n_sync = int(meta['snsApLfSy'].split(',')[-1])
+            if n_sync > 0:
+                sync_channel = n_chan_bin - n_sync
+    else:
+        fs = float(meta['niSampRate'])
+        # Counts of MN, MA, XA and digital word channels, saved in that order.
+        if 'snsMnMaXaDw' in meta:
+            n_digital = int(meta['snsMnMaXaDw'].split(',')[-1])
+            if n_digital > 0:
+                sync_channel = n_chan_bin - n_digital
+    n_samples = int(meta['fileSizeBytes']) // (2 * n_chan_bin) \
+        if 'fileSizeBytes' in meta else None
+
+    return {'n_chan_bin': n_chan_bin, 'fs': fs, 'sync_channel': sync_channel,
+            'n_samples': n_samples}
+
+
 def load_probe(probe_path):
     """Load a .mat probe file from Kilosort2, or a PRB file and returns a dictionary
     
@@ -220,7 +317,7 @@ def remove_bad_channels(probe, bad_channels):
 
 def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
                 data_dtype=None, save_extra_vars=False,
-                save_preprocessed_copy=False):
+                save_preprocessed_copy=False, pc_chunk_size=2**16):
     """Save sorting results to disk in a format readable by Phy.
 
     Parameters
@@ -256,6 +353,9 @@ def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
         If True, save a pre-processed copy of the data (including drift
         correction) to `temp_wh.dat` in the results directory and format Phy
         output to use that copy of the data.
+    pc_chunk_size : int; default=2**16.
+        Number of spikes processed at a time when writing `pc_features.npy`.
+        Smaller values reduce peak memory usage.
     
     Returns
     -------
@@ -315,6 +415,9 @@ def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
         Dictionary containing a number of state variables saved throughout
         the sorting process (see `run_kilosort`). We recommend loading with
         `kilosort.io.load_ops`.
+    ops/ : shape N/A
+        Structured copy of `ops.npy`, with settings in `ops.json` and one
+        `.npy` file per array. Used by `kilosort.io.load_ops` when present.
     params.py : shape N/A
         Settings used by Phy, like data location and sampling rate.
     pc_features.npy : shape (n_spikes, n_pcs, nearest_chans)
@@ -413,15 +516,12 @@ def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
     
     # pc features
     if save_extra_vars:
-        # Save tF first since it gets updated in-place
         np.save(results_dir / 'tF.npy', tF.cpu().numpy())
-    # This will momentarily copy tF which is pretty large, but it's on CPU
-    # so the extra memory hopefully won't be an issue.
-    tF = tF[kept_spikes]
-    pc_features, pc_feature_ind = make_pc_features(
-        ops, spike_templates, spike_clusters, tF
+    # Written in chunks of spikes, to avoid copying tF which can be very large.
+    pc_feature_ind = save_pc_features(
+        results_dir / 'pc_features.npy', ops, spike_templates, spike_clusters,
+        tF, kept_spikes=kept_spikes, chunk_size=pc_chunk_size
         )
-    np.save(results_dir / 'pc_features.npy', pc_features)
     np.save(results_dir / 'pc_feature_ind.npy', pc_feature_ind)
 
     # contamination ratio
@@ -456,11 +556,18 @@ def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
         }
     if save_preprocessed_copy:
         dat_path = results_dir / 'temp_wh.dat'
-        params['dtype'] = "'int16'"
+        params['dtype'] = f"'{ops.get('preprocessed_dtype', 'int16')}'"
         params['hp_filtered'] = True
         params['dat_path'] = f"'{dat_path.resolve().as_posix()}'"
     else:
         dat_path = Path(ops['settings']['filename'])
+        params['offset'] = ops['settings'].get('byte_offset', 0)
+        if dat_path.suffix == '.ksc':
+            logger.warning(
+                'Phy cannot read compressed binary files, raw waveforms will '
+                'not be available unless `dat_path` in params.py is changed '
+                'to point to the uncompressed data.'
+                )
         params['dtype'] = dtype
         params['hp_filtered'] = False
         params['dat_path'] = f"'{dat_path.resolve().as_posix()}'"
@@ -487,7 +594,14 @@ def save_to_phy(st, clu, tF, Wall, probe, ops, imin, results_dir=None,
 
 
 def save_ops(ops, results_dir=None):
-    """Save intermediate `ops` dictionary to `results_dir/ops.npy`."""
+    """Save intermediate `ops` dictionary to `results_dir/ops.npy`.
+
+    A structured copy is also saved to the `results_dir/ops` directory, with
+    settings and other small values in `ops.json` and one `.npy` file per
+    array. `load_ops` uses this copy when it exists, so that arrays are only
+    read from disk when they are accessed.
+
+    """
 
     if results_dir is None:
         results_dir = Path(ops['data_dir']) / 'kilosort4'
@@ -504,29 +618,260 @@ def save_ops(ops, results_dir=None):
     ops['data_dir'] = str(ops['data_dir'])
     ops['settings']['filename'] = str(ops['settings']['filename'])
     ops['settings']['data_dir'] = str(ops['settings']['data_dir'])
+    ops['is_tensor'] = [k for k, v in ops.items() if isinstance(v, torch.Tensor)]
 
     # Convert pytorch tensors to numpy arrays before saving, otherwise loading
     # ops on a different system may not work (if saved from GPU, but loaded
     # on a system with only CPU).
-    ops['is_tensor'] = []
-    for k, v in ops.items():
-        if isinstance(v, torch.Tensor):
-            ops[k] = v.cpu().numpy()
-            ops['is_tensor'].append(k)
-    ops['preprocessing'] = {k: v.cpu().numpy()
-                            for k, v in ops['preprocessing'].items()}
+    ops_np = ops.copy()
+    for k in ops['is_tensor']:
+        ops_np[k] = ops[k].cpu().numpy()
+    ops_np['preprocessing'] = {k: v.cpu().numpy()
+                               for k, v in ops['preprocessing'].items()}
+
+    np.save(results_dir / 'ops.npy', np.array(ops_np))
+    # Saved after ops.npy, `load_ops` only uses the store if it is newer.
+    save_ops_store(ops, results_dir / 'ops')
 
-    np.save(results_dir / 'ops.npy', np.array(ops))
+
+class _StoredValue:
+    """Placeholder for an `ops` value that is loaded from file on access."""
+
+    def __init__(self, filename, tensor=False, device=None, pickled=False):
+        self.filename = filename
+        self.tensor = tensor
+        self.device = device
+        self.pickled = pickled
+        self._loaded = False
+        self._value = None
+
+    def __repr__(self):
+        return f'<stored {self.filename.name}>'
+
+    def load(self):
+        if not self._loaded:
+            if self.pickled:
+                self._value = np.load(self.filename, allow_pickle=True).item()
+            elif self.tensor:
+                self._value = torch.from_numpy(np.load(self.filename))
+                self._value = self._value.to(self.device)
+            else:
+                # Copy-on-write, so in-place changes aren't saved to disk.
+                self._value = np.load(self.filename, mmap_mode='c')
+            self._loaded = True
+        return self._value
+
+
+class LazyOps(dict):
+    """`ops` dictionary loaded by `load_ops`, with arrays loaded on access.
+
+    Behaves like a regular dictionary, but values for arrays and tensors are
+    only read from the ops store the first time they are accessed. Pickling
+    (including `np.save`) produces a regular dictionary with all values loaded.
+
+    """
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, _StoredValue):
+            value = value.load()
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            dict.__delitem__(self, key)
+            return value
+        return dict.pop(self, key, *default)
+
+    def __iter__(self):
+        # Overriding this stops dict(ops) and {**ops} from copying stored
+        # values directly, so that they are loaded through __getitem__.
+        return dict.__iter__(self)
+
+    def items(self):
+        return [(k, self[k]) for k in self]
+
+    def values(self):
+        return [self[k] for k in self]
+
+    def copy(self):
+        return LazyOps(dict.items(self))
+
+    def __reduce__(self):
+        return (dict, (), None, None, iter(self.items()))
+
+
+def save_ops_store(ops, store_dir):
+    """Save `ops` as `ops.json` plus one `.npy` file per array in `store_dir`.
+
+    Arrays and tensors that appear more than once (like the copies in
+    `ops['settings']`) are only saved once. Values that can't be represented
+    in JSON are pickled to separate files. The directory is written to a
+    temporary location first and then moved into place.
+
+    """
+    store_dir = Path(store_dir)
+    tmp_dir = store_dir.with_name(store_dir.name + '.tmp')
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+    saved = {}  # id(array) -> (filename, array)
+
+    # Name shared arrays after their shortest key path, so that they are named
+    # after the top-level key rather than a copy in `ops['settings']`.
+    names = {}
+    queue, seen = [(ops, [])], {id(ops)}
+    for d, path in queue:
+        for k, v in d.items():
+            if isinstance(v, dict) and id(v) not in seen:
+                seen.add(id(v))
+                queue.append((v, path + [str(k)]))
+            elif isinstance(v, (np.ndarray, torch.Tensor)):
+                names.setdefault(id(v), path + [str(k)])
+
+    def save_array(value, path, **kwargs):
+        if id(value) not in saved:
+            filename = '.'.join(names.get(id(value), path)) + '.npy'
+            if isinstance(value, torch.Tensor):
+                np.save(tmp_dir / filename, value.cpu().numpy())
+            else:
+                np.save(tmp_dir / filename, value, **kwargs)
+            # Keep a reference so that the id isn't reused.
+            saved[id(value)] = (filename, value)
+        return saved[id(value)][0]
+
+    def encode(value, path, parents):
+        if isinstance(value, dict):
+            for i, p in enumerate(parents):
+                if value is p:
+                    # Reference to a parent dict, like `ops['settings']`.
+                    return {'__ref__': i}
+            if all(isinstance(k, str) for k in value):
+                return {k: encode(v, path + [k], parents + [value])
+                        for k, v in value.items()}
+        elif isinstance(value, torch.Tensor):
+            return {'__array__': save_array(value, path), 'tensor': True}
+        elif isinstance(value, (np.ndarray, np.generic)) \
+                and value.dtype != object:
+            if value.ndim == 0:
+                return {'__scalar__': value.item(), 'dtype': value.dtype.str}
+            return {'__array__': save_array(value, path)}
+        elif isinstance(value, Path):
+            return str(value)
+        elif isinstance(value, (list, tuple)):
+            return [encode(v, path + [str(i)], parents)
+                    for i, v in enumerate(value)]
+        elif value is None or isinstance(value, (bool, int, float, str)):
+            return value
+
+        obj = np.empty((), dtype=object)
+        obj[()] = value
+        return {'__pickle__': save_array(obj, path, allow_pickle=True)}
+
+    header = {'version': 1, 'ops': encode(ops, [], [])}
+    with open(tmp_dir / 'ops.json', 'w') as f:
+        json.dump(header, f, indent=1)
+
+    if store_dir.exists():
+        old_dir = store_dir.with_name(store_dir.name + '.old')
+        if old_dir.exists():
+            shutil.rmtree(old_dir)
+        store_dir.rename(old_dir)
+        tmp_dir.rename(store_dir)
+        # Files may still be memory-mapped by a previously loaded `ops`.
+        shutil.rmtree(old_dir, ignore_errors=True)
+    else:
+        tmp_dir.rename(store_dir)
+
+
+def _find_ops_store(ops_path):
+    """Get directory with a structured copy of `ops_path`, if one exists."""
+    ops_path = Path(ops_path)
+    if ops_path.is_dir():
+        return ops_path if (ops_path / 'ops.json').is_file() else None
+    store_dir = ops_path.parent / ops_path.stem
+    header = store_dir / 'ops.json'
+    if not header.is_file():
+        return None
+    if ops_path.is_file() and \
+            header.stat().st_mtime_ns < ops_path.stat().st_mtime_ns:
+        # ops.npy was overwritten by something other than `save_ops`.
+        return None
+    return store_dir
+
+
+def load_ops_store(store_dir, device=None):
+    """Load `ops` saved by `save_ops_store`, with arrays loaded on access."""
+    if device is None:
+        if torch.cuda.is_available():
+            device = torch.device('cuda')
+        else:
+            device = torch.device('cpu')
+    store_dir = Path(store_dir)
+    with open(store_dir / 'ops.json') as f:
+        header = json.load(f)
+
+    def decode(value, parents):
+        if isinstance(value, list):
+            return [decode(v, parents) for v in value]
+        if not isinstance(value, dict):
+            return value
+        if '__ref__' in value:
+            return parents[value['__ref__']]
+        if '__scalar__' in value:
+            return np.dtype(value['dtype']).type(value['__scalar__'])
+        if '__array__' in value:
+            return _StoredValue(
+                store_dir / value['__array__'], device=device,
+                tensor=value.get('tensor', False)
+                )
+        if '__pickle__' in value:
+            return _StoredValue(store_dir / value['__pickle__'], pickled=True)
+        d = LazyOps()
+        for k, v in value.items():
+            dict.__setitem__(d, k, decode(v, parents + [d]))
+        return d
+
+    ops = decode(header['ops'], [])
+    # Arrays in `preprocessing` are always loaded as tensors, see `load_ops`.
+    preprocessing = dict.get(ops, 'preprocessing', None)
+    if isinstance(preprocessing, LazyOps):
+        for v in dict.values(preprocessing):
+            if isinstance(v, _StoredValue):
+                v.tensor = True
+                v.device = device
+
+    return ops
 
 
 def load_ops(ops_path, device=None):
-    """Load a saved `ops` dictionary and convert some arrays to tensors."""
+    """Load a saved `ops` dictionary and convert some arrays to tensors.
+
+    If `ops_path` has a structured copy saved by `save_ops` (the `ops`
+    directory next to `ops.npy`), or is that directory, arrays are loaded
+    lazily from it instead. See `LazyOps`.
+
+    """
     if device is None:
         if torch.cuda.is_available():
             device = torch.device('cuda')
         else:
             device = torch.device('cpu')
 
+    store_dir = _find_ops_store(ops_path)
+    if store_dir is not None:
+        return load_ops_store(store_dir, device=device)
+
     ops = np.load(ops_path, allow_pickle=True).item()
     for k, v in ops.items():
         if k in ops['is_tensor']:
@@ -563,7 +908,12 @@ def bfile_from_ops(ops=None, ops_path=None, filename=None, device=None):
         hp_filter=ops['fwav'], whiten_mat=ops['Wrot'], dshift=ops['dshift'],
         device=device, do_CAR=ops['do_CAR'], artifact_threshold=ops['artifact_threshold'],
         invert_sign=ops['invert_sign'], dtype=ops['data_dtype'], tmin=ops['tmin'],
-        tmax=ops['tmax'], shift=ops['shift'], scale=ops['scale']
+        tmax=ops['tmax'], shift=ops['shift'], scale=ops['scale'],
+        prefetch=ops.get('prefetch_batches', DEFAULT_SETTINGS['prefetch_batches']),
+        offset=ops.get('byte_offset', 0),
+        car_method=ops.get('car_method', 'median'),
+        car_groups=ops['probe']['kcoords'],
+        fused=ops.get('fused_preprocessing', False)
         )
 
     return bfile
@@ -577,7 +927,8 @@ class BinaryRWFile:
                  NT: int = 60000, nt: int = 61, nt0min: int = 20,
                  device: torch.device = None, write: bool = False,
                  dtype: str = None, tmin: float = 0.0, tmax: float = np.inf,
-                 shift=None, scale=None, file_object=None):
+                 shift=None, scale=None, file_object=None, prefetch: int = 0,
+                 reuse_buffers: bool = False, offset: int = 0):
         """
         Creates/Opens a BinaryFile for reading and/or writing data that acts like numpy array
 
@@ -595,6 +946,18 @@ class BinaryRWFile:
             Must have 'shape' and 'dtype' attributes and support array-like
             indexing (e.g. [:100,:], [5, 7:10], etc). For example, a numpy
             array or memmap.
+        prefetch : int; default=0.
+            Number of batches to read ahead in background threads when
+            iterating with `iter_batches`. If 0, batches are read synchronously.
+        reuse_buffers : bool; default=False.
+            If True, `padded_batch_to_torch` copies data into preallocated
+            host (pinned, for GPU devices) and device buffers instead of
+            allocating new tensors for every batch. The returned tensor is then
+            a view of the device buffer, which is overwritten by the next call,
+            so it must not be kept after loading another batch.
+        offset : int; default=0.
+            Number of bytes at the start of the file to skip, for example a
+            file header. Ignored if `file_object` is specified.
 
         """
         # Extra casting statements to ensure that 64-bit values are used
@@ -607,6 +970,7 @@ class BinaryRWFile:
         self.nt0min = np.int64(nt0min)
         self.shift = shift
         self.scale = scale
+        self.offset = int(offset)
         tmin = np.float64(tmin)
         tmax = np.float64(tmax)
 
@@ -618,7 +982,21 @@ class BinaryRWFile:
         self.device = device
         self.uint_set_warning = True
         self.writable = write
-
+        self.prefetch = prefetch
+        # Background reads for upcoming batches, keyed by batch index.
+        self._pending = {}
+        self.reuse_buffers = reuse_buffers
+        # Staging buffers for `reuse_buffers`. Host buffers are pooled since
+        # several may be in use at once by `iter_batches`.
+        self._host_buffers = queue.SimpleQueue()
+        self._device_raw = None
+        self._device_buffer = None
+
+        if file_object is None and Path(filename).suffix == '.ksc':
+            # Chunk-compressed data, see `compress_binary`.
+            if write:
+                raise ValueError('Compressed binary files are read-only.')
+            file_object = CompressedBinary(filename)
         if file_object is not None:
             dtype = file_object.dtype
         if dtype is None:
@@ -635,7 +1013,9 @@ class BinaryRWFile:
 
         # Must come after dtype since dtype is necessary for nbytesread
         if file_object is None:
-            total_samples = get_total_samples(filename, n_chan_bin, dtype)
+            total_samples = get_total_samples(
+                filename, n_chan_bin, dtype, offset=self.offset
+                )
         else:
             n, c = file_object.shape
             assert c == n_chan_bin
@@ -663,7 +1043,8 @@ class BinaryRWFile:
             self.file = file_object
         else:
             self.file = np.memmap(self.filename, mode=mode, dtype=self.dtype,
-                                  shape=(total_samples, self.n_chan_bin))
+                                  shape=(total_samples, self.n_chan_bin),
+                                  offset=self.offset)
 
     @property
     def n_samples(self) -> int:
@@ -698,6 +1079,12 @@ class BinaryRWFile:
         """
         Closes the file.
         """
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        self._host_buffers = queue.SimpleQueue()
+        self._device_raw = None
+        self._device_buffer = None
         del(self.file)
         self.file = None
         
@@ -785,13 +1172,117 @@ class BinaryRWFile:
 
         return bstart, bend
 
+    def get_padded_inds(self, ibatch):
+        """Sample indices spanned by a padded batch, including edge padding."""
+        bstart, bend = self.get_batch_edges(ibatch)
+        if ibatch == 0:
+            bstart = self.imin - self.nt
+        elif ibatch == self.n_batches-1:
+            bend += self.nt
+        return [bstart, bend]
+
+    def _load_batch(self, ibatch, ops=None):
+        """Read raw samples for a padded batch into memory."""
+        # NOTE: `ops` is not used here, but subclasses may need it.
+        bstart, bend = self.get_batch_edges(ibatch)
+        if self.reuse_buffers:
+            host, host_array = self._get_host_buffer()
+            if hasattr(self.file, 'read_into'):
+                # Let the file object write directly into the buffer, like for
+                # BinaryFileGroup reads that span multiple files.
+                nsamp = self.file.read_into(host_array, bstart, bend)
+            else:
+                data = self.file[bstart : bend]
+                nsamp = data.shape[0]
+                host_array[:nsamp] = data
+            return host, host_array, nsamp
+        # Copy so that the data is actually read from disk here, rather than
+        # when the memmap view is first accessed.
+        return np.array(self.file[bstart : bend])
+
+    def _get_host_buffer(self):
+        try:
+            return self._host_buffers.get_nowait()
+        except queue.Empty:
+            pass
+        # Use the file's dtype where possible so that the copy from disk is a
+        # straight memcpy, conversion to float happens on the device.
+        if str(self.dtype) in ['int16', 'int32', 'float32']:
+            dtype = getattr(torch, str(self.dtype))
+        elif str(self.dtype) == 'uint16':
+            dtype = torch.int32
+        else:
+            dtype = torch.float32
+        host = torch.empty((self.NT + 2*self.nt, self.n_chan_bin), dtype=dtype,
+                           pin_memory=(self.device.type == 'cuda'))
+        return host, host.numpy()
+
+    def _staged_batch_to_torch(self, ibatch, host, host_array, nsamp):
+        """Copy data from a host staging buffer into the device buffer."""
+        if self._device_buffer is None:
+            self._device_buffer = torch.empty(
+                (self.n_chan_bin, self.NT + 2*self.nt), device=self.device
+                )
+        X = self._device_buffer
+
+        src = host[:nsamp]
+        if self.device.type != 'cpu':
+            # Copy to device in file layout first, so that the transpose and
+            # conversion to float happen on the device.
+            if self._device_raw is None:
+                self._device_raw = torch.empty(host.shape, dtype=host.dtype,
+                                               device=self.device)
+            self._device_raw[:nsamp].copy_(src)
+            src = self._device_raw[:nsamp]
+
+        # fix the data at the edges for the first and last batch
+        if ibatch == 0:
+            data = X[:, self.nt : self.nt+nsamp]
+        else:
+            data = X[:, :nsamp]
+        data.copy_(src.T)
+        # Host buffer can be reused once data has been copied out of it.
+        self._host_buffers.put((host, host_array))
+        if self.dtype == 'uint16':
+            # Shift data to +/- 2**15
+            data -= 2**15
+        if self.scale is not None:
+            data *= self.scale
+        if self.shift is not None:
+            data += self.shift
+
+        if ibatch == 0:
+            X[:, :self.nt] = X[:, self.nt : self.nt+1]
+            # Only relevant if there is a single batch that is shorter than NT.
+            X[:, self.nt+nsamp:] = 0
+        elif ibatch == self.n_batches-1:
+            X[:, nsamp:] = X[:, nsamp-1:nsamp]
+
+        return X
+
     def padded_batch_to_torch(self, ibatch, return_inds=False):
         """ read batches from file """
         if self.file is None:
             raise ValueError('Binary file has been closed, data not accessible.')
 
         bstart, bend = self.get_batch_edges(ibatch)
-        data = self.file[bstart : bend]
+        future = self._pending.pop(ibatch, None)
+        if self.reuse_buffers:
+            if future is not None:
+                staged = future.result()
+            else:
+                staged = self._load_batch(ibatch)
+            X = self._staged_batch_to_torch(ibatch, *staged)
+            if return_inds:
+                return X, self.get_padded_inds(ibatch)
+            else:
+                return X
+
+        if future is not None:
+            # Batch was already read in the background by `iter_batches`.
+            data = future.result()
+        else:
+            data = self.file[bstart : bend]
         data = data.T
 
         if self.dtype == 'uint16':
@@ -817,26 +1308,96 @@ class BinaryRWFile:
             if ibatch == 0:
                 X[:, self.nt : self.nt+nsamp] = torch.from_numpy(data).to(self.device).float()
                 X[:, :self.nt] = X[:, self.nt : self.nt+1]
-                bstart = self.imin - self.nt
             elif ibatch == self.n_batches-1:
                 X[:, :nsamp] = torch.from_numpy(data).to(self.device).float()
                 X[:, nsamp:] = X[:, nsamp-1:nsamp]
-                bend += self.nt
             else:
                 X[:] = torch.from_numpy(data).to(self.device).float()
 
-        inds = [bstart, bend]
+        inds = self.get_padded_inds(ibatch)
         if return_inds:
             return X, inds
         else:
             return X
-        
 
-def get_total_samples(filename, n_channels, dtype=np.int16):
-    """Count samples in binary file given dtype and number of channels."""
+    def iter_batches(self, batch_indices=None, prefetch=None, **kwargs):
+        """Iterate over padded batches, reading upcoming batches in the background.
+
+        While one batch is being processed by the caller, the raw data for the
+        next `prefetch` batches is read from disk by a pool of threads, so that
+        computation and file i/o overlap.
+
+        Parameters
+        ----------
+        batch_indices : iterable of int; optional.
+            Indices of batches to load, in the order they should be returned.
+            By default, all batches are loaded.
+        prefetch : int; optional.
+            Number of batches to read ahead. Defaults to `self.prefetch`.
+            If 0, batches are read synchronously.
+        **kwargs
+            Additional keyword arguments for `padded_batch_to_torch`,
+            like `ops`, `return_inds` or `out_dtype`.
+
+        Yields
+        ------
+        X : torch.Tensor
+            Same output as `padded_batch_to_torch` for each batch.
+
+        Examples
+        --------
+        >>> for ibatch, X in zip(range(bfile.n_batches), bfile.iter_batches()):
+        ...     process(X)
+
+        """
+        if batch_indices is None:
+            batch_indices = range(self.n_batches)
+        if prefetch is None:
+            prefetch = self.prefetch
+
+        if prefetch < 1:
+            for ibatch in batch_indices:
+                yield self.padded_batch_to_torch(ibatch, **kwargs)
+            return
+
+        batch_indices = list(batch_indices)
+        load_kwargs = {'ops': kwargs['ops']} if 'ops' in kwargs else {}
+        with ThreadPoolExecutor(max_workers=prefetch) as exe:
+            try:
+                for i, ibatch in enumerate(batch_indices):
+                    # Queue reads for this batch and the next `prefetch` batches,
+                    # unless they were already queued on a previous iteration.
+                    for j in batch_indices[i : i+prefetch+1]:
+                        if j not in self._pending:
+                            # Run in a copy of the caller's context, so that
+                            # log records are attributed to the same run.
+                            self._pending[j] = exe.submit(
+                                contextvars.copy_context().run,
+                                self._load_batch, j, **load_kwargs
+                                )
+                    yield self.padded_batch_to_torch(ibatch, **kwargs)
+            finally:
+                # Discard reads that won't be used, like when the caller exits
+                # the loop early.
+                for future in self._pending.values():
+                    future.cancel()
+                self._pending.clear()
+
+
+
+def get_total_samples(filename, n_channels, dtype=np.int16, offset=0):
+    """Count samples in binary file given dtype and number of channels.
+
+    The first `offset` bytes of the file (e.g. a header) are not counted.
+
+    """
     bytes_per_value = np.dtype(dtype).itemsize
     bytes_per_sample = np.int64(bytes_per_value * n_channels)
-    total_bytes = os.path.getsize(filename)
+    total_bytes = os.path.getsize(filename) - offset
+    if total_bytes < 0:
+        raise ValueError(
+            f'byte_offset {offset} is larger than the size of {filename}.'
+            )
     samples = np.float64(total_bytes / bytes_per_sample)
 
     if samples%1 != 0:
@@ -864,53 +1425,109 @@ class BinaryFileGroup:
         # is the starting index of the subsequent file.
         i = 0
         self.split_indices = []
+        self.start_indices = []
         for f in file_objects:
+            self.start_indices.append(i)
             i += f.shape[0]
             self.split_indices.append(i)
 
+    def _file_index(self, i):
+        """Index of file containing sample `i`."""
+        return bisect.bisect_right(self.split_indices, i)
+
+    def _iter_pieces(self, start, stop):
+        """Yield (file index, start, stop) within each file for start:stop."""
+        k = self._file_index(start)
+        while start < stop and k < len(self.file_objects):
+            offset = self.start_indices[k]
+            end = min(stop, self.split_indices[k])
+            yield k, start - offset, end - offset
+            start = end
+            k += 1
+
+    def read_into(self, out, start, stop, channel_idx=slice(None)):
+        """Copy samples `start:stop` into preallocated array `out`.
+
+        Each file's portion of the data is written directly into `out`, so
+        that no intermediate arrays are needed for reads that span files.
+
+        Parameters
+        ----------
+        out : np.ndarray
+            Array with at least `stop - start` rows, and the number of columns
+            selected by `channel_idx`.
+        start, stop : int
+            Range of sample indices to read, negative indices are not supported.
+        channel_idx : slice, int or array-like; default=slice(None).
+            Channels to read.
+
+        Returns
+        -------
+        n : int
+            Number of samples written to `out`, which may be less than
+            `stop - start` at the end of the data.
+
+        """
+        stop = min(stop, self.shape[0])
+        n = 0
+        for k, a, b in self._iter_pieces(start, stop):
+            out[n : n+b-a] = self.file_objects[k][a:b, channel_idx]
+            n += b - a
+        return n
+
     def __getitem__(self, *items):
         # Index into appropriate individual object based on index.
-        # For indices that span multiple files, index all then concatenate result.
+        # For indices that span multiple files, each piece is copied directly
+        # into a single output array.
         idx, *crop = items
         if not isinstance(idx, tuple): idx = tuple([idx])
         channel_idx = idx[1] if len(idx) > 1 else slice(None)
         time_idx = idx[0]
+        n_samples = self.shape[0]
 
-        # To simplify for loop logic, convert integer index to slice and
-        # convert NoneTypes to boundaries of data, and convert negative
-        # indices to positive indices.
-        if not isinstance(time_idx, slice):
-            time_idx = slice(time_idx, time_idx+1)
-        i = time_idx.start
-        j = time_idx.stop
-
-        if i is None: i = 0
-        if i < 0: i = self.shape[0] + i
-        if j is None: j = self.shape[0]
-        if j < 0: j = self.shape[0] + j
-        time_idx = slice(i, j)
-
-        data = []
-        shift = 0
-        for k,f in zip(self.split_indices, self.file_objects):
-            n_samples = f.shape[0]
-            if time_idx.start < k:
-                # At least part of the data is in this file
-                t = slice(int(time_idx.start - shift), int(time_idx.stop - shift))
-                data.append(f[t, channel_idx])
-                if time_idx.stop <= k:
-                    # This is the end of the data to be retrieved
-                    break
-            shift += n_samples
-
-        if len(data) == 0:
-            d = None
-        elif len(data) == 1:
-            d = data[0]
-        else:
-            d = np.concatenate(data, axis=0)
-    
-        return d
+        if isinstance(time_idx, (int, np.integer)):
+            i = time_idx + n_samples if time_idx < 0 else time_idx
+            if i < 0 or i >= n_samples:
+                raise IndexError(
+                    f'index {time_idx} is out of bounds for {n_samples} samples'
+                    )
+            k = self._file_index(i)
+            return self.file_objects[k][i - self.start_indices[k], channel_idx]
+
+        if isinstance(time_idx, slice):
+            i, j, step = time_idx.indices(n_samples)
+            j = max(i, j) if step > 0 else j
+            if step == 1:
+                pieces = list(self._iter_pieces(i, j))
+                if len(pieces) == 1:
+                    # No copy needed for data within a single file.
+                    k, a, b = pieces[0]
+                    return self.file_objects[k][a:b, channel_idx]
+                out = self._empty(j - i, channel_idx)
+                self.read_into(out, i, j, channel_idx)
+                return out
+            time_idx = np.arange(i, j, step)
+
+        # Array of sample indices (or boolean mask)
+        time_idx = np.asarray(time_idx)
+        if time_idx.dtype == bool:
+            time_idx = np.nonzero(time_idx)[0]
+        time_idx = np.where(time_idx < 0, time_idx + n_samples, time_idx)
+        out = self._empty(time_idx.size, channel_idx)
+        file_ids = np.searchsorted(self.split_indices, time_idx, side='right')
+        for k in np.unique(file_ids):
+            if k >= len(self.file_objects):
+                raise IndexError('Sample index is out of bounds.')
+            mask = file_ids == k
+            rows = time_idx[mask] - self.start_indices[k]
+            out[mask] = self.file_objects[k][rows][:, channel_idx]
+
+        return out
+
+    def _empty(self, n, channel_idx):
+        # Index an empty slice to get the shape of the channel dimension.
+        chan_shape = self.file_objects[0][:0, channel_idx].shape[1:]
+        return np.empty((n, *chan_shape), dtype=self.dtype)
 
     @property
     def shape(self):
@@ -928,6 +1545,247 @@ class BinaryFileGroup:
         return BinaryFileGroup(files)
 
 
+class CompressedBinary:
+    """Array-like, read-only access to a chunk-compressed binary file.
+
+    Files are created with `compress_binary`. Data is split into chunks of
+    a fixed number of samples, each compressed independently (delta coding
+    over time for integer data, byte shuffling and zlib) so that only the
+    chunks overlapping a requested range of samples need to be decoded.
+    Chunks are decoded in parallel threads, and the most recently decoded
+    chunks are kept in memory since consecutive batches overlap.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Path to compressed file, typically with a `.ksc` extension.
+    n_threads : int; optional.
+        Number of threads used for decoding chunks. By default, uses the
+        number of available CPUs (up to 8).
+    max_cached_chunks : int; default=8.
+        Number of decoded chunks to keep in memory.
+
+    Attributes
+    ----------
+    shape
+    dtype
+
+    Examples
+    --------
+    >>> compress_binary('/data/recording.bin', n_chan_bin=385)
+    >>> data = CompressedBinary('/data/recording.ksc')
+    >>> data[1000:2000, :10].shape
+    (1000, 10)
+
+    """
+
+    magic = b'KSC1'
+    codecs = ('zlib',)
+
+    def __init__(self, filename, n_threads=None, max_cached_chunks=8):
+        self.filename = filename
+        self._bytes = np.memmap(filename, mode='r', dtype=np.uint8)
+        magic = bytes(self._bytes[:4])
+        if magic[:3] != self.magic[:3]:
+            raise ValueError(f'{filename} is not a compressed binary file.')
+        if magic != self.magic:
+            raise ValueError(
+                f'{filename} uses compressed format version '
+                f'{magic[3:].decode(errors="replace")}, only version '
+                f'{self.magic[3:].decode()} is supported.'
+                )
+        try:
+            n_header = int(self._bytes[4:12].view(np.uint64)[0])
+            header = json.loads(bytes(self._bytes[12 : 12+n_header]).decode())
+            codec = header.get('codec', None)
+            self.dtype = np.dtype(header['dtype'])
+            self.shape = (header['n_samples'], header['n_channels'])
+            self.chunk_samples = header['chunk_samples']
+            self.delta = header['delta']
+        except (KeyError, ValueError, TypeError) as e:
+            raise ValueError(f'{filename} has an invalid header: {e}') from e
+        if codec not in self.codecs:
+            raise ValueError(
+                f'{filename} uses unsupported codec {codec!r}, must be one of '
+                f'{self.codecs}.'
+                )
+        n_chunks = int(np.ceil(self.shape[0] / self.chunk_samples))
+        i = 12 + n_header
+        self.offsets = self._bytes[i : i + 8*(n_chunks+1)].view(np.int64)
+
+        if n_threads is None:
+            n_threads = min(os.cpu_count() or 1, 8)
+        self.n_threads = n_threads
+        self.max_cached_chunks = max_cached_chunks
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=n_threads)
+
+    @property
+    def n_chunks(self):
+        return self.offsets.size - 1
+
+    def _decode(self, ichunk):
+        a, b = self.offsets[ichunk], self.offsets[ichunk+1]
+        n = min(self.chunk_samples, self.shape[0] - ichunk*self.chunk_samples)
+        raw = np.frombuffer(zlib.decompress(self._bytes[a:b]), dtype=np.uint8)
+        # Undo byte shuffling
+        data = raw.reshape(self.dtype.itemsize, -1).T.copy().view(self.dtype)
+        data = data.reshape(n, self.shape[1])
+        if self.delta:
+            # Integer overflow wraps around, which reverses the same
+            # wrap-around from computing differences.
+            data = np.cumsum(data, axis=0, dtype=self.dtype)
+        return data
+
+    def _get_chunk(self, ichunk):
+        with self._lock:
+            if ichunk in self._chunks:
+                self._chunks.move_to_end(ichunk)
+                return self._chunks[ichunk]
+        data = self._decode(ichunk)
+        with self._lock:
+            self._chunks[ichunk] = data
+            while len(self._chunks) > self.max_cached_chunks:
+                self._chunks.popitem(last=False)
+        return data
+
+    def __getitem__(self, *items):
+        idx, *crop = items
+        if not isinstance(idx, tuple): idx = tuple([idx])
+        channel_idx = idx[1] if len(idx) > 1 else slice(None)
+        time_idx = idx[0]
+        if isinstance(time_idx, slice):
+            i, j, step = time_idx.indices(self.shape[0])
+            if step < 0:
+                # Read the same samples in increasing order, then reverse.
+                r = range(i, j, step)
+                if len(r) == 0:
+                    return self[0:0, channel_idx]
+                return self[r[-1]:r[0]+1, channel_idx][::-1][::-step]
+            squeeze = False
+        else:
+            i = time_idx + self.shape[0] if time_idx < 0 else time_idx
+            j, step = i+1, 1
+            squeeze = True
+        j = max(i, j)
+
+        first = i // self.chunk_samples
+        last = (j - 1) // self.chunk_samples
+        chunk_ids = list(range(first, last+1)) if j > i else []
+        if len(chunk_ids) > 1:
+            chunks = list(self._executor.map(self._get_chunk, chunk_ids))
+        else:
+            chunks = [self._get_chunk(c) for c in chunk_ids]
+
+        if len(chunks) == 0:
+            data = np.zeros((0, self.shape[1]), dtype=self.dtype)
+        else:
+            data = np.concatenate(chunks, axis=0) if len(chunks) > 1 else chunks[0]
+            k = i - first*self.chunk_samples
+            data = data[k : k + (j-i) : step]
+        data = data[:, channel_idx]
+        if squeeze:
+            data = data[0]
+
+        return data
+
+    def __len__(self):
+        return self.shape[0]
+
+
+def compress_binary(filename, n_chan_bin, dtype='int16', output=None,
+                    chunk_samples=30000, level=1, n_threads=None):
+    """Save a chunk-compressed copy of a binary file for use with Kilosort4.
+
+    Compression is lossless. For int16 electrophysiology data, the compressed
+    file is typically 2-3x smaller than the original.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Path to raw binary file.
+    n_chan_bin : int
+        Total number of channels in the binary file.
+    dtype : str or type; default='int16'.
+        dtype of data in the binary file.
+    output : str or Path; optional.
+        Path where compressed file will be saved. By default, uses the same
+        path as `filename` with the extension changed to `.ksc`.
+    chunk_samples : int; default=30000.
+        Number of samples per compressed chunk. Smaller chunks allow faster
+        random access, at the cost of a slightly worse compression ratio.
+    level : int; default=1.
+        zlib compression level, from 1 (fastest) to 9 (smallest file).
+    n_threads : int; optional.
+        Number of threads used to compress chunks. By default, uses the number
+        of available CPUs (up to 8).
+
+    Returns
+    -------
+    output : Path
+        Path to the compressed file.
+
+    See also
+    --------
+    CompressedBinary
+
+    """
+
+    filename = Path(filename)
+    output = filename.with_suffix('.ksc') if output is None else Path(output)
+    dtype = np.dtype(dtype)
+    n_samples = get_total_samples(filename, n_chan_bin, dtype)
+    data = np.memmap(filename, mode='r', dtype=dtype,
+                     shape=(n_samples, n_chan_bin))
+    delta = np.issubdtype(dtype, np.integer)
+    if n_threads is None:
+        n_threads = min(os.cpu_count() or 1, 8)
+
+    def encode(ichunk):
+        chunk = np.array(data[ichunk*chunk_samples : (ichunk+1)*chunk_samples])
+        if delta:
+            # Store differences over time, which are mostly small values for
+            # continuous signals. Integer overflow wraps around, which is
+            # reversed when decoding.
+            chunk[1:] = np.diff(chunk, axis=0)
+        # Shuffle bytes so that the (mostly constant) high bytes of each
+        # value are stored together.
+        shuffled = chunk.view(np.uint8).reshape(-1, dtype.itemsize).T
+        return zlib.compress(np.ascontiguousarray(shuffled).tobytes(), level)
+
+    header = json.dumps({
+        'n_samples': int(n_samples), 'n_channels': int(n_chan_bin),
+        'dtype': dtype.name, 'chunk_samples': int(chunk_samples),
+        'delta': bool(delta), 'codec': 'zlib', 'source': filename.name
+        }).encode()
+    n_chunks = int(np.ceil(n_samples / chunk_samples))
+    offsets = np.zeros(n_chunks+1, dtype=np.int64)
+    offsets[0] = 12 + len(header) + offsets.nbytes
+
+    logger.info(f'Compressing {filename} to {output}...')
+    tic = time.time()
+    with open(output, 'wb') as f, ThreadPoolExecutor(n_threads) as exe:
+        f.write(CompressedBinary.magic)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        # Placeholder for chunk offsets, filled in after compressing.
+        f.write(offsets.tobytes())
+        # Compress a limited number of chunks at a time to bound memory usage.
+        for start in range(0, n_chunks, 4*n_threads):
+            stop = min(start + 4*n_threads, n_chunks)
+            for i, b in zip(range(start, stop), exe.map(encode, range(start, stop))):
+                f.write(b)
+                offsets[i+1] = offsets[i] + len(b)
+        f.seek(12 + len(header))
+        f.write(offsets.tobytes())
+
+    ratio = os.path.getsize(filename) / os.path.getsize(output)
+    logger.info(f'Compressed by {ratio:.2f}x in {time.time()-tic:.2f}s.')
+
+    return output
+
+
 class BinaryFiltered(BinaryRWFile):
     def __init__(self, filename: str, n_chan_bin: int, fs: int = 30000, 
                  NT: int = 60000, nt: int = 61, nt0min: int = 20,
@@ -936,20 +1794,234 @@ class BinaryFiltered(BinaryRWFile):
                  device: torch.device = None, do_CAR: bool = True,
                  artifact_threshold: float = np.inf, invert_sign: bool = False,
                  dtype=None, tmin: float = 0.0, tmax: float = np.inf,
-                 shift=None, scale=None, file_object=None):
-
+                 shift=None, scale=None, file_object=None, prefetch: int = 0,
+                 cache=None, reuse_buffers=True, offset: int = 0,
+                 use_rfft: bool = True, drift_resolution: float = 0.1,
+                 drift_cache_gb: float = 1.0, car_method: str = 'median',
+                 car_groups: np.ndarray = None, fused: bool = False):
+        # NOTE: `reuse_buffers` is safe to enable by default here since
+        #       `filter` always returns a new tensor.
         super().__init__(filename, n_chan_bin, fs, NT, nt, nt0min, device,
                          dtype=dtype, tmin=tmin, tmax=tmax, shift=shift,
-                         scale=scale, file_object=file_object) 
+                         scale=scale, file_object=file_object,
+                         prefetch=prefetch, reuse_buffers=reuse_buffers,
+                         offset=offset)
         self.chan_map = chan_map
         self.whiten_mat = whiten_mat
         self.hp_filter = hp_filter
         self.dshift = dshift
         self.do_CAR = do_CAR
+        if car_method not in CAR_METHODS:
+            raise ValueError(
+                f'Unrecognized car_method: {car_method}, must be one of '
+                f'{CAR_METHODS}.'
+                )
+        if car_method == 'shank' and car_groups is None:
+            raise ValueError("car_groups must be specified for car_method='shank'.")
+        self.car_method = car_method
+        # Group label (e.g. shank index) for each channel in chan_map.
+        self.car_groups = car_groups
+        self._car_group_idx = None
+        if car_groups is not None:
+            groups = np.asarray(car_groups)
+            self._car_group_idx = [
+                torch.from_numpy(np.flatnonzero(groups == g)).to(self.device)
+                for g in np.unique(groups)
+                ]
         self.invert_sign=invert_sign
         self.artifact_threshold = artifact_threshold
+        # Optional FilteredBatchCache, so that filtered batches only need to
+        # be computed once when there are multiple passes over the data.
+        self.cache = cache
+        self._cache_keys = {}
+        # Data are real-valued, so the high-pass filter can be applied with
+        # rfft/irfft for about half the work of the complex transforms.
+        self.use_rfft = use_rfft
+        # Fourier-domain filter for each batch length, since all batches
+        # except possibly the last one have the same length.
+        self._fwav_cache = {}
+        # Use `_filter_fused`, which applies the same preprocessing steps
+        # with fewer intermediate copies of the batch.
+        self.fused = fused
+        # Drift correction and whitening are combined into one operator per
+        # unique row of `dshift`, rounded to a multiple of `drift_resolution`
+        # microns. All operators are precomputed once, and kept on `device`
+        # up to `drift_cache_gb`. Any that don't fit are kept in CPU memory
+        # and copied to `device` when needed.
+        self.drift_resolution = drift_resolution
+        self.drift_cache_gb = drift_cache_gb
+        self._drift_ops = None
+        self._drift_lock = threading.Lock()
+
+    def close(self) -> None:
+        if self.cache is not None:
+            # Make sure batches queued for writing actually end up on disk.
+            self.cache.flush()
+        super().close()
+
+    def _uses_drift(self, ops):
+        return self.dshift is not None and ops is not None
+
+    def _get_cache_key(self, ops=None):
+        # Drift correction is only applied when `ops` is provided, so the
+        # same file can have two different sets of filtered batches.
+        use_drift = self._uses_drift(ops)
+        if use_drift not in self._cache_keys:
+            state = [
+                self.filename, self.n_chan_bin, self.dtype, self.NT, self.nt,
+                self.imin, self.imax, self.shift, self.scale, self.offset,
+                self.chan_map,
+                self.hp_filter, self.whiten_mat, self.do_CAR, self.invert_sign,
+                self.artifact_threshold, self.use_rfft
+                ]
+            if self.do_CAR and self.car_method != 'median':
+                # Only added if changed, so that existing cache keys are kept.
+                state.extend([self.car_method, self.car_groups])
+            if self.fused:
+                state.append('fused')
+            if self.filename is not None and Path(self.filename).is_file():
+                # Invalidate cache if the data file is modified.
+                stat = os.stat(self.filename)
+                state.extend([stat.st_size, stat.st_mtime_ns])
+            if use_drift:
+                state.extend([
+                    self.dshift, ops['yblk'], ops['iKxx'], ops['nblocks'],
+                    ops['probe']['xc'], ops['probe']['yc'],
+                    ops['settings']['sig_interp'], self.drift_resolution
+                    ])
+            self._cache_keys[use_drift] = self.cache.make_key(state)
+        return self._cache_keys[use_drift]
+
+    def _load_batch(self, ibatch, ops=None):
+        if self.cache is not None:
+            X = self.cache.get(self._get_cache_key(ops), ibatch)
+            if X is not None:
+                # Already filtered, returned as a tensor to distinguish from
+                # raw data.
+                return X
+        return super()._load_batch(ibatch)
+
+    def get_fft_highpass(self, NT, device=None, real=None, shifted=False):
+        """Conjugate of the Fourier-domain high-pass filter for length `NT`.
+
+        Cached per length, device and transform type, and recomputed if
+        `hp_filter` is replaced. If `shifted` is True, the filter also
+        applies `fftshift` to the filtered data, as a phase ramp.
+
+        """
+        if device is None:
+            device = self.hp_filter.device
+        if real is None:
+            real = self.use_rfft
+        key = (NT, str(device), real, shifted)
+        cached = self._fwav_cache.get(key, None)
+        if cached is not None and cached[0] is self.hp_filter:
+            return cached[1]
+
+        fwav = fft_highpass(self.hp_filter.to(device), NT=NT, real=real)
+        fwav = torch.conj(fwav)
+        if shifted:
+            # circular shift by NT//2 samples in time
+            k = torch.arange(fwav.shape[0], device=device, dtype=torch.float64)
+            phase = torch.exp(-2j * np.pi * k * (NT//2) / NT)
+            fwav = (fwav.to(torch.complex128) * phase).to(fwav.dtype)
+        self._fwav_cache[key] = (self.hp_filter, fwav)
+        return fwav
+
+    def _build_drift_operators(self, ops):
+        dshift = np.asarray(self.dshift)
+        if self.drift_resolution:
+            r = self.drift_resolution
+            dshift = np.round(dshift / r) * r
+        # `index` maps each batch to its row of unique shifts.
+        rows, index = np.unique(
+            dshift.reshape(dshift.shape[0], -1), axis=0, return_inverse=True
+            )
+        index = index.reshape(-1)
+        n_chan = self.whiten_mat.shape[0]
+        op_bytes = n_chan * self.whiten_mat.shape[1] * 4
+        capacity = int(self.drift_cache_gb * 1024**3 // op_bytes)
+
+        # Compute in chunks to limit memory used by the kernel matrices.
+        W, overflow = [], []
+        for i in range(0, rows.shape[0], 64):
+            M = get_drift_matrices(ops, rows[i:i+64], device=self.device)
+            Wi = M.float() @ self.whiten_mat
+            n_device = min(max(capacity - i, 0), Wi.shape[0])
+            W.append(Wi[:n_device])
+            overflow.append(Wi[n_device:].cpu())
+        operators = torch.cat(W)
+        overflow = torch.cat(overflow)
+
+        gb = operators.shape[0] * op_bytes / 1024**3
+        logger.info(f'Precomputed {rows.shape[0]} drift operators for '
+                    f'{dshift.shape[0]} batches, using {gb:.2f} GB on {self.device}.')
+        if overflow.shape[0] > 0:
+            gb = overflow.shape[0] * op_bytes / 1024**3
+            logger.info(f'{overflow.shape[0]} drift operators exceed '
+                        f'drift_cache_gb, using {gb:.2f} GB of CPU memory.')
+
+        return {'ops': ops, 'iKxx': ops['iKxx'], 'dshift': self.dshift,
+                'whiten_mat': self.whiten_mat, 'rows': rows, 'index': index,
+                'operators': operators, 'overflow': overflow}
+
+    def get_drift_operator(self, ops, ibatch):
+        """Combined drift correction and whitening matrix for `ibatch`."""
+        with self._drift_lock:
+            d = self._drift_ops
+            if (d is None or d['ops'] is not ops or d['iKxx'] is not ops['iKxx']
+                    or d['dshift'] is not self.dshift
+                    or d['whiten_mat'] is not self.whiten_mat):
+                d = self._build_drift_operators(ops)
+                self._drift_ops = d
+
+        i = d['index'][ibatch]
+        n_device = d['operators'].shape[0]
+        if i < n_device:
+            return d['operators'][i]
+        return d['overflow'][i - n_device].to(self.device)
+
+    def _filter_fused(self, X, ops=None, ibatch=None):
+        # Same steps as `filter`, but with as few full-size intermediate
+        # tensors as possible. After the first step, which creates a new
+        # tensor, the remaining elementwise steps are done in place.
+        if self.chan_map is not None:
+            X = X[self.chan_map]
+        X = X - X.mean(1, keepdim=True)
+        if self.invert_sign:
+            # negation is exact, so it can be done after subtracting the mean
+            X.neg_()
+        if self.do_CAR:
+            X.sub_(common_reference(X, self.car_method, self._car_group_idx))
+
+        # high-pass filter and fftshift combined into one complex multiply
+        if self.hp_filter is not None:
+            NT = X.shape[1]
+            fwav = self.get_fft_highpass(NT, device=X.device, real=True,
+                                         shifted=True)
+            Xf = rfft(X)
+            del X
+            Xf.mul_(fwav)
+            X = irfft(Xf, n=NT)
+            del Xf
+
+        if self.artifact_threshold < np.inf:
+            # single pass over the data, instead of abs then compare
+            xmin, xmax = torch.aminmax(X)
+            if max(-xmin.item(), xmax.item()) >= self.artifact_threshold:
+                return torch.zeros_like(X)
+
+        if self.whiten_mat is not None:
+            if self.dshift is not None and ops is not None and ibatch is not None:
+                X = self.get_drift_operator(ops, ibatch) @ X
+            else:
+                X = self.whiten_mat @ X
+        return X
 
     def filter(self, X, ops=None, ibatch=None):
+        if self.fused:
+            return self._filter_fused(X, ops, ibatch)
+
         # pick only the channels specified in the chanMap
         if self.chan_map is not None:
             X = X[self.chan_map]
@@ -960,12 +2032,16 @@ class BinaryFiltered(BinaryRWFile):
         X = X - X.mean(1).unsqueeze(1)
         if self.do_CAR:
             # remove the mean of each channel, and the median across channels
-            X = X - torch.median(X, 0)[0]
+            X = X - common_reference(X, self.car_method, self._car_group_idx)
     
         # high-pass filtering in the Fourier domain (much faster than filtfilt etc)
         if self.hp_filter is not None:
-            fwav = fft_highpass(self.hp_filter, NT=X.shape[1])
-            X = torch.real(ifft(fft(X) * torch.conj(fwav)))
+            NT = X.shape[1]
+            fwav = self.get_fft_highpass(NT, device=X.device)
+            if self.use_rfft:
+                X = irfft(rfft(X) * fwav, n=NT)
+            else:
+                X = torch.real(ifft(fft(X) * fwav))
             X = fftshift(X, dim = -1)
 
         if self.artifact_threshold < np.inf:
@@ -977,9 +2053,7 @@ class BinaryFiltered(BinaryRWFile):
         # whitening, with optional drift correction
         if self.whiten_mat is not None:
             if self.dshift is not None and ops is not None and ibatch is not None:
-                M = get_drift_matrix(ops, self.dshift[ibatch], device=self.device)
-                #logger.info(M.dtype, X.dtype, self.whiten_mat.dtype)
-                X = (M @ self.whiten_mat) @ X
+                X = self.get_drift_operator(ops, ibatch) @ X
             else:
                 X = self.whiten_mat @ X
         return X
@@ -993,18 +2067,230 @@ class BinaryFiltered(BinaryRWFile):
             X = torch.from_numpy(samples.T).to(self.device).float()
         return self.filter(X)
         
-    def padded_batch_to_torch(self, ibatch, ops=None, return_inds=False):
+    def padded_batch_to_torch(self, ibatch, ops=None, return_inds=False,
+                              out_dtype=None):
+        """Load and filter a padded batch.
+
+        If `out_dtype` is specified, like a reduced-precision format from the
+        `precision` setting, the filtered batch is converted to it once here,
+        so that later steps don't need their own copies.
+
+        """
+        if self.cache is None:
+            if return_inds:
+                X, inds = super().padded_batch_to_torch(ibatch, return_inds=return_inds)
+                X = self.filter(X, ops, ibatch)
+            else:
+                X = super().padded_batch_to_torch(ibatch)
+                X = self.filter(X, ops, ibatch)
+            if out_dtype is not None:
+                X = X.to(out_dtype)
+            if return_inds:
+                return X, inds
+            else:
+                return X
+
+        key = self._get_cache_key(ops)
+        future = self._pending.get(ibatch, None)
+        if future is not None:
+            # Batch was loaded in the background, either from cache or raw data.
+            X = future.result()
+        else:
+            X = self.cache.get(key, ibatch)
+
+        if isinstance(X, torch.Tensor):
+            self._pending.pop(ibatch, None)
+            X = X.to(self.device).to(out_dtype or torch.float32)
+            inds = self.get_padded_inds(ibatch)
+        else:
+            X, inds = super().padded_batch_to_torch(ibatch, return_inds=True)
+            X = self.filter(X, ops, ibatch)
+            self.cache.put(key, ibatch, X)
+            if out_dtype is not None:
+                X = X.to(out_dtype)
+
         if return_inds:
-            X, inds = super().padded_batch_to_torch(ibatch, return_inds=return_inds)
-            return self.filter(X, ops, ibatch), inds
+            return X, inds
         else:
-            X = super().padded_batch_to_torch(ibatch)
-            return self.filter(X, ops, ibatch)
+            return X
+
 
+def hash_state(state, prefix=''):
+    """Get a hex digest that identifies the values in list `state`.
 
-def save_preprocessing(filename, ops, bfile=None, bfile_path=None):
+    Arrays and tensors are hashed by dtype, shape and contents, and all other
+    values by their `repr`.
+
+    """
+    h = hashlib.sha1(prefix.encode())
+    for v in state:
+        if isinstance(v, torch.Tensor):
+            v = v.cpu().numpy()
+        if isinstance(v, np.ndarray):
+            h.update(str(v.dtype).encode() + str(v.shape).encode())
+            h.update(np.ascontiguousarray(v).tobytes())
+        else:
+            h.update(repr(v).encode())
+    return h.hexdigest()
+
+
+class FilteredBatchCache:
+    """On-disk cache of filtered batches, shared by passes over the same data.
+
+    Each distinct combination of data file and preprocessing variables
+    (see `BinaryFiltered._get_cache_key`) gets its own sub-directory in
+    `cache_dir`, with one `.npy` file per batch. When the total size of the
+    cache exceeds `max_gb`, the least recently used batches are deleted.
+
+    Parameters
+    ----------
+    cache_dir : str or Path
+        Directory where cached batches are stored. Will be created if it does
+        not exist. Batches cached by previous runs are re-used.
+    max_gb : float; default=50.
+        Maximum size of the cache on disk, in gigabytes.
+    dtype : str; default='float32'.
+        Data type used to store batches. 'float16' halves the size of the cache,
+        but is lossy: batches loaded from the cache are rounded to float16
+        while newly computed batches are not, so sorting results depend on
+        which batches were already cached.
+
+    """
+
+    def __init__(self, cache_dir, max_gb=50, dtype='float32'):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = np.int64(max_gb * 1024**3)
+        self.dtype = np.dtype(dtype)
+        self._lock = threading.Lock()
+        # Writes happen in the background so that they don't hold up sorting.
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._writes = []
+
+        # Track size of cached batches, ordered from least to most recently
+        # used. Start with batches left over from previous runs.
+        self._entries = OrderedDict()
+        existing = sorted(self.cache_dir.glob('*/*.npy'),
+                          key=lambda p: p.stat().st_mtime)
+        for path in existing:
+            self._entries[path] = path.stat().st_size
+        self.n_bytes = np.int64(sum(self._entries.values()))
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, state):
+        """Hash a list of variables that determine filtered batch values."""
+        return hash_state(state, prefix=str(self.dtype))
+
+    def _path(self, key, ibatch):
+        return self.cache_dir / key / f'{ibatch:07d}.npy'
+
+    def get(self, key, ibatch):
+        """Load a cached batch as a CPU tensor, or return None if missing."""
+        path = self._path(key, ibatch)
+        with self._lock:
+            if path not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(path)
+        try:
+            X = np.load(path)
+            # Update modification time so that recency is preserved for
+            # future runs.
+            os.utime(path)
+        except (OSError, ValueError):
+            # Evicted in the meantime or incomplete, treat as a miss.
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return torch.from_numpy(X)
+
+    def put(self, key, ibatch, X):
+        """Queue a filtered batch to be written to the cache."""
+        path = self._path(key, ibatch)
+        if path in self._entries:
+            return
+        X = X.cpu().numpy()
+        if self.dtype == np.float16:
+            # Avoid overflow to inf for large artifacts.
+            lim = np.finfo(np.float16).max
+            X = np.clip(X, -lim, lim)
+        X = X.astype(self.dtype)
+        self._writes = [w for w in self._writes if not w.done()]
+        self._writes.append(self._writer.submit(
+            contextvars.copy_context().run, self._write, path, X
+            ))
+
+    def _write(self, path, X):
+        path.parent.mkdir(exist_ok=True)
+        # Write to a temporary file first so that readers never see
+        # partially written batches.
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, X)
+        os.replace(tmp, path)
+        with self._lock:
+            self.n_bytes -= self._entries.pop(path, 0)
+            self._entries[path] = path.stat().st_size
+            self.n_bytes += self._entries[path]
+            self._evict()
+
+    def _evict(self):
+        while self.n_bytes > self.max_bytes and len(self._entries) > 0:
+            path, size = self._entries.popitem(last=False)
+            self.n_bytes -= size
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def flush(self):
+        """Wait for queued batches to finish writing."""
+        for w in self._writes:
+            w.result()
+        self._writes = []
+
+    def close(self):
+        """Finish writing queued batches and stop the writer thread."""
+        self.flush()
+        self._writer.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def clear(self):
+        """Delete all cached batches."""
+        self.flush()
+        with self._lock:
+            for key_dir in self.cache_dir.iterdir():
+                if key_dir.is_dir():
+                    shutil.rmtree(key_dir)
+            self._entries.clear()
+            self.n_bytes = np.int64(0)
+
+
+def batch_cache_from_ops(ops):
+    """Get FilteredBatchCache specified by `ops`, or None if not enabled."""
+    max_gb = ops['settings'].get('batch_cache_gb', 0)
+    cache_dir = ops['settings'].get('batch_cache_dir', None)
+    if not max_gb or cache_dir is None:
+        return None
+    return FilteredBatchCache(cache_dir, max_gb=max_gb)
+
+
+def save_preprocessing(filename, ops, bfile=None, bfile_path=None, dtype=None,
+                       flush_every=50, queue_size=4):
     """Save a preprocessed copy of data, including drift correction.
 
+    Preprocessing on the GPU, blending of overlapping batch edges and writing
+    to disk happen in separate threads connected by bounded queues, so that
+    all three overlap while using a limited amount of memory.
+
     Parameters
     ----------
     filename : str or Path-like.
@@ -1020,6 +2306,15 @@ def save_preprocessing(filename, ops, bfile=None, bfile_path=None):
         Path where raw binary data should be loaded from. If `bfile` is given,
         this parameter will not be used.
         One of `bfile` or `bfile_path` must be provided.
+    dtype : str; optional.
+        Data type of the new file, either 'int16' or 'float16'. By default,
+        uses `ops['preprocessed_dtype']` if present, otherwise 'int16'.
+        In both cases, values are scaled by 200 before saving, but float16 data
+        is not rounded to integers and does not overflow for large values.
+    flush_every : int; default=50.
+        Number of batches to write before flushing data to disk.
+    queue_size : int; default=4.
+        Maximum number of batches waiting in each queue between stages.
 
     """
 
@@ -1030,8 +2325,15 @@ def save_preprocessing(filename, ops, bfile=None, bfile_path=None):
     hp_filter = ops['preprocessing']['hp_filter']
     dshift = ops['dshift']
     chan_map = ops['chanMap']
-    dtype = ops['data_dtype']
+    data_dtype = ops['data_dtype']
     n_chans = ops['n_chan_bin']
+    if dtype is None:
+        dtype = ops.get('preprocessed_dtype', 'int16')
+    if str(dtype) not in ['int16', 'float16']:
+        raise ValueError(
+            f"Preprocessed data must be saved as 'int16' or 'float16', not {dtype}."
+            )
+    ops['preprocessed_dtype'] = str(dtype)
 
     if bfile is None:
         if bfile_path is None:
@@ -1039,7 +2341,11 @@ def save_preprocessing(filename, ops, bfile=None, bfile_path=None):
         bfile = BinaryFiltered(
             filename=bfile_path, n_chan_bin=n_chans, chan_map=chan_map, nt=nt,
             NT=NT, hp_filter=hp_filter, whiten_mat=whiten_mat, dshift=dshift,
-            dtype=dtype
+            dtype=data_dtype, prefetch=ops['settings']['prefetch_batches'],
+            offset=ops['settings'].get('byte_offset', 0),
+            car_method=ops['settings'].get('car_method', 'median'),
+            car_groups=ops['probe']['kcoords'],
+            fused=ops['settings'].get('fused_preprocessing', False)
             )
 
     # Need weights to linearly smooth the overlapping portions of batches
@@ -1051,61 +2357,134 @@ def save_preprocessing(filename, ops, bfile=None, bfile_path=None):
     W = np.vstack([weights, np.flip(weights)])
     W = np.tile(W, n_chans_used).reshape(2, n_chans_used, 2*nt)
 
-    # NOTE: dtype for new file is always int16, float32 data returned by preproc
-    #       steps is scaled by 200 and then converted.
-    z = np.memmap(filename, dtype='int16', mode='w+', shape=(NT*n_batches, n_chans))
+    # NOTE: float32 data returned by preproc steps is scaled by 200 and then
+    #       converted to `dtype`.
+    z = np.memmap(filename, dtype=dtype, mode='w+', shape=(NT*n_batches, n_chans))
+
+    def convert(y):
+        return (y*200).astype(dtype)
+
+    def blend(batches, writes):
+        # Combine overlapping edges of consecutive batches, queue blocks of
+        # samples to be written as (start, stop, data).
+        batch1 = _get_from_queue(batches)
+        for i in range(n_batches):
+            if i == n_batches-1:
+                # Skip first 2*nt of real data, it was added in previous iter.
+                # Nothing to interpolate on last batch.
+                y = batch1[:, 2*nt:-nt].T
+                _put_to_queue(writes, ((i*NT)+nt, z.shape[0], convert(y)), [writer])
+            else:
+                batch2 = _get_from_queue(batches)
+
+                # Get interpolated values to replace inter-batch padding, there
+                # are 2*nt samples overlapping at the batch edges.
+                x1 = batch1[:, (NT-1) + 1:]
+                x2 = batch2[:, :2*nt]
+                X = np.vstack([x1[np.newaxis,...], x2[np.newaxis,...]])
+                y2 = (X*W).sum(axis=0).T
+
+                if i == 0:
+                    # Also need to write first nt values of first batch
+                    y0 = batch1[:, nt:2*nt].T
+                    _put_to_queue(writes, (0, nt, convert(y0)), [writer])
+                # Write raw data, leaving out padding and first nt values
+                y1 = batch1[:, nt*2:-nt].T
+                _put_to_queue(writes, ((i*NT)+nt, (i+1)*NT, convert(y1)), [writer])
+                # Write interpolated data afterward, to replace the last nt
+                # values of first batch and first nt values of the next batch.
+                _put_to_queue(
+                    writes, (((i+1)*NT)-nt, ((i+1)*NT)+nt, convert(y2)), [writer]
+                    )
+                batch1 = batch2
+        _put_to_queue(writes, None, [writer])
+
+    def write(writes):
+        last_flush = 0
+        while (item := _get_from_queue(writes)) is not None:
+            start, stop, y = item
+            z[start:stop, chan_map] = y
+            if stop - last_flush >= flush_every*NT:
+                z.flush()
+                last_flush = stop
+        z.flush()
 
     logger.info(' ')
     logger.info('='*40)
     logger.info(f'Saving drift-corrected copy of data to: {filename}...')
-    for i in range(n_batches):
-        if i % 100 == 0:
-            logger.info(f'Writing batch {i}/{n_batches}...')
+    tic = time.time()
+    batches = queue.Queue(maxsize=queue_size)
+    writes = queue.Queue(maxsize=3*queue_size)
+    with ThreadPoolExecutor(max_workers=2) as exe:
+        # Workers run in copies of this context, so that their log records
+        # are attributed to the same run.
+        writer = exe.submit(contextvars.copy_context().run, write, writes)
+        blender = exe.submit(
+            contextvars.copy_context().run, blend, batches, writes
+            )
+        try:
+            for i, X in enumerate(bfile.iter_batches(ops=ops)):
+                if i % 100 == 0:
+                    logger.info(f'Writing batch {i}/{n_batches}...')
+                _put_to_queue(batches, X.cpu().numpy(), [blender, writer])
+            blender.result()
+            writer.result()
+        except BaseException:
+            # Unblock worker threads so the executor can shut down.
+            for q in [batches, writes]:
+                _stop_queue(q)
+            raise
+
+    logger.info(f'Copying finished in {time.time()-tic:.2f}s.')
+    logger.info('='*40)
+    logger.info(' ')
 
-        if i == 0:
-            # Initialize with first batch
-            batch1 = bfile.padded_batch_to_torch(i, ops=ops)
-        else:
-            # Re-use batch2 from previous iteration
-            batch1 = batch2
-
-        if i == n_batches-1:
-            # Skip first 2*nt of real data, it was added in previous iter.
-            # Nothing to interpolate on last batch.
-            y = batch1[:, 2*nt:-nt].cpu().numpy().T
-            z[(i*NT)+nt:, chan_map] = (y*200).astype('int16')
-        else:
-            batch2 = bfile.padded_batch_to_torch(i+1, ops=ops)
-
-            # Get interpolated values to replace inter-batch padding, there are
-            # 2*nt samples overlapping at the batch edges.
-            x1 = batch1[:, (NT-1) + 1:].cpu().numpy()
-            x2 = batch2[:, :2*nt].cpu().numpy()
-            X = np.vstack([x1[np.newaxis,...], x2[np.newaxis,...]])
-            y2 = (X*W).sum(axis=0).T
-            
-            # Write raw data, leaving out padding and first nt values
-            y1 = batch1[:, nt*2:-nt].cpu().numpy().T
-            z[(i*NT)+(nt) : ((i+1)*NT), chan_map] = (y1*200).astype('int16')
-            if i == 0:
-                # Also need to write first nt values of first batch
-                y0 = batch1[:, nt:2*nt].cpu().numpy().T
-                z[:nt, chan_map] = (y0*200).astype('int16')
-
-            # Write interpolated data afterward, to replace the last nt values of
-            # first batch and first nt values of the next batch in loop.
-            z[((i+1)*NT)-nt : ((i+1)*NT)+nt, chan_map] = (y2*200).astype('int16')
 
-        z.flush()
+class _StopPipeline(Exception):
+    pass
+
+# Sentinel used to stop threads in `save_preprocessing` after an error.
+_STOP = object()
+
+
+def _get_from_queue(q):
+    item = q.get()
+    if item is _STOP:
+        raise _StopPipeline()
+    return item
 
-    logger.info('='*40)
-    logger.info('Copying finished.')
-    logger.info(' ')
+
+def _put_to_queue(q, item, workers):
+    """Put `item` into bounded queue `q`, raising errors from `workers`."""
+    while True:
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            for w in workers:
+                if w.done():
+                    # Raises any exception from the worker thread.
+                    w.result()
+                    raise RuntimeError('Pipeline stage exited unexpectedly.')
+
+
+def _stop_queue(q):
+    """Put stop sentinel into `q`, discarding queued items to make room."""
+    while True:
+        try:
+            q.put_nowait(_STOP)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
 
 
 def spikeinterface_to_binary(recording, filepath, data_name='data.bin',
                              dtype=np.int16, chunksize=300000, export_probe=True,
-                             probe_name='probe.prb', max_workers=None):
+                             probe_name='probe.prb', max_workers=None,
+                             max_in_flight=None, resume=True, flush_every=16):
     """Save data from a SpikeInterface RecordingExtractor to a binary file.
 
     This function is provided to assist with converting data from other file
@@ -1138,6 +2517,17 @@ def spikeinterface_to_binary(recording, filepath, data_name='data.bin',
         Maximum number of threads used to execute file i/o.
         Default: min(32, (os.process_cpu_count() or 1) + 4)
         (https://github.com/python/cpython/blob/main/Lib/concurrent/futures/thread.py)
+    max_in_flight : int; optional.
+        Maximum number of chunks that are submitted to threads at once, which
+        bounds memory use to roughly `max_in_flight` chunks.
+        Default: 2 * max_workers.
+    resume : bool; default=True.
+        If True and a progress file from an interrupted conversion to the
+        same binary file exists, copying starts from the last chunk that was
+        saved instead of from the beginning.
+    flush_every : int; default=16.
+        Number of completed chunks between flushing the binary file to disk
+        and updating the progress file.
         
     Notes
     -----
@@ -1146,6 +2536,11 @@ def spikeinterface_to_binary(recording, filepath, data_name='data.bin',
     better control over filepath structure, minimal output, and fewer
     dependencies on file format details. However, for very large files, you
     may want to investigate `recording.save` to speed up data copying.
+
+    While copying, progress is saved to `<data_name>.progress.json` in
+    `filepath` so that a conversion that was killed (like a preempted cluster
+    job) can be resumed by calling this function again with the same
+    arguments. The progress file is removed once copying is finished.
     
     """
 
@@ -1169,42 +2564,125 @@ def spikeinterface_to_binary(recording, filepath, data_name='data.bin',
     dtype = recording.get_dtype()
     logger.info(f'dtype: {dtype}')
 
-    # Determine start/end indices for each segment
+    # Determine start/end indices for each chunk in each segment, and the
+    # offset of each segment in the binary file.
     indices = []
+    offset = 0
     for k in range(s):
         n = recording.get_num_samples(segment_index=k)
-        i = 0 + k*chunksize
-        while i < n:
-            j = i + chunksize if (i + chunksize) < n else n
-            indices.append((i, j, k))
-            i += chunksize
+        for i in range(0, n, chunksize):
+            j = min(i + chunksize, n)
+            indices.append((i, j, k, offset))
+        offset += n
 
     # Copy each chunk of data to memmory mapped binary file,
     # use multithreading to speed it up.
-    def copy_chunk(memmap, i, j, k):
+    def copy_chunk(memmap, i, j, k, offset):
         t = recording.get_traces(start_frame=i, end_frame=j, segment_index=k)
-        memmap[i:j,:] = t
-        memmap.flush()
+        memmap[offset+i : offset+j, :] = t
         del(t)
 
-    y = np.memmap(binary_filename, dtype=dtype, mode='w+', shape=(N,c))
     total_chunks = len(indices)
+    progress_file = binary_filename.with_name(
+        binary_filename.name + '.progress.json'
+        )
+    header = {'n_samples': int(N), 'n_chans': int(c), 'chunksize': int(chunksize),
+              'dtype': np.dtype(dtype).str, 'n_chunks': total_chunks}
+    # Chunks before `n_saved` have all been copied and flushed to disk.
+    n_saved = 0
+    if resume and progress_file.is_file() and binary_filename.is_file():
+        with open(progress_file) as f:
+            progress = json.load(f)
+        if {k: progress.get(k) for k in header} == header:
+            n_saved = progress['n_saved']
+    if n_saved > 0:
+        y = np.memmap(binary_filename, dtype=dtype, mode='r+', shape=(N,c))
+        logger.info(
+            f'Resuming conversion from chunk {n_saved} of {total_chunks}, '
+            f'using {progress_file}.'
+            )
+    else:
+        y = np.memmap(binary_filename, dtype=dtype, mode='w+', shape=(N,c))
+
+    def save_progress():
+        y.flush()
+        tmp_file = progress_file.with_name(progress_file.name + '.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump({**header, 'n_saved': n_saved}, f)
+        os.replace(tmp_file, progress_file)
+
+    if max_workers is None:
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+    if max_in_flight is None:
+        max_in_flight = 2 * max_workers
+    bytes_per_sample = c * np.dtype(dtype).itemsize
+
     logger.info('='*40)
     logger.info(
         f'Converting {total_chunks} data chunks '
         f'with a chunksize of {chunksize} samples...'
         )
+    # Chunks can finish out of order, but progress only advances past chunks
+    # for which all previous chunks have also finished.
+    in_flight = {}
+    finished = set()
+    next_chunk = n_saved
+    n_unsaved = 0
+    n_bytes = 0
+    t0 = time.time()
+    t_log = t0
     with ThreadPoolExecutor(max_workers=max_workers) as exe:
-        futures = [exe.submit(copy_chunk, y, i, j, k) for i, j, k in indices]
-        # TODO: every some-amount-of-time, check list of futures
-        #       for completion
-        while exe._work_queue.qsize() > 0:
-            time.sleep(10)
-            logger.info(
-                f'{total_chunks - exe._work_queue.qsize()} of {total_chunks}'
-                ' chunks converted...'
-                )
-    logger.info(f'Data conversion finished.')
+        try:
+            while True:
+                while len(in_flight) < max_in_flight and next_chunk < total_chunks:
+                    future = exe.submit(copy_chunk, y, *indices[next_chunk])
+                    in_flight[future] = next_chunk
+                    next_chunk += 1
+                if len(in_flight) == 0:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    n = in_flight.pop(future)
+                    future.result()
+                    finished.add(n)
+                    i, j, _, _ = indices[n]
+                    n_bytes += (j - i) * bytes_per_sample
+
+                n_done = n_saved + n_unsaved
+                while n_done in finished:
+                    finished.remove(n_done)
+                    n_done += 1
+                n_unsaved = n_done - n_saved
+                if n_unsaved >= flush_every:
+                    n_saved = n_done
+                    n_unsaved = 0
+                    save_progress()
+
+                if time.time() - t_log > 10:
+                    t_log = time.time()
+                    logger.info(
+                        f'{n_done + len(finished)} of {total_chunks} chunks '
+                        f'converted, {n_bytes / 1e6 / (t_log - t0):.1f} MB/s...'
+                        )
+        except BaseException:
+            for future in in_flight:
+                future.cancel()
+            raise
+        finally:
+            if n_unsaved > 0:
+                # Record chunks that finished before an error, too.
+                n_saved += n_unsaved
+                n_unsaved = 0
+                save_progress()
+
+    y.flush()
+    progress_file.unlink(missing_ok=True)
+    elapsed = time.time() - t0
+    logger.info(
+        f'Data conversion finished, copied {n_bytes / 1e6:.1f} MB '
+        f'in {elapsed:.1f}s ({n_bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s).'
+        )
     logger.info('='*40)
 
     del(y)  # Close memmap after copying
@@ -1234,7 +2712,8 @@ def spikeinterface_to_binary(recording, filepath, data_name='data.bin',
 
 class RecordingExtractorAsArray:
 
-    def __init__(self, recording_extractor):
+    def __init__(self, recording_extractor, chunk_size=2**16, cache_chunks=4,
+                 prefetch=True):
         """An array-like wrapper for a RecordingExtractor.
 
         This class is provided to assist with loading data from other file 
@@ -1251,6 +2730,20 @@ class RecordingExtractorAsArray:
             A SpikeInterface recording extractor. When the wrapper object is
             indexed, `recording_extractor.get_traces()` will be invoked to
             retrieve data from disk.
+        chunk_size : int; default=2**16.
+            Number of samples per chunk read from `recording_extractor`.
+            Requested samples are read in chunks aligned to multiples of
+            `chunk_size`, with all channels included.
+        cache_chunks : int; default=4.
+            Maximum number of chunks kept in memory. Overlapping or repeated
+            requests, like the padding shared by neighbouring batches, are
+            served from these chunks instead of reading from disk again.
+            The least recently used chunk is discarded when this is
+            exceeded. If 0, data is read for exactly the requested range
+            on every access.
+        prefetch : bool; default=True.
+            If True, the chunk following the most recent request is read in a
+            background thread. Has no effect if `cache_chunks` is 0.
 
         Attributes
         ----------
@@ -1272,6 +2765,7 @@ class RecordingExtractorAsArray:
 
         """
 
+        self.recording = recording_extractor
         if recording_extractor.get_num_segments() > 1:
             try:
                 import spikeinterface as si
@@ -1289,7 +2783,6 @@ class RecordingExtractorAsArray:
 
         logger.info('='*40)
         logger.info('Loading recording with SpikeInterface...')
-        self.recording = recording_extractor
         self.N = self.recording.get_total_samples()
         logger.info(f'number of samples: {self.N}')
         self.c = self.recording.get_traces(start_frame=0, end_frame=1, segment_index=0).shape[1]
@@ -1302,7 +2795,79 @@ class RecordingExtractorAsArray:
         logger.info(f'dtype: {self.dtype}')
         self.shape = (self.N, self.c)
         logger.info('='*40)
-    
+
+        self.chunk_size = int(chunk_size)
+        self.cache_chunks = cache_chunks
+        self.prefetch = prefetch
+        self._chunks = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        # Extractors are not guaranteed to be thread-safe, so reads from the
+        # prefetch thread and the caller are never run at the same time.
+        self._read_lock = threading.Lock()
+        self._executor = None
+        self.hits = 0
+        self.misses = 0
+
+    def _read_chunk(self, k):
+        a = k * self.chunk_size
+        b = min(a + self.chunk_size, self.N)
+        with self._read_lock:
+            return self.recording.get_traces(start_frame=a, end_frame=b)
+
+    def _get_chunk(self, k):
+        with self._lock:
+            if k in self._chunks:
+                self._chunks.move_to_end(k)
+                self.hits += 1
+                return self._chunks[k]
+            future = self._pending.pop(k, None)
+            self.misses += 1
+        data = future.result() if future is not None else self._read_chunk(k)
+        with self._lock:
+            self._chunks[k] = data
+            while len(self._chunks) > self.cache_chunks:
+                self._chunks.popitem(last=False)
+        return data
+
+    def _prefetch_chunk(self, k):
+        if k * self.chunk_size >= self.N:
+            return
+        with self._lock:
+            if k in self._chunks or k in self._pending:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            self._pending[k] = self._executor.submit(self._read_chunk, k)
+
+    def _get_cached(self, i, j, channel_idx):
+        first = i // self.chunk_size
+        last = (j - 1) // self.chunk_size
+        samples = None
+        for k in range(first, last + 1):
+            chunk = self._get_chunk(k)
+            a = max(i, k * self.chunk_size)
+            b = min(j, (k + 1) * self.chunk_size)
+            piece = chunk[a - k*self.chunk_size : b - k*self.chunk_size]
+            piece = piece[:, channel_idx]
+            if samples is None:
+                samples = np.empty((j - i, piece.shape[1]), dtype=piece.dtype)
+            samples[a-i : b-i] = piece
+        if self.prefetch:
+            self._prefetch_chunk(last + 1)
+        return samples
+
+    def close(self):
+        """Stop background reads and discard cached chunks."""
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending = {}
+            self._chunks = OrderedDict()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
 
     def __getitem__(self, *items):
         idx, *crop = items
@@ -1334,6 +2899,11 @@ class RecordingExtractorAsArray:
             channel_ids = [channel_ids]
         else:
             channel_ids = np.arange(self.shape[1])
+
+        j = min(j, self.N)
+        if self.cache_chunks > 0 and j > i:
+            return self._get_cached(i, j, channel_ids)
+
         # Index into actual channel ids from recording, which do not have to 
         # be sequential or start from 0
         channel_ids = self.recording.channel_ids[channel_ids]
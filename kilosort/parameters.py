@@ -8,6 +8,7 @@ import numpy as np
 #     'min': minimum value allowed (inclusive).
 #     'max': maximum value allowed (inclusive).
 #     'exclude': list of individual values to exclude from allowed range.
+#     'options': (str parameters only) list of allowed values.
 #     'default': default value used by gui and API
 #     'step': which step of the pipeline the parameter is used in, from:
 #             ['data', 'preprocessing', 'spike detection',
@@ -140,6 +141,45 @@ EXTRA_PARAMETERS = {
             """
     },
 
+    'byte_offset': {
+        'gui_name': 'byte offset', 'type': int, 'min': 0, 'max': np.inf,
+        'exclude': [], 'default': 0, 'step': 'data',
+        'description':
+            """
+            Number of bytes at the start of the binary file to skip, for
+            example a file header. Data is still memory-mapped directly from
+            the file, starting at this offset.
+            """
+    },
+
+    'prefetch_batches': {
+        'gui_name': 'prefetch batches', 'type': int, 'min': 0, 'max': np.inf,
+        'exclude': [], 'default': 2, 'step': 'data',
+        'description':
+            """
+            Number of batches to read from disk in background threads while
+            the current batch is being processed. Higher values can help on
+            slow or network filesystems, at the cost of holding more batches
+            in memory. Set to 0 to read batches synchronously.
+            """
+    },
+
+    'batch_cache_gb': {
+        'gui_name': 'batch cache (GB)', 'type': float, 'min': 0, 'max': np.inf,
+        'exclude': [], 'default': 0, 'step': 'data',
+        'description':
+            """
+            Maximum size of the on-disk cache of preprocessed batches, in
+            gigabytes. If greater than 0, filtered, whitened and drift-corrected
+            batches are saved to `batch_cache_dir` (by default
+            `results_dir/.batch_cache`) the first time they are computed, so
+            that later passes over the data can load them instead of
+            preprocessing again. Cached batches are also re-used by later runs
+            on the same data with the same preprocessing. When the cache is
+            full, the least recently used batches are deleted.
+            """
+    },
+
     ### PREPROCESSING
     'artifact_threshold': {
         'gui_name': 'artifact threshold', 'type': float, 'min': 0, 'max': np.inf,
@@ -152,6 +192,33 @@ EXTRA_PARAMETERS = {
             """
     },
 
+    'car_method': {
+        'gui_name': 'CAR method', 'type': str, 'min': None, 'max': None,
+        'exclude': [], 'options': ['median', 'approx', 'shank'],
+        'default': 'median', 'step': 'preprocessing',
+        'description':
+            """
+            How the common average reference is computed, if `do_CAR` is
+            True. 'median' uses the exact median across channels.
+            'approx' uses the median of medians of channel triples, which is
+            about twice as fast on CPU. 'shank' uses a separate median for
+            each shank, based on the probe's `kcoords`.
+            """
+    },
+
+    'fused_preprocessing': {
+        'gui_name': 'fused preprocessing', 'type': bool, 'min': None,
+        'max': None, 'exclude': [], 'default': False, 'step': 'preprocessing',
+        'description':
+            """
+            If True, batches are preprocessed with fewer intermediate copies
+            of the data: steps are done in place where possible, and the
+            high-pass filter and fftshift are combined into one step. This
+            is faster on CPU, and gives the same result up to float32
+            rounding error.
+            """
+    },
+
     'nskip': {
         'gui_name': 'nskip', 'type': int, 'min': 1, 'max': np.inf,
         'exclude': [], 'default': 25, 'step': 'preprocessing',
@@ -170,6 +237,31 @@ EXTRA_PARAMETERS = {
             """
     },
 
+    'whitening_tol': {
+        'gui_name': 'whitening tol', 'type': float, 'min': 0, 'max': np.inf,
+        'exclude': [], 'default': 0, 'step': 'preprocessing',
+        'description':
+            """
+            Convergence tolerance for the covariance matrix used to compute
+            the whitening matrix. Batches are sampled from across the
+            recording, and sampling stops once the covariance estimated from
+            all sampled batches differs from the estimate using only the
+            first half of them by less than this (relative) value. The check
+            is done each time the number of batches doubles, starting from 20.
+            By default (0), every `nskip`-th batch is always used.
+            """
+    },
+
+    'whitening_max_batches': {
+        'gui_name': 'whitening max batches', 'type': int, 'min': 1,
+        'max': np.inf, 'exclude': [], 'default': None, 'step': 'preprocessing',
+        'description':
+            """
+            Maximum number of batches used to compute the whitening matrix.
+            By default, there is no limit other than `nskip`.
+            """
+    },
+
     'highpass_cutoff': {
         'gui_name': 'highpass cutoff', 'type': float, 'min': 0, 'max': np.inf,
         'exclude': [], 'default': 300, 'step': 'preprocessing',
@@ -211,6 +303,48 @@ EXTRA_PARAMETERS = {
             """
     },
 
+    'max_drift_shift': {
+        'gui_name': 'max drift shift', 'type': float, 'min': 0, 'max': np.inf,
+        'exclude': [0], 'default': None, 'step': 'preprocessing',
+        'description':
+            """
+            Maximum vertical shift in microns considered when aligning batches
+            for drift correction, before fine alignment within blocks. By
+            default, this is 15 bins of size `binning_depth` (75 microns).
+            Increase this for recordings with large drift.
+            """
+    },
+
+    'drift_nskip': {
+        'gui_name': 'drift nskip', 'type': int, 'min': 1, 'max': np.inf,
+        'exclude': [], 'default': 1, 'step': 'preprocessing',
+        'description':
+            """
+            Batch stride for estimating drift. Spikes are only detected in
+            every `drift_nskip`-th batch for drift estimation, and shifts
+            for the remaining batches are linearly interpolated. Smoothing
+            across batches in `drift_smoothing` is divided by `drift_nskip`
+            so that it spans the same amount of time, which means it has
+            little effect once `drift_nskip` is larger than a few times the
+            smoothing. Values above 1 save time on long recordings with slow
+            drift.
+            """
+    },
+
+    'cache_motion': {
+        'gui_name': 'cache motion', 'type': bool, 'min': None, 'max': None,
+        'exclude': [], 'default': True, 'step': 'preprocessing',
+        'description':
+            """
+            If True, drift estimates are saved to a cache directory, by
+            default `results_dir/.motion_cache`, and re-used by later runs on
+            the same data file and time range with the same preprocessing,
+            spike detection and drift settings. This applies to both
+            Kilosort and MEDiCINe drift estimates. Data provided as a
+            `file_object` are not cached.
+            """
+    },
+
 
     ### SPIKE DETECTION
     # NOTE: if left as None, will be set to `int(20 * settings['nt']/61)`
@@ -308,6 +442,25 @@ EXTRA_PARAMETERS = {
         """
     },
 
+    'precision': {
+        'gui_name': 'precision', 'type': str, 'min': None, 'max': None,
+        'exclude': [], 'options': ['float32', 'bfloat16', 'float16'],
+        'default': 'float32', 'step': 'spike detection',
+        'description':
+            """
+            Floating point format for convolutions of batch data with
+            templates, during spike detection and template matching.
+            Filtered batches are converted to this format once, as they are
+            loaded for those steps, which halves the memory used by each
+            batch and by the convolution outputs. Convolution outputs are
+            converted back to float32 in chunks before projecting onto
+            templates, and all later steps are done in float32.
+            'bfloat16' is faster on most recent CPUs, 'float16' is usually
+            only faster on GPU. See `simulation.compare_precision` to check
+            the effect on sorting results.
+            """
+    },
+
     'templates_from_data': {
         'gui_name': 'templates from data', 'type': bool, 'min': None, 'max': None,
         'exclude': [], 'default': True, 'step': 'spike detection',
@@ -348,6 +501,21 @@ EXTRA_PARAMETERS = {
             """
     },
 
+    'max_spike_memory_gb': {
+        'gui_name': 'max spike memory (GB)', 'type': float, 'min': 0,
+        'max': np.inf, 'exclude': [0], 'default': np.inf,
+        'step': 'spike detection',
+        'description':
+            """
+            Maximum amount of memory used to store detected spikes and their
+            features while they are collected during spike detection, in
+            gigabytes. Spikes beyond this limit are temporarily stored on disk
+            in the results directory. This does not limit peak memory use:
+            once all batches are processed, every spike is loaded into memory
+            as one array. By default there is no limit.
+            """
+    },
+
 
     ### CLUSTERING
     'acg_threshold': {
@@ -431,9 +599,13 @@ for k, v in MAIN_PARAMETERS.items():
         """
     v['description'] += s
 for k, v in EXTRA_PARAMETERS.items():
+    if 'options' in v:
+        allowed = f"Options: {', '.join(v['options'])}"
+    else:
+        allowed = f"Min, max: ({str(v['min'])}, {str(v['max'])})"
     s = f"""
         Default value: {str(v["default"])}   
-        Min, max: ({str(v['min'])}, {str(v['max'])})   
+        {allowed}   
         Type: {v['type'].__name__}
         """
     v['description'] += s
@@ -120,3 +120,119 @@ def make_pc_features(ops, spike_templates, spike_clusters, tF):
     tF = torch.permute(tF, (0, 2, 1))
 
     return tF, feature_ind
+
+
+def save_pc_features(filename, ops, spike_templates, spike_clusters, tF,
+                     kept_spikes=None, chunk_size=2**16):
+    '''Write PC Features for export to Phy without copying all of tF.
+
+    Produces the same result as `make_pc_features`, but `tF` is not modified
+    and the features are written to `filename` (as an `.npy` file) in chunks
+    of spikes, so that peak memory use is bounded by `chunk_size` rather than
+    the total number of spikes.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Path where pc features will be saved, typically `pc_features.npy`.
+    ops : dict
+        Dictionary of state variables updated throughout the sorting process.
+        This function is intended to be used with the final state of ops, after
+        all sorting has finished.
+    spike_templates : np.ndarray
+        Vector of template ids for kept spikes, with shape `(n_kept,)`.
+    spike_clusters : np.ndarray
+        Vector of cluster ids for kept spikes, with shape `(n_kept,)`.
+    tF : torch.Tensor
+        Tensor of pc features as returned by `template_matching.extract`,
+        with shape `(n_spikes, nearest_chans, n_pcs)`.
+    kept_spikes : np.ndarray; optional.
+        Boolean mask with shape `(n_spikes,)` indicating which spikes in `tF`
+        were kept by `remove_duplicates`. By default, all spikes are kept.
+    chunk_size : int; default=2**16.
+        Number of spikes from `tF` to process at a time.
+
+    Returns
+    -------
+    feature_ind : np.ndarray
+        Channel indices associated with the saved features for each cluster,
+        with shape `(n_clusters, nearest_chans)`.
+
+    '''
+
+    xy, iC = xy_templates(ops)
+    iC = iC.cpu().numpy()
+    n_templates = iC.shape[1]
+    n_spikes, n_chans_raw, n_pcs = tF.shape
+    n_chans = ops['nearest_chans']
+    if kept_spikes is None:
+        kept_spikes = np.ones(n_spikes, dtype=bool)
+    spike_templates = spike_templates.astype(np.int64)
+    clusters = np.unique(spike_clusters)
+    feature_ind = np.zeros((clusters.size, n_chans), dtype=np.uint32)
+
+    def kept_chunks():
+        # Yield (first kept index, templates, features) for each chunk of tF
+        i = 0
+        for start in range(0, n_spikes, chunk_size):
+            keep = torch.from_numpy(kept_spikes[start : start+chunk_size])
+            X = tF[start : start+chunk_size].cpu()[keep]
+            yield i, spike_templates[i : i+X.shape[0]], X
+            i += X.shape[0]
+
+    # Sum of features and spike count for each template.
+    template_sum = torch.zeros((n_templates, n_chans_raw, n_pcs),
+                               dtype=torch.float64)
+    template_count = np.zeros(n_templates, dtype=np.int64)
+    for _, t, X in kept_chunks():
+        template_sum.index_add_(0, torch.from_numpy(t), X.double())
+        template_count += np.bincount(t, minlength=n_templates)
+
+    # Features for every spike detected with a cluster's templates are
+    # assigned channels based on that cluster. If a template is shared by
+    # multiple clusters, the largest cluster id takes precedence, the same as
+    # overwriting tF in order of cluster ids.
+    pairs = np.unique(np.vstack([spike_clusters, spike_templates]), axis=1)
+    winner = np.full(n_templates, -1, dtype=np.int64)
+    np.maximum.at(winner, pairs[1], pairs[0])
+    # Position of each template channel in the saved features, or -1 if the
+    # channel is not one of the `n_chans` channels kept for the cluster.
+    feature_col = np.full((n_templates, n_chans_raw), -1, dtype=np.int64)
+
+    for i in clusters:
+        templates = pairs[1, pairs[0] == i]
+        ch_min = iC[:, templates].min()
+        nchan = iC[:, templates].max() + 1 - ch_min
+        # Same as mean of features across spikes in `get_data_cpu` layout
+        dd = torch.zeros((nchan, n_pcs), dtype=torch.float64)
+        for t in templates:
+            dd[iC[:, t] - ch_min] += template_sum[t]
+        spike_mean = (dd / template_count[templates].sum()).float()
+        # Find channels w/ largest norm
+        chan_norm = torch.linalg.norm(spike_mean, dim=1)
+        sorted_chans, ind = torch.sort(chan_norm, descending=True)
+        ind = ind[:n_chans].numpy()
+        feature_ind[i,:] = ind + ch_min
+
+        rank = np.full(nchan, -1, dtype=np.int64)
+        rank[ind] = np.arange(ind.size)
+        for t in templates[winner[templates] == i]:
+            feature_col[t] = rank[iC[:, t] - ch_min]
+
+    # Shape expected by Phy, (n_spikes, n_pcs, n_chans)
+    pc_features = np.lib.format.open_memmap(
+        filename, mode='w+', dtype=np.float32,
+        shape=(spike_templates.size, n_pcs, n_chans)
+        )
+    for i, t, X in kept_chunks():
+        m = X.shape[0]
+        out = np.zeros((m, n_pcs, n_chans), dtype=np.float32)
+        cols = feature_col[t].ravel()
+        rows = np.repeat(np.arange(m), n_chans_raw)
+        valid = cols >= 0
+        out[rows[valid], :, cols[valid]] = X.reshape(-1, n_pcs).numpy()[valid]
+        pc_features[i : i+m] = out
+    pc_features.flush()
+    del pc_features
+
+    return feature_ind
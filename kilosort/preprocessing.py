@@ -3,7 +3,9 @@ import numpy as np
 from scipy.signal import butter, filtfilt
 from scipy.interpolate import interp1d
 from glob import glob
-from torch.fft import fft, ifft, fftshift
+from torch.fft import fft, ifft, fftshift, rfft
+import logging
+logger = logging.getLogger(__name__)
 
 def whitening_from_covariance(CC):
     """Whitening matrix for a covariance matrix CC.
@@ -21,19 +23,77 @@ def whitening_local(CC, xc, yc, nrange=32, device=torch.device('cuda')):
     Nchan = CC.shape[0]
     Wrot = torch.zeros((Nchan,Nchan), device = device)
 
-    # for each channel, a local covariance matrix is extracted
-    # the whitening matrix is computed for that local neighborhood
-    for j in range(CC.shape[0]):
-        ds = (xc[j] - xc)**2 + (yc[j] - yc)**2
-        isort = np.argsort(ds)
-        ix = isort[:nrange]
+    # nearest channels for every channel at once, shape (Nchan, nrange)
+    xc = np.asarray(xc)
+    yc = np.asarray(yc)
+    ds = (xc[:, None] - xc)**2 + (yc[:, None] - yc)**2
+    ix = np.argsort(ds, axis=1)[:, :nrange]
 
-        wrot = whitening_from_covariance(CC[np.ix_(ix, ix)])
+    # for each channel, a local covariance matrix is extracted, and the
+    # whitening matrices for all neighborhoods are computed in one batch
+    ix = torch.from_numpy(ix).to(CC.device)
+    CC_local = CC[ix[:, :, None], ix[:, None, :]]
+    D, E = torch.linalg.eigh(CC_local)
+    # covariance is positive semi-definite, clamp any rounding errors
+    D = D.clamp(min=0)
+    eps = 1e-6
 
-        # the first row of wrot is a whitening vector for the center channel
-        Wrot[j, ix] = wrot[0]
+    # the first row of each local ZCA matrix (see whitening_from_covariance)
+    # is a whitening vector for the center channel
+    wrot = ((E[:, :1, :] / (D[:, None, :] + eps)**.5) @ E.transpose(1, 2))
+    Wrot[torch.arange(Nchan, device=device)[:, None], ix.to(device)] = \
+        wrot[:, 0].to(device)
     return Wrot
 
+CAR_METHODS = ['median', 'approx', 'shank']
+
+def common_reference(X, method='median', groups=None):
+    """Common reference across channels for a batch X (channels x time).
+
+    Parameters
+    ----------
+    X : torch.Tensor
+        Data with shape (n_channels, n_samples).
+    method : str; default='median'.
+        'median' : exact median across channels.
+        'approx' : median of the medians of channel triples, about twice as
+            fast on CPU. Any channels left over are included as-is.
+        'shank' : exact median across the channels in each group.
+    groups : list of torch.Tensor; optional.
+        Channel indices for each group, required for `method='shank'`.
+
+    Returns
+    -------
+    torch.Tensor
+        Shape (n_samples,), or (n_channels, n_samples) for 'shank'.
+
+    """
+    if method == 'median':
+        return torch.median(X, 0)[0]
+
+    elif method == 'approx':
+        n = X.shape[0] // 3
+        if n == 0:
+            return torch.median(X, 0)[0]
+        a, b, c = X[:n], X[n:2*n], X[2*n:3*n]
+        # median of three values without sorting
+        med3 = torch.maximum(torch.minimum(a, b),
+                             torch.minimum(torch.maximum(a, b), c))
+        return torch.median(torch.cat((med3, X[3*n:])), 0)[0]
+
+    elif method == 'shank':
+        if groups is None:
+            raise ValueError("Channel groups must be provided for method='shank'.")
+        ref = torch.empty_like(X)
+        for g in groups:
+            ref[g] = torch.median(X[g], 0)[0]
+        return ref
+
+    else:
+        raise ValueError(
+            f'Unrecognized CAR method: {method}, must be one of {CAR_METHODS}.'
+            )
+
 def kernel2D_torch(x, y, sig = 1):
     """Simple Gaussian kernel for two sets of coordinates x and y."""
     ds = ((x.unsqueeze(1) - y)**2).sum(-1)
@@ -69,6 +129,43 @@ def get_drift_matrix(ops, dshift, device=torch.device('cuda')):
     return M
 
 
+def get_drift_matrices(ops, dshifts, device=torch.device('cuda')):
+    """Drift matrices for several dshift rows at once, stacked on dim 0.
+
+    Equivalent to calling `get_drift_matrix` for each row of `dshifts`.
+
+    """
+    dshifts = np.asarray(dshifts)
+    if dshifts.ndim == 1:
+        dshifts = dshifts[:, np.newaxis]
+
+    # first, interpolate drifts to every channel
+    yc = ops['probe']['yc']
+    if ops['nblocks'] == 1:
+        shifts = dshifts[:, :1] * np.ones_like(yc)
+    else:
+        finterp = interp1d(ops['yblk'], dshifts, axis=1,
+                           fill_value="extrapolate", kind='linear')
+        shifts = finterp(yc)
+
+    # compute coordinates of desired interpolation
+    xp = np.vstack((ops['probe']['xc'], yc)).T
+    yp = np.repeat(xp[np.newaxis], shifts.shape[0], axis=0)
+    yp[:,:,1] -= shifts
+
+    xp = torch.from_numpy(xp).to(device)
+    yp = torch.from_numpy(yp).to(device)
+
+    # same radial kernel as kernel2D_torch, batched over dshift rows
+    ds = ((yp.unsqueeze(-2) - xp)**2).sum(-1)
+    Kyx = torch.exp(-ds / (2*ops['settings']['sig_interp']**2))
+
+    # multiply with precomputed inverse kernel matrix of original channels
+    M = Kyx @ ops['iKxx']
+
+    return M
+
+
 def get_fwav(NT = 30122, fs = 30000, device=torch.device('cuda')):
     """Precomputes a filter to use for high-pass filtering.
     
@@ -93,23 +190,62 @@ def get_fwav(NT = 30122, fs = 30000, device=torch.device('cuda')):
 
     return fwav
 
-def get_whitening_matrix(f, xc, yc, nskip=25, nrange=32):
-    """Get the whitening matrix, use every nskip batches."""
+def _spread_order(n):
+    """Order range(n) so that any prefix is spread evenly over the range."""
+    if n < 2:
+        return list(range(n))
+    n_bits = int(np.ceil(np.log2(n)))
+    # bit-reversal permutation: 0, 1/2, 1/4, 3/4, 1/8, ... of the range
+    rev = [int(format(i, f'0{n_bits}b')[::-1], 2) for i in range(2**n_bits)]
+    return [i for i in rev if i < n]
+
+def get_whitening_matrix(f, xc, yc, nskip=25, nrange=32, tol=0,
+                         max_batches=None, min_batches=20):
+    """Get the whitening matrix, use every nskip batches.
+
+    Batches are read in an order spread across the whole recording, so any
+    prefix of that order samples the whole recording. If `tol` is positive,
+    the mean covariance of the first k batches is compared to that of the
+    first k/2 batches, for k = `min_batches`, 2*`min_batches`, 4*`min_batches`
+    and so on. Reading stops once their relative (Frobenius norm) difference
+    is less than `tol`. At most `max_batches` batches are used.
+
+    """
     n_chan = len(f.chan_map)
+    batch_indices = np.arange(0, f.n_batches-1, nskip)
+    batch_indices = batch_indices[_spread_order(batch_indices.size)]
+    if max_batches is not None:
+        batch_indices = batch_indices[:max_batches]
+
     # collect the covariance matrix across channels
     CC = torch.zeros((n_chan, n_chan), device=f.device)
+    # covariance sum over the first `k_check // 2` batches
+    CC_half = None
+    k_check = max(min_batches, 2)
     k = 0
-    for j in range(0, f.n_batches-1, nskip):
-        # load data with high-pass filtering (see the Binary file class)
-        X = f.padded_batch_to_torch(j)        
+    # load data with high-pass filtering (see the Binary file class)
+    for X in f.iter_batches(batch_indices.tolist()):
         
         # remove padding
         X = X[:, f.nt : -f.nt]
 
         # cumulative covariance matrix
         CC = CC + (X @ X.T)/X.shape[1]
-        
         k+=1
+
+        # stop early if the covariance estimate has converged
+        if tol > 0:
+            if k == k_check // 2:
+                CC_half = CC.clone()
+            elif k == k_check:
+                change = torch.linalg.norm(CC/k - CC_half/(k//2)) \
+                         / torch.linalg.norm(CC/k)
+                if change < tol:
+                    logger.info(f'Whitening covariance converged after {k} '
+                                f'of {batch_indices.size} batches.')
+                    break
+                CC_half = CC.clone()
+                k_check *= 2
         
     CC = CC / k
 
@@ -135,20 +271,26 @@ def get_highpass_filter(fs=30000, cutoff=300, device=torch.device('cuda')):
     hp_filter = torch.from_numpy(hp_filter).to(device).float()
     return hp_filter
 
-def fft_highpass(hp_filter, NT=30122):
-    """Convert filter to fourier domain."""
+def fft_highpass(hp_filter, NT=30122, real=False):
+    """Convert filter to fourier domain.
+
+    If `real` is True, only the non-negative frequencies are returned
+    (using `rfft`), for use with `irfft` on real-valued data.
+
+    """
     device = hp_filter.device
     ft = hp_filter.shape[0]
+    transform = rfft if real else fft
 
     # the filter is padded or cropped depending on the size of NT
     if ft < NT:
         pad = (NT - ft) // 2
-        fhp = fft(torch.cat((torch.zeros(pad, device=device), 
-                             hp_filter,
-                             torch.zeros(pad + (NT-pad*2-ft), device=device))))
+        fhp = transform(torch.cat((torch.zeros(pad, device=device), 
+                                   hp_filter,
+                                   torch.zeros(pad + (NT-pad*2-ft), device=device))))
     elif ft > NT:
         crop = (ft - NT) // 2 
-        fhp = fft(hp_filter[crop : crop + NT])
+        fhp = transform(hp_filter[crop : crop + NT])
     else:
-        fhp = fft(hp_filter)
+        fhp = transform(hp_filter)
     return fhp
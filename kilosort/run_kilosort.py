@@ -4,7 +4,9 @@ import pprint
 import logging
 import warnings
 import platform
-import sys
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 logger = logging.getLogger(__name__)
 
 import numpy as np
@@ -24,16 +26,21 @@ from kilosort import (
 )
 from kilosort.parameters import DEFAULT_SETTINGS
 from kilosort.utils import (
-    log_performance, log_cuda_details, probe_as_string, ops_as_string
+    log_performance, log_cuda_details, probe_as_string, ops_as_string, seed_rng
     )
 
 RECOGNIZED_SETTINGS = list(DEFAULT_SETTINGS.keys())
 RECOGNIZED_SETTINGS.extend([
     'filename', 'data_dir', 'results_dir', 'probe_name', 'probe_path',
     'data_file_path', 'probe', 'data_dtype', 'save_preprocessed_copy',
-    'clear_cache', 'do_CAR', 'invert_sign'
+    'clear_cache', 'do_CAR', 'invert_sign', 'batch_cache_dir',
+    'motion_cache_dir'
 ])
 
+# Set by `run_kilosort_multi` for its worker threads, so that each sorting
+# run logs to its own results directory.
+_thread_state = threading.local()
+
 
 def run_kilosort(settings, probe=None, probe_name=None, filename=None,
                  data_dir=None, file_object=None, results_dir=None,
@@ -41,7 +48,8 @@ def run_kilosort(settings, probe=None, probe_name=None, filename=None,
                  progress_bar=None, save_extra_vars=False, clear_cache=False,
                  save_preprocessed_copy=False, bad_channels=None,
                  verbose_console=False, drift_correction_type='none', with_whitening=False,
-                 stop_after_motion=True):
+                 stop_after_motion=True, batch_cache_dir=None,
+                 preprocessed_dtype='int16', motion_cache_dir=None):
     """Run full spike sorting pipeline on specified data.
     
     Parameters
@@ -51,7 +59,9 @@ def run_kilosort(settings, probe=None, probe_name=None, filename=None,
         spike sorting pipeline. See `kilosort/parameters.py` for a full list of
         available parameters.
         NOTE: `n_chan_bin` must be specified here, but all other settings are
-              optional.
+              optional. If the binary file has a SpikeGLX `.meta` file next
+              to it, `n_chan_bin` and `fs` are read from there when not
+              specified, and are checked against it otherwise.
     probe : dict; optional.
         A Kilosort4 probe dictionary, as returned by `kilosort.io.load_probe`.
     probe_name : str; optional.
@@ -106,6 +116,10 @@ def run_kilosort(settings, probe=None, probe_name=None, filename=None,
         If True, save a pre-processed copy of the data (including drift
         correction) to `temp_wh.dat` in the results directory and format Phy
         output to use that copy of the data.
+    preprocessed_dtype : str; default='int16'.
+        Data type of `temp_wh.dat` if `save_preprocessed_copy=True`, either
+        'int16' or 'float16'. Both use the same scaling, but float16 data is
+        not rounded to integers and does not overflow for large values.
     bad_channels : list; optional.
         A list of channel indices (rows in the binary file) that should not be
         included in sorting. Listing channels here is equivalent to excluding
@@ -114,12 +128,32 @@ def run_kilosort(settings, probe=None, probe_name=None, filename=None,
         If True, set logging level for console output to `DEBUG` instead
         of `INFO`, so that additional information normally only saved to the
         log file will also show up in real time while sorting.
+    batch_cache_dir : str or Path; optional.
+        Directory for the on-disk cache of preprocessed batches, which is only
+        used if `settings['batch_cache_gb'] > 0`. By default, will be set to
+        `results_dir / '.batch_cache'`. Using the same directory for multiple
+        runs allows cached batches to be re-used between them.
+    stop_after_motion : bool; default=True.
+        If True and `drift_correction_type='medicine'`, return after motion
+        has been estimated, without sorting. Only `ops` is saved to
+        `results_dir` and returned, all other return values are None.
+    motion_cache_dir : str or Path; optional.
+        Directory where drift estimates are cached, which is only used if
+        `settings['cache_motion']` is True. By default, will be set to
+        `results_dir / '.motion_cache'`, so that repeated runs re-use
+        estimates computed with the same data, time range and settings. Using
+        the same directory for multiple results directories allows estimates
+        to be re-used between them. If the directory can't be written to, a
+        warning is logged and estimates are not cached.
     
     Raises
     ------
     ValueError
-        If settings[`n_chan_bin`] is None (default). User must specify, for
-        example:  `run_kilosort(settings={'n_chan_bin': 385})`.
+        If settings[`n_chan_bin`] is None (default) and there is no SpikeGLX
+        `.meta` file for the data. User must specify, for example:
+        `run_kilosort(settings={'n_chan_bin': 385})`.
+    ValueError
+        If settings[`n_chan_bin`] does not match the SpikeGLX `.meta` file.
 
     Returns
     -------
@@ -159,18 +193,42 @@ def run_kilosort(settings, probe=None, probe_name=None, filename=None,
     """
 
     # Configure settings, ops, and file paths
-    if settings is None or settings.get('n_chan_bin', None) is None:
+    if settings is None:
+        settings = {}
+    fs_given = settings.get('fs', None) is not None
+    settings = {**DEFAULT_SETTINGS, **settings,
+                'n_chan_bin': settings.get('n_chan_bin', None)}
+    # NOTE: This modifies settings in-place
+    filename, data_dir, results_dir, probe = \
+        set_files(settings, filename, probe, probe_name, data_dir, results_dir, bad_channels)
+    spikeglx_info = None
+    if file_object is None and settings['n_chan_bin'] is None:
+        # Otherwise, the .meta file is only read after logging is set up.
+        spikeglx_info = get_spikeglx_info(filename)
+        if spikeglx_info is not None:
+            settings['n_chan_bin'] = spikeglx_info['n_chan_bin']
+    if settings['n_chan_bin'] is None:
         raise ValueError(
             '`n_chan_bin` is a required setting. This is the total number of '
             'channels in the binary file, which may or may not be equal to the '
             'number of channels specified by the probe.'
             )
-    settings = {**DEFAULT_SETTINGS, **settings}
-    # NOTE: This modifies settings in-place
-    filename, data_dir, results_dir, probe = \
-        set_files(settings, filename, probe, probe_name, data_dir, results_dir, bad_channels)
-    setup_logger(results_dir, verbose_console=verbose_console)
-
+    log_handlers = setup_logger(
+        results_dir, verbose_console=verbose_console,
+        thread_only=getattr(_thread_state, 'thread_only', False)
+        )
+    if batch_cache_dir is None:
+        batch_cache_dir = settings.get('batch_cache_dir', None)
+    if batch_cache_dir is None:
+        batch_cache_dir = results_dir / '.batch_cache'
+    settings['batch_cache_dir'] = str(batch_cache_dir)
+    if motion_cache_dir is None:
+        motion_cache_dir = settings.get('motion_cache_dir', None)
+    if motion_cache_dir is None:
+        motion_cache_dir = results_dir / '.motion_cache'
+    settings['motion_cache_dir'] = str(motion_cache_dir)
+
+    bfile = None
     try:
         logger.info(f"Kilosort version {kilosort.__version__}")
         logger.info(f"Python version {platform.python_version()}")
@@ -208,6 +266,13 @@ def run_kilosort(settings, probe=None, probe_name=None, filename=None,
         if clear_cache:
             logger.info('clear_cache=True')
 
+        if file_object is None and spikeglx_info is None:
+            spikeglx_info = get_spikeglx_info(filename)
+        if file_object is None and spikeglx_info is not None:
+            if not fs_given:
+                settings['fs'] = spikeglx_info['fs']
+            check_spikeglx_info(settings, filename, probe, spikeglx_info)
+
         if probe['chanMap'].max() >= settings['n_chan_bin']:
             raise ValueError(
                 f'Largest value of chanMap exceeds channel count of data, '
@@ -216,7 +281,7 @@ def run_kilosort(settings, probe=None, probe_name=None, filename=None,
 
         tic0 = time.time()
         ops = initialize_ops(settings, probe, data_dtype, do_CAR, invert_sign,
-                            device, save_preprocessed_copy)
+                            device, save_preprocessed_copy, preprocessed_dtype)
         
         # Pretty-print ops and probe for log
         logger.debug(f"Initial ops:\n\n{ops_as_string(ops)}\n")
@@ -224,15 +289,19 @@ def run_kilosort(settings, probe=None, probe_name=None, filename=None,
 
         # Set preprocessing and drift correction parameters
         ops = compute_preprocessing(ops, device, tic0=tic0, file_object=file_object)
-        np.random.seed(1)
-        torch.cuda.manual_seed_all(1)
-        torch.random.manual_seed(1)
+        # Concurrent runs from `run_kilosort_multi` each get their own
+        # random state, instead of sharing the global generators.
+        seed_rng(1, isolated=getattr(_thread_state, 'thread_only', False))
         ops, bfile, st0 = compute_drift_correction(
             ops, device, tic0=tic0, progress_bar=progress_bar,
             file_object=file_object, clear_cache=clear_cache,
             drift_correction_type=drift_correction_type, 
-            with_whitening=with_whitening
+            with_whitening=with_whitening, stop_after_motion=stop_after_motion
             )
+        if bfile is None:
+            # Stopped after motion estimation.
+            io.save_ops(ops, results_dir)
+            return ops, None, None, None, None, None, None, None, None
 
         # Check scale of data for log file
         b1 = bfile.padded_batch_to_torch(0).cpu().numpy()
@@ -269,12 +338,129 @@ def run_kilosort(settings, probe=None, probe_name=None, filename=None,
         raise
     
     finally:
-        close_logger()
+        if bfile is not None and bfile.cache is not None:
+            # Finish writing cached batches and stop the writer thread.
+            bfile.cache.close()
+        close_logger(log_handlers)
 
     return ops, st, clu, tF, Wall, similar_templates, \
            is_ref, est_contam_rate, kept_spikes
 
 
+def run_kilosort_multi(recordings, settings=None, max_workers=None,
+                       return_exceptions=False, **kwargs):
+    """Sort several recordings concurrently in one process.
+
+    Each recording is sorted with `run_kilosort` in a separate thread, so
+    imported modules, compiled numba functions, universal templates and the
+    PyTorch thread pool are shared instead of being loaded by one process per
+    recording. This is intended for recordings from several probes in the
+    same session, where much of each run is spent waiting on file i/o.
+
+    Parameters
+    ----------
+    recordings : list of dict
+        Keyword arguments for `run_kilosort` that are specific to each
+        recording, like `filename`, `probe` and `results_dir`. If a recording
+        has a `settings` entry, it is combined with (and takes precedence
+        over) the shared `settings`.
+    settings : dict; optional.
+        Settings shared by all recordings, see `run_kilosort`.
+    max_workers : int; optional.
+        Maximum number of recordings sorted at once. By default, all
+        recordings are sorted at once.
+    return_exceptions : bool; default=False.
+        If True, an exception raised while sorting a recording is returned in
+        place of its results. Otherwise, the first exception is raised after
+        all recordings have finished.
+    **kwargs
+        Keyword arguments for `run_kilosort` shared by all recordings.
+
+    Returns
+    -------
+    results : list
+        Values returned by `run_kilosort` for each recording, in the same
+        order as `recordings`.
+
+    Raises
+    ------
+    ValueError
+        If two recordings would save results to the same directory.
+
+    Notes
+    -----
+    Each run logs to `kilosort4.log` in its own results directory, and console
+    output is prefixed with the name of that directory. Log handlers added
+    by earlier runs in the same session don't receive records from these
+    runs.
+
+    Each run has its own random state, which is only loaded into the global
+    numpy and torch generators (under a lock) for the steps that draw from
+    them: template extraction with KMeans, MEDiCINe and clustering. Results
+    are then the same as sorting each recording separately, and reproducible
+    between invocations. Those steps don't run concurrently. Other code
+    that draws from the global generators at the same time, like another
+    library in a different thread, is not isolated and makes results not
+    reproducible. When using a GPU, all runs share the same device memory.
+
+    Examples
+    --------
+    >>> results = run_kilosort_multi(
+    ...     [{'filename': 'g0_imec0/run.imec0.ap.bin', 'probe': probe0},
+    ...      {'filename': 'g0_imec1/run.imec1.ap.bin', 'probe': probe1}],
+    ...     settings={'n_chan_bin': 385}
+    ...     )
+    >>> ops0, st0, clu0 = results[0][:3]
+
+    """
+    jobs = []
+    for rec in recordings:
+        job = {**kwargs, **rec}
+        job['settings'] = {**(settings or {}), **rec.get('settings', {})}
+        jobs.append(job)
+
+    # Check for overlapping results directories before starting any runs.
+    results_dirs = []
+    for job in jobs:
+        results_dir = job.get('results_dir', job['settings'].get('results_dir'))
+        if results_dir is None and job.get('filename') is not None:
+            results_dir = Path(job['filename']).parent / 'kilosort4'
+        if results_dir is not None:
+            results_dirs.append(Path(results_dir).resolve())
+    if len(set(results_dirs)) < len(results_dirs):
+        raise ValueError(
+            'Each recording must be saved to a different results directory, '
+            'specify `results_dir` for each recording.'
+            )
+
+    def run(job):
+        _thread_state.thread_only = True
+        try:
+            return run_kilosort(**job)
+        finally:
+            _thread_state.thread_only = False
+
+    if max_workers is None:
+        max_workers = len(jobs)
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1),
+                            thread_name_prefix='kilosort') as exe:
+        # Each job gets its own copy of the context, for `_log_run`.
+        futures = [exe.submit(contextvars.copy_context().run, run, job)
+                   for job in jobs]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                if not return_exceptions:
+                    # Wait for other runs before raising.
+                    exe.shutdown(wait=True)
+                    raise
+                results.append(e)
+
+    return results
+
+
 def set_files(settings, filename, probe, probe_name,
               data_dir, results_dir, bad_channels):
     """Parse file and directory information for data, probe, and results."""
@@ -311,6 +497,7 @@ def set_files(settings, filename, probe, probe_name,
         results_dir = data_dir / 'kilosort4'
     # Make sure results directory exists
     results_dir.mkdir(exist_ok=True)
+    settings['results_dir'] = results_dir
     
     # find probe configuration file and load
     if probe is None:
@@ -334,7 +521,94 @@ def set_files(settings, filename, probe, probe_name,
     return filename, data_dir, results_dir, probe
 
 
-def setup_logger(results_dir, verbose_console=False):
+def get_spikeglx_info(filename):
+    """Load settings from a SpikeGLX `.meta` file for `filename`, if present.
+
+    Returns None if there is no `.meta` file, or if it is missing required
+    values or has invalid ones, in which case a warning is logged.
+
+    """
+    if filename is None or io.find_spikeglx_meta(filename) is None:
+        return None
+    try:
+        return io.spikeglx_settings(filename)
+    except (KeyError, ValueError) as e:
+        logger.warning(
+            f'Could not read settings from the SpikeGLX .meta file for '
+            f'{filename}, missing or invalid value: {e}'
+            )
+        return None
+
+
+def check_spikeglx_info(settings, filename, probe, info):
+    """Compare settings to values from `get_spikeglx_info`.
+
+    Raises a ValueError if `n_chan_bin` does not match the number of saved
+    channels. Mismatched sampling rate, file size, or a sync channel included
+    in the probe are logged as warnings.
+
+    """
+    logger.info(f'Found SpikeGLX metadata for {filename}: {info}')
+    if settings['n_chan_bin'] != info['n_chan_bin']:
+        raise ValueError(
+            f"n_chan_bin = {settings['n_chan_bin']} does not match "
+            f"nSavedChans = {info['n_chan_bin']} in the SpikeGLX .meta file."
+            )
+    if not np.isclose(settings['fs'], info['fs'], rtol=1e-3):
+        logger.warning(
+            f"fs = {settings['fs']} does not match the sampling rate of "
+            f"{info['fs']} in the SpikeGLX .meta file."
+            )
+    if info['n_samples'] is not None and Path(filename).suffix != '.ksc':
+        n_bytes = Path(filename).stat().st_size - settings['byte_offset']
+        if n_bytes != info['n_samples'] * 2 * info['n_chan_bin']:
+            logger.warning(
+                f'Binary file has {n_bytes} bytes of data, but the SpikeGLX '
+                f".meta file specifies {info['n_samples']} samples. The "
+                'recording may be incomplete.'
+                )
+    sync = info['sync_channel']
+    if sync is not None and sync in np.asarray(probe['chanMap']):
+        logger.warning(
+            f'Channel {sync} is the sync channel according to the SpikeGLX '
+            '.meta file, but it is included in the probe chanMap.'
+            )
+
+
+# Identifies the sorting run that log records belong to. Worker threads
+# started with `contextvars.copy_context().run` inherit the run of the
+# thread that started them.
+_log_run = contextvars.ContextVar('kilosort_log_run', default=None)
+
+
+class _RunFilter(logging.Filter):
+    """Only keep log records from the run that created the filter."""
+
+    def __init__(self, run):
+        super().__init__()
+        self.run = run
+
+    def filter(self, record):
+        return _log_run.get() is self.run
+
+
+class _NoRunFilter(logging.Filter):
+    """Only keep log records that don't belong to a thread-only run."""
+
+    def filter(self, record):
+        return _log_run.get() is None
+
+
+def setup_logger(results_dir, verbose_console=False, thread_only=False):
+    """Add file and console handlers to the Kilosort logger.
+
+    If `thread_only` is True, new handlers are always added, only records
+    from the calling thread (and worker threads started with a copy of its
+    context) are handled, and console output is prefixed with the name of
+    `results_dir`. The handlers are returned so they can be
+    removed with `close_logger`.
+
+    """
     results_dir = Path(results_dir)
     
     # Get root logger for Kilosort application
@@ -343,7 +617,7 @@ def setup_logger(results_dir, verbose_console=False):
 
     # Skip this if the handlers were already added, like when running multiple
     # times in a single session.
-    if not ks_log.handlers:
+    if not thread_only and not ks_log.handlers:
         # Add file handler at debug level, include timestamps and logging level
         # in text output.
         file = logging.FileHandler(results_dir / 'kilosort4.log', mode='w')
@@ -366,15 +640,54 @@ def setup_logger(results_dir, verbose_console=False):
         ks_log.addHandler(file)
         ks_log.addHandler(console)
 
+    if thread_only:
+        # Handlers added by an earlier run that wasn't thread-only would also
+        # get records from this run, like writing to that run's log file.
+        for handler in ks_log.handlers:
+            if not any(isinstance(f, (_RunFilter, _NoRunFilter))
+                       for f in handler.filters):
+                handler.addFilter(_NoRunFilter())
+
+        text_format = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+        file = logging.FileHandler(results_dir / 'kilosort4.log', mode='w')
+        file.setLevel(logging.DEBUG)
+        file.setFormatter(logging.Formatter(text_format))
+
+        console = logging.StreamHandler()
+        prefix = f'[{results_dir.name}] '
+        if verbose_console:
+            console.setLevel(logging.DEBUG)
+            console.setFormatter(logging.Formatter(prefix + text_format))
+        else:
+            console.setLevel(logging.INFO)
+            console.setFormatter(
+                logging.Formatter(prefix + '%(name)-12s: %(message)s')
+                )
+
+        run = object()
+        _log_run.set(run)
+        handlers = [file, console]
+        for handler in handlers:
+            handler.addFilter(_RunFilter(run))
+            ks_log.addHandler(handler)
+        return handlers
+
 
-def close_logger():
+def close_logger(handlers=None):
+    """Close Kilosort log handlers, and remove them if given explicitly."""
     ks_log = logging.getLogger('kilosort')
-    for handler in ks_log.handlers:
-        handler.close()
+    if handlers is None:
+        for handler in ks_log.handlers:
+            handler.close()
+    else:
+        for handler in handlers:
+            ks_log.removeHandler(handler)
+            handler.close()
 
 
 def initialize_ops(settings, probe, data_dtype, do_CAR, invert_sign,
-                   device, save_preprocessed_copy) -> dict:
+                   device, save_preprocessed_copy,
+                   preprocessed_dtype='int16') -> dict:
     """Package settings and probe information into a single `ops` dictionary."""
 
     if settings['nt0min'] is None:
@@ -427,6 +740,7 @@ def initialize_ops(settings, probe, data_dtype, do_CAR, invert_sign,
     ops['duplicate_spike_bins'] = dup_bins
     ops['torch_device'] = str(device)
     ops['save_preprocessed_copy'] = save_preprocessed_copy
+    ops['preprocessed_dtype'] = preprocessed_dtype
 
     if not settings['templates_from_data'] and settings['nt'] != 61:
         raise ValueError('If using pre-computed universal templates '
@@ -455,7 +769,8 @@ def get_run_parameters(ops) -> list:
         ops['settings']['tmax'],
         ops['settings']['artifact_threshold'],
         ops['settings']['shift'],
-        ops['settings']['scale']
+        ops['settings']['scale'],
+        ops['settings'].get('byte_offset', 0)
     ]
 
     return parameters
@@ -489,9 +804,10 @@ def compute_preprocessing(ops, device, tic0=np.nan, file_object=None):
     logger.info('-'*40)
 
     n_chan_bin, fs, NT, nt, twav_min, chan_map, dtype, do_CAR, invert, \
-        xc, yc, tmin, tmax, artifact, shift, scale = get_run_parameters(ops)
+        xc, yc, tmin, tmax, artifact, shift, scale, offset = get_run_parameters(ops)
     nskip = ops['settings']['nskip']
     whitening_range = ops['settings']['whitening_range']
+    car_method = ops['settings']['car_method']
  
     # Compute high pass filter
     cutoff = ops['settings']['highpass_cutoff']
@@ -501,14 +817,21 @@ def compute_preprocessing(ops, device, tic0=np.nan, file_object=None):
                               chan_map, hp_filter, device=device, do_CAR=do_CAR,
                               invert_sign=invert, dtype=dtype, tmin=tmin,
                               tmax=tmax, artifact_threshold=artifact,
-                              shift=shift, scale=scale, file_object=file_object)
+                              shift=shift, scale=scale, file_object=file_object,
+                              prefetch=ops['settings']['prefetch_batches'],
+                              offset=offset, car_method=car_method,
+                              car_groups=ops['probe']['kcoords'],
+                              fused=ops['settings']['fused_preprocessing'])
 
     logger.info(f'N samples: {bfile.n_samples}')
     logger.info(f'N seconds: {bfile.n_samples/fs}')
     logger.info(f'N batches: {bfile.n_batches}')
 
-    whiten_mat = preprocessing.get_whitening_matrix(bfile, xc, yc, nskip=nskip,
-                                                    nrange=whitening_range)
+    whiten_mat = preprocessing.get_whitening_matrix(
+        bfile, xc, yc, nskip=nskip, nrange=whitening_range,
+        tol=ops['settings']['whitening_tol'],
+        max_batches=ops['settings']['whitening_max_batches']
+        )
 
     bfile.close()
 
@@ -556,7 +879,8 @@ def compute_drift_correction(ops, device, tic0=np.nan, progress_bar=None,
     ops : dict
         Dictionary storing settings and results for all algorithmic steps.
     bfile : kilosort.io.BinaryFiltered
-        Wrapped file object for handling data.
+        Wrapped file object for handling data. None if `stop_after_motion`
+        is True and MEDiCINe was used for drift correction.
     st0 : np.ndarray.
         Intermediate spike times variable with 6 columns. This is only used
         for generating the 'Drift Scatter' plot through the GUI.
@@ -569,9 +893,16 @@ def compute_drift_correction(ops, device, tic0=np.nan, progress_bar=None,
     logger.info('-'*40)
 
     n_chan_bin, fs, NT, nt, twav_min, chan_map, dtype, do_CAR, invert, \
-        _, _, tmin, tmax, artifact, shift, scale = get_run_parameters(ops)
+        _, _, tmin, tmax, artifact, shift, scale, offset = get_run_parameters(ops)
     hp_filter = ops['preprocessing']['hp_filter']
     whiten_mat = ops['preprocessing']['whiten_mat']
+    prefetch = ops['settings']['prefetch_batches']
+    car_method = ops['settings']['car_method']
+    car_groups = ops['probe']['kcoords']
+    fused = ops['settings']['fused_preprocessing']
+    cache = io.batch_cache_from_ops(ops)
+    if cache is not None:
+        logger.info(f'Caching preprocessed batches in {cache.cache_dir}')
 
     if with_whitening:
         bfile = io.BinaryFiltered(
@@ -579,7 +910,9 @@ def compute_drift_correction(ops, device, tic0=np.nan, progress_bar=None,
             hp_filter=hp_filter, whiten_mat=whiten_mat, device=device, do_CAR=do_CAR,
             invert_sign=invert, dtype=dtype, tmin=tmin, tmax=tmax,
             artifact_threshold=artifact, shift=shift, scale=scale,
-            file_object=file_object
+            file_object=file_object, prefetch=prefetch, cache=cache,
+            offset=offset, car_method=car_method, car_groups=car_groups,
+            fused=fused
             )
     else:
         logger.info('NO WHITENING.')
@@ -588,7 +921,9 @@ def compute_drift_correction(ops, device, tic0=np.nan, progress_bar=None,
             hp_filter=hp_filter, whiten_mat=None, device=device, do_CAR=do_CAR,
             invert_sign=invert, dtype=dtype, tmin=tmin, tmax=tmax,
             artifact_threshold=artifact, shift=shift, scale=scale,
-            file_object=file_object
+            file_object=file_object, prefetch=prefetch, cache=cache,
+            offset=offset, car_method=car_method, car_groups=car_groups,
+            fused=fused
             )
 
 
@@ -598,9 +933,6 @@ def compute_drift_correction(ops, device, tic0=np.nan, progress_bar=None,
     else:
         ops, st = datashift.run_medicine(ops, bfile, device=device, progress_bar=progress_bar,
                                 clear_cache=clear_cache)
-        if stop_after_motion:
-            print("Stopping after motion correction as requested (stop_after_motion=True).")
-            sys.exit()
 
     bfile.close()
     logger.info(f'drift computed in {time.time()-tic : .2f}s; ' + 
@@ -610,6 +942,12 @@ def compute_drift_correction(ops, device, tic0=np.nan, progress_bar=None,
         logger.debug(f'yblk shape: {ops["yblk"].shape}')
         logger.debug(f'dshift shape: {ops["dshift"].shape}')
         logger.debug(f'iKxx shape: {ops["iKxx"].shape}')
+
+    if stop_after_motion and drift_correction_type not in ['kilosort', 'none']:
+        logger.info('Stopping after motion estimation (stop_after_motion=True).')
+        if cache is not None:
+            cache.close()
+        return ops, None, st
     
     # binary file with drift correction
     if with_whitening:
@@ -618,7 +956,9 @@ def compute_drift_correction(ops, device, tic0=np.nan, progress_bar=None,
             hp_filter=hp_filter, whiten_mat=whiten_mat, device=device,
             dshift=ops['dshift'], do_CAR=do_CAR, dtype=dtype, tmin=tmin, tmax=tmax,
             artifact_threshold=artifact, shift=shift, scale=scale,
-            file_object=file_object
+            file_object=file_object, prefetch=prefetch, cache=cache,
+            offset=offset, car_method=car_method, car_groups=car_groups,
+            fused=fused
             )
     else:
         logger.info('NO WHITENING.')
@@ -627,7 +967,9 @@ def compute_drift_correction(ops, device, tic0=np.nan, progress_bar=None,
             hp_filter=hp_filter, whiten_mat=None, device=device,
             dshift=ops['dshift'], do_CAR=do_CAR, dtype=dtype, tmin=tmin, tmax=tmax,
             artifact_threshold=artifact, shift=shift, scale=scale,
-            file_object=file_object
+            file_object=file_object, prefetch=prefetch, cache=cache,
+            offset=offset, car_method=car_method, car_groups=car_groups,
+            fused=fused
             )
 
 
@@ -875,7 +1217,8 @@ def save_sorting(ops, results_dir, st, clu, tF, Wall, imin, tic0=np.nan,
     return ops, similar_templates, is_ref, est_contam_rate, kept_spikes
 
 
-def load_sorting(results_dir, device=None, load_extra_vars=False):
+def load_sorting(results_dir, device=None, load_extra_vars=False,
+                 mmap_mode=None):
     '''Load saved sorting results into memory.
     
     Parameters
@@ -937,6 +1280,11 @@ def load_sorting(results_dir, device=None, load_extra_vars=False):
         Per-spike amplitudes, computed as the L2 norm of the PC features
         for each spike.
         Includes spikes removed by `kilosort.postprocessing.remove_duplicate_spikes`.
+
+    mmap_mode : str; optional.
+        If specified, results arrays are memory-mapped with `np.load` using
+        this mode (e.g. 'r') instead of being read into memory. See also
+        `kilosort.data_tools.SortingResults` for lazy access to all results.
     
     '''
     if device is None:
@@ -947,11 +1295,12 @@ def load_sorting(results_dir, device=None, load_extra_vars=False):
 
     results_dir = Path(results_dir)
     ops = io.load_ops(results_dir / 'ops.npy', device=device)
-    similar_templates = np.load(results_dir / 'similar_templates.npy')
+    similar_templates = np.load(results_dir / 'similar_templates.npy',
+                                mmap_mode=mmap_mode)
 
-    clu = np.load(results_dir / 'spike_clusters.npy')
-    st = np.load(results_dir / 'spike_times.npy')
-    kept_spikes = np.load(results_dir / 'kept_spikes.npy')
+    clu = np.load(results_dir / 'spike_clusters.npy', mmap_mode=mmap_mode)
+    st = np.load(results_dir / 'spike_times.npy', mmap_mode=mmap_mode)
+    kept_spikes = np.load(results_dir / 'kept_spikes.npy', mmap_mode=mmap_mode)
     acg_threshold = ops['settings']['acg_threshold']
     ccg_threshold = ops['settings']['ccg_threshold']
     is_ref, est_contam_rate = CCG.refract(clu, st / ops['fs'],
@@ -963,13 +1312,16 @@ def load_sorting(results_dir, device=None, load_extra_vars=False):
 
     if load_extra_vars:
         # NOTE: tF and Wall always go on CPU, not CUDA
-        tF = np.load(results_dir / 'tF.npy')
-        tF = torch.from_numpy(tF)
-        Wall = np.load(results_dir / 'Wall.npy')
-        Wall = torch.from_numpy(Wall)
-        full_st = np.load(results_dir / 'full_st.npy')
-        full_clu = np.load(results_dir / 'full_clu.npy')
-        full_amp = np.load(results_dir / 'full_amp.npy')
+        with warnings.catch_warnings():
+            # Read-only memory maps are never written to by `load_sorting`.
+            warnings.filterwarnings("ignore", message=io._torch_warning)
+            tF = np.load(results_dir / 'tF.npy', mmap_mode=mmap_mode)
+            tF = torch.from_numpy(tF)
+            Wall = np.load(results_dir / 'Wall.npy', mmap_mode=mmap_mode)
+            Wall = torch.from_numpy(Wall)
+        full_st = np.load(results_dir / 'full_st.npy', mmap_mode=mmap_mode)
+        full_clu = np.load(results_dir / 'full_clu.npy', mmap_mode=mmap_mode)
+        full_amp = np.load(results_dir / 'full_amp.npy', mmap_mode=mmap_mode)
         results.extend([tF, Wall, full_st, full_clu, full_amp])
 
     return results
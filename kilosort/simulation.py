@@ -684,3 +684,105 @@ def hybrid_simulation(filename_bg, sim_name, n_batches_sim=1350,
 
     return data, params
 
+
+
+def match_spikes(st0, st, dt=6):
+    """Pair spike times in `st` with spike times in `st0`, within `dt`.
+
+    Spikes are matched one-to-one in time order, so repeated spike times
+    (e.g. spikes on different channels) are each matched once.
+
+    Returns
+    -------
+    i0, i : np.ndarray
+        Indices into `st0` and `st` of matched spikes.
+
+    """
+    isort0 = np.argsort(st0, kind='stable')
+    isort = np.argsort(st, kind='stable')
+    a, b = st0[isort0], st[isort]
+    i0, i = [], []
+    j = k = 0
+    while j < len(a) and k < len(b):
+        if abs(a[j] - b[k]) <= dt:
+            i0.append(j)
+            i.append(k)
+            j += 1
+            k += 1
+        elif a[j] < b[k]:
+            j += 1
+        else:
+            k += 1
+    return isort0[np.array(i0, dtype=int)], isort[np.array(i, dtype=int)]
+
+
+def compare_precision(filename, probe, settings, results_dir,
+                      precisions=('bfloat16',), gt_path=None, dt=6,
+                      **run_kwargs):
+    """Compare sorting with reduced-precision convolutions to float32.
+
+    Sorts `filename` once for each value of the `precision` setting,
+    including 'float32' as the reference, and reports how well detected
+    spikes and cluster assignments agree with the float32 results. Intended
+    for use with recordings from `create_simulation` or `hybrid_simulation`,
+    but any recording can be used.
+
+    Parameters
+    ----------
+    filename, probe, settings
+        Passed to `run_kilosort`.
+    results_dir : str or Path
+        Results for each precision are saved to a subfolder with that name.
+    precisions : list of str; default=('bfloat16',).
+        Values of the `precision` setting to compare to 'float32'.
+    gt_path : str or Path; optional.
+        Ground truth '_params.npz' file saved by `hybrid_simulation`. If
+        given, the fraction of ground truth spikes detected is also reported.
+    dt : int; default=6.
+        Spikes within this many samples of each other are considered a match.
+    **run_kwargs
+        Additional keyword arguments for `run_kilosort`.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per precision, with run time, number of spikes and clusters,
+        fraction of float32 spikes detected ('recall'), fraction of spikes
+        matching a float32 spike ('precision_frac'), adjusted rand index of
+        cluster labels for matched spikes ('cluster_ari') and, if `gt_path`
+        is given, fraction of ground truth spikes detected ('gt_recall').
+
+    """
+    from sklearn.metrics import adjusted_rand_score
+    from kilosort.run_kilosort import run_kilosort
+
+    if gt_path is not None:
+        st_gt = np.load(gt_path)['st'].astype('int64')
+
+    os.makedirs(results_dir, exist_ok=True)
+    results = {}
+    for p in ['float32'] + [p for p in precisions if p != 'float32']:
+        tic = time.time()
+        out = run_kilosort(
+            settings={**settings, 'precision': p}, probe=probe,
+            filename=filename, results_dir=os.path.join(results_dir, p),
+            **run_kwargs
+            )
+        results[p] = (out[1][:, 0].astype('int64'), out[2], time.time() - tic)
+
+    st0, clu0, _ = results['float32']
+    rows = []
+    for p, (st, clu, t) in results.items():
+        i0, i = match_spikes(st0, st, dt=dt)
+        row = {
+            'precision': p, 'time': t, 'n_spikes': len(st),
+            'n_clusters': len(np.unique(clu)),
+            'recall': len(i0) / max(len(st0), 1),
+            'precision_frac': len(i) / max(len(st), 1),
+            'cluster_ari': adjusted_rand_score(clu0[i0], clu[i])
+            }
+        if gt_path is not None:
+            row['gt_recall'] = len(match_spikes(st_gt, st, dt=dt)[0]) / len(st_gt)
+        rows.append(row)
+
+    return pd.DataFrame(rows).set_index('precision')
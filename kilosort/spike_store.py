@@ -0,0 +1,191 @@
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SpikeStore:
+    """Append-only table of spike properties, stored in fixed-size blocks.
+
+    Used by `spikedetect.run` and `template_matching.extract` to collect
+    spikes batch by batch. Appending never copies previously stored spikes,
+    and once the in-memory blocks reach `max_memory_gb`, new blocks are
+    memory-mapped to files in `scratch_dir` instead.
+
+    Parameters
+    ----------
+    columns : dict
+        Maps column name to `(shape, dtype)` for one spike, for example
+        `{'st': ((3,), 'float64'), 'tF': ((nC, n_pcs), 'float32')}`.
+    block_size : int; default=2**16.
+        Number of spikes per block.
+    max_memory_gb : float; default=np.inf.
+        Maximum size of blocks held in memory, in gigabytes.
+    scratch_dir : str or Path; optional.
+        Directory where blocks beyond `max_memory_gb` are stored. A temporary
+        sub-directory is created there, and removed by `close`. Required if
+        `max_memory_gb` is finite.
+
+    Examples
+    --------
+    >>> store = SpikeStore({'t': ((), 'float64'), 'amp': ((), 'float32')})
+    >>> t = np.array([3., 1.])
+    >>> store.append(sort_key=t, t=t, amp=np.array([10., 20.]))
+    >>> t = np.array([2.])
+    >>> store.append(sort_key=t, t=t, amp=np.array([30.]))
+    >>> store.to_arrays(sort=True)['amp']
+    array([20., 30., 10.], dtype=float32)
+
+    """
+
+    def __init__(self, columns, block_size=2**16, max_memory_gb=np.inf,
+                 scratch_dir=None):
+        self.columns = {
+            name: (tuple(shape), np.dtype(dtype))
+            for name, (shape, dtype) in columns.items()
+            }
+        self.block_size = int(block_size)
+        self.max_bytes = max_memory_gb * 1024**3
+        self.row_bytes = sum(
+            int(np.prod(shape)) * dtype.itemsize
+            for shape, dtype in self.columns.values()
+            )
+        self.scratch_root = scratch_dir
+        self._scratch = None
+        self.blocks = []
+        self.sort_keys = []
+        self.n_spikes = 0
+        self.memory_bytes = 0
+
+    def __len__(self):
+        return self.n_spikes
+
+    def _new_block(self):
+        block_bytes = self.block_size * self.row_bytes
+        if self.memory_bytes + block_bytes <= self.max_bytes:
+            block = {
+                name: np.empty((self.block_size, *shape), dtype=dtype)
+                for name, (shape, dtype) in self.columns.items()
+                }
+            self.memory_bytes += block_bytes
+        else:
+            if self._scratch is None:
+                if self.scratch_root is None:
+                    raise ValueError(
+                        'SpikeStore exceeded `max_memory_gb`, but no '
+                        '`scratch_dir` was specified.'
+                        )
+                Path(self.scratch_root).mkdir(parents=True, exist_ok=True)
+                self._scratch = Path(tempfile.mkdtemp(dir=self.scratch_root))
+                logger.info(f'Storing spikes on disk in {self._scratch}')
+            i = len(self.blocks)
+            block = {
+                name: np.lib.format.open_memmap(
+                    self._scratch / f'{name}_{i}.npy', mode='w+',
+                    dtype=dtype, shape=(self.block_size, *shape)
+                    )
+                for name, (shape, dtype) in self.columns.items()
+                }
+        self.blocks.append(block)
+
+    def append(self, sort_key=None, **arrays):
+        """Add spikes to the store.
+
+        Parameters
+        ----------
+        sort_key : np.ndarray; optional.
+            Values used to order spikes in `to_arrays`, like spike times. If
+            given, spikes are sorted by this key before they are stored.
+        **arrays
+            One array per column, with spikes along the first dimension.
+
+        """
+        n = len(next(iter(arrays.values())))
+        if sort_key is not None:
+            isort = np.argsort(sort_key, kind='stable')
+            arrays = {k: v[isort] for k, v in arrays.items()}
+            self.sort_keys.append(np.asarray(sort_key)[isort])
+
+        i = 0
+        while i < n:
+            k = self.n_spikes % self.block_size
+            if k == 0 and self.n_spikes // self.block_size == len(self.blocks):
+                self._new_block()
+            block = self.blocks[-1]
+            m = min(n - i, self.block_size - k)
+            for name, v in arrays.items():
+                block[name][k : k+m] = v[i : i+m]
+            i += m
+            self.n_spikes += m
+
+    def to_arrays(self, sort=False):
+        """Get all stored spikes as a dictionary of contiguous arrays.
+
+        Parameters
+        ----------
+        sort : bool; default=False.
+            If True, spikes are ordered by the `sort_key` values given to
+            `append`. Otherwise, spikes are returned in the order they were
+            appended.
+
+        """
+        n = self.n_spikes
+        out = {
+            name: np.empty((n, *shape), dtype=dtype)
+            for name, (shape, dtype) in self.columns.items()
+            }
+
+        if not sort:
+            for i, block in enumerate(self.blocks):
+                a = i * self.block_size
+                b = min(a + self.block_size, n)
+                for name in out:
+                    out[name][a:b] = block[name][:b-a]
+            return out
+
+        if sum(k.size for k in self.sort_keys) != n:
+            raise ValueError('`sort_key` must be given for every append.')
+        # Each append is already sorted, so this is a k-way merge of sorted
+        # runs (numpy's stable sort detects and merges existing runs).
+        isort = np.argsort(np.concatenate(self.sort_keys), kind='stable')
+        for a in range(0, n, self.block_size):
+            idx = isort[a : a+self.block_size]
+            block_ids = idx // self.block_size
+            rows = idx % self.block_size
+            for j in np.unique(block_ids):
+                mask = block_ids == j
+                for name in out:
+                    out[name][a : a+idx.size][mask] = self.blocks[j][name][rows[mask]]
+
+        return out
+
+    def close(self):
+        """Release blocks and delete any files in `scratch_dir`."""
+        self.blocks = []
+        self.sort_keys = []
+        self.memory_bytes = 0
+        if self._scratch is not None:
+            shutil.rmtree(self._scratch, ignore_errors=True)
+            self._scratch = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def spike_store_from_ops(ops, columns):
+    """Create a SpikeStore using memory limit and scratch directory in `ops`."""
+    settings = ops['settings']
+    results_dir = settings.get('results_dir', None)
+    if results_dir is None:
+        results_dir = Path(settings['data_dir']) / 'kilosort4'
+    return SpikeStore(
+        columns, max_memory_gb=settings.get('max_spike_memory_gb', np.inf),
+        scratch_dir=Path(results_dir) / '.spike_store'
+        )
@@ -1,5 +1,6 @@
 import os
 import logging
+from functools import lru_cache
 import warnings
 logger = logging.getLogger(__name__)
 
@@ -10,7 +11,8 @@ from sklearn.cluster import KMeans
 from sklearn.decomposition import TruncatedSVD
 from tqdm import tqdm
 
-from kilosort.utils import template_path, log_performance
+from kilosort.utils import template_path, log_performance, compute_dtype, run_rng
+from kilosort.spike_store import spike_store_from_ops
 
 
 def my_max2d(X, dt):
@@ -51,8 +53,7 @@ def extract_wPCA_wTEMP(ops, bfile, nt=61, twav_min=20, Th_single_ch=6, nskip=25,
 
     clips = np.zeros((500000,nt), 'float32')
     i = 0
-    for j in range(0, bfile.n_batches, nskip):
-        X = bfile.padded_batch_to_torch(j, ops)
+    for X in bfile.iter_batches(range(0, bfile.n_batches, nskip), ops=ops):
         
         clips_new = extract_snippets(X, nt=nt, twav_min=twav_min,
                                      Th_single_ch=Th_single_ch, device=device)
@@ -68,26 +69,34 @@ def extract_wPCA_wTEMP(ops, bfile, nt=61, twav_min=20, Th_single_ch=6, nskip=25,
     clips = clips[:i]
     clips /= (clips**2).sum(1, keepdims=True)**.5
 
-    model = TruncatedSVD(n_components=ops['settings']['n_pcs']).fit(clips)
-    wPCA = torch.from_numpy(model.components_).to(device).float()
-
-    with warnings.catch_warnings():
-        warnings.filterwarnings("ignore", message="")
-        # Prevents memory leak for KMeans when using MKL on Windows
-        msg = 'KMeans is known to have a memory leak on Windows with MKL'
-        nthread = os.environ.get('OMP_NUM_THREADS', msg)
-        os.environ['OMP_NUM_THREADS'] = '7'
-        model = KMeans(n_clusters=ops['settings']['n_templates'], n_init = 10).fit(clips)
-        wTEMP = torch.from_numpy(model.cluster_centers_).to(device).float()
-        wTEMP = wTEMP / (wTEMP**2).sum(1).unsqueeze(1)**.5
-        os.environ['OMP_NUM_THREADS'] = nthread
+    # TruncatedSVD and KMeans use the global numpy generator
+    with run_rng():
+        model = TruncatedSVD(n_components=ops['settings']['n_pcs']).fit(clips)
+        wPCA = torch.from_numpy(model.components_).to(device).float()
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="")
+            # Prevents memory leak for KMeans when using MKL on Windows
+            msg = 'KMeans is known to have a memory leak on Windows with MKL'
+            nthread = os.environ.get('OMP_NUM_THREADS', msg)
+            os.environ['OMP_NUM_THREADS'] = '7'
+            model = KMeans(n_clusters=ops['settings']['n_templates'], n_init = 10).fit(clips)
+            wTEMP = torch.from_numpy(model.cluster_centers_).to(device).float()
+            wTEMP = wTEMP / (wTEMP**2).sum(1).unsqueeze(1)**.5
+            os.environ['OMP_NUM_THREADS'] = nthread
 
     return wPCA, wTEMP
 
+@lru_cache(maxsize=1)
+def _load_universal_templates(path):
+    # Loaded once per process, then shared by all sorting runs.
+    dd = np.load(path)
+    return dd['wPCA'], dd['wTEMP']
+
 def get_waves(ops, device=torch.device('cuda')):
-    dd = np.load(template_path())
-    wTEMP = torch.from_numpy(dd['wTEMP']).to(device)
-    wPCA = torch.from_numpy(dd['wPCA']).to(device)
+    wPCA, wTEMP = _load_universal_templates(template_path())
+    wTEMP = torch.from_numpy(wTEMP).to(device, copy=True)
+    wPCA = torch.from_numpy(wPCA).to(device, copy=True)
     return wPCA, wTEMP
 
 def template_centers(ops):
@@ -132,8 +141,13 @@ def template_match(X, ops, iC, iC2, weigh, device=torch.device('cuda')):
     niter = 40
     nb = (NT-1)//niter+1
 
-    W = ops['wTEMP'].unsqueeze(1)
-    B = conv1d(X.unsqueeze(1), W, padding=nt//2)
+    # The convolution is done in `precision` (X is usually already converted
+    # by `bfile`), and so is its output B. B is converted to float32 one chunk
+    # at a time before projecting onto templates, since rounded projections
+    # would cause ties between neighboring peaks.
+    dtype = compute_dtype(ops)
+    W = ops['wTEMP'].unsqueeze(1).to(dtype)
+    B = conv1d(X.to(dtype).unsqueeze(1), W, padding=nt//2)
     As    = torch.zeros((Nfilt, NT), device=device)
     Amaxs = torch.zeros((Nfilt, NT), device=device)
     imaxs = torch.zeros((Nfilt, NT), dtype = torch.int64, device=device)
@@ -141,7 +155,7 @@ def template_match(X, ops, iC, iC2, weigh, device=torch.device('cuda')):
     tj = torch.arange(nb, device = device)
 
     for t in range(niter):
-        A = torch.einsum('ijk, jklm-> iklm', weigh, B[iC,:, nb*t:nb*(t+1)])        
+        A = torch.einsum('ijk, jklm-> iklm', weigh, B[iC,:, nb*t:nb*(t+1)].float())
         A = A.transpose(1,2)
         A = A.reshape(-1, Nfilt, A.shape[-1])
         
@@ -163,7 +177,7 @@ def template_match(X, ops, iC, iC2, weigh, device=torch.device('cuda')):
 
     ssign = imax.sign()
     imax = imax.abs()-1
-    adist = B[iC[:, xy[:,0]], imax%nk, xy[:,1]] * ssign
+    adist = B[iC[:, xy[:,0]], imax%nk, xy[:,1]].float() * ssign
 
     #adist = B[iC[:, xy[:,0]], imax%nk, xy[:,1]] 
     
@@ -190,7 +204,12 @@ def yweighted(yc, iC, adist, xy, device=torch.device('cuda')):
     return yct
 
 def run(ops, bfile, device=torch.device('cuda'), progress_bar=None,
-        clear_cache=False):        
+        clear_cache=False, batch_indices=None):
+    """Detect spikes in `bfile` using universal templates.
+
+    If `batch_indices` is specified, only those batches are used. Column 4
+    of the returned spike array is the index of the batch in `bfile`.
+    """
     sig = ops['settings']['min_template_size']
     nsizes = ops['settings']['template_sizes'] 
 
@@ -234,61 +253,64 @@ def run(ops, bfile, device=torch.device('cuda'), progress_bar=None,
     weigh = torch.permute(weigh, (2, 0, 1)).contiguous()
     weigh = weigh / (weigh**2).sum(1).unsqueeze(1)**.5
 
-    st = np.zeros((10**6, 6), 'float64')
-    tF = np.zeros((10**6, nC , ops['settings']['n_pcs']), 'float32')
-
-    k = 0
-    nt = ops['nt']
-    tarange = torch.arange(-(nt//2),nt//2+1, device = device)
-    logger.info('Detecting spikes...')
-    prog = tqdm(np.arange(bfile.n_batches), miniters=200 if progress_bar else None, 
-                mininterval=60 if progress_bar else None)
-    # repeat performance log after every 10 minutes of data
-    log_skip = int(600 / (ops['batch_size'] / ops['fs']))
-    try:
-        for ibatch in prog:
-            if ibatch % log_skip == 0:
-                log_performance(logger, 'debug', f'Batch {ibatch}')
-
-            X = bfile.padded_batch_to_torch(ibatch, ops)
-            xy, imax, amp, adist = template_match(X, ops, iC, iC2, weigh, device=device)
-            yct = yweighted(yc, iC, adist, xy, device=device)
-            nsp = len(xy)
-
-            if k+nsp>st.shape[0]:
-                st = np.concatenate((st, np.zeros_like(st)), 0)
-                tF = np.concatenate((tF, np.zeros_like(tF)), 0)
-
-            xsub = X[iC[:,xy[:,:1]], xy[:,1:2] + tarange]
-            xfeat = xsub @ ops['wPCA'].T
-            tF[k:k+nsp] = xfeat.transpose(0,1).cpu().numpy()
-
-            st[k:k+nsp,0] = ((xy[:,1].cpu().numpy()-nt)/ops['fs'] + ibatch * (ops['batch_size']/ops['fs']))
-            st[k:k+nsp,1] = yct.cpu().numpy()
-            st[k:k+nsp,2] = amp.cpu().numpy()
-            st[k:k+nsp,3] = imax.cpu().numpy()
-            st[k:k+nsp,4] = ibatch
-            st[k:k+nsp,5] = xy[:,0].cpu().numpy()
-
-            k = k + nsp
-            
-            if progress_bar is not None:
-                progress_bar.emit(int((ibatch+1) / bfile.n_batches * 100))
-    except:
-        logger.exception(f'Error in spikedetect.run on batch {ibatch}')
+    # the store is closed (removing any spilled files) even if a batch fails
+    with spike_store_from_ops(ops, {
+        'st': ((6,), 'float64'),
+        'tF': ((nC, ops['settings']['n_pcs']), 'float32')
+        }) as store:
+
+        nt = ops['nt']
+        tarange = torch.arange(-(nt//2),nt//2+1, device = device)
+        logger.info('Detecting spikes...')
+        if batch_indices is None:
+            batch_indices = np.arange(bfile.n_batches)
+        n_batches = len(batch_indices)
+        prog = tqdm(batch_indices, miniters=200 if progress_bar else None, 
+                    mininterval=60 if progress_bar else None)
+        # repeat performance log after every 10 minutes of data
+        log_skip = int(600 / (ops['batch_size'] / ops['fs']))
         try:
-            logger.debug(f'X shape: {X.shape}')
-            logger.debug(f'xy shape: {xy.shape}')
-        except UnboundLocalError:
-            # Error happened before one or both of these was assigned,
-            # no need to raise an additional error for this.
-            pass
-        raise
+            for i, (ibatch, X) in enumerate(
+                    zip(prog, bfile.iter_batches(batch_indices, ops=ops,
+                                                 out_dtype=compute_dtype(ops)))):
+                if ibatch % log_skip == 0:
+                    log_performance(logger, 'debug', f'Batch {ibatch}')
+
+                xy, imax, amp, adist = template_match(X, ops, iC, iC2, weigh, device=device)
+                yct = yweighted(yc, iC, adist, xy, device=device)
+                nsp = len(xy)
+
+                xsub = X[iC[:,xy[:,:1]], xy[:,1:2] + tarange]
+                xfeat = xsub.float() @ ops['wPCA'].T
+                tF = xfeat.transpose(0,1).cpu().numpy()
+
+                st = np.zeros((nsp, 6), 'float64')
+                st[:,0] = ((xy[:,1].cpu().numpy()-nt)/ops['fs'] + ibatch * (ops['batch_size']/ops['fs']))
+                st[:,1] = yct.cpu().numpy()
+                st[:,2] = amp.cpu().numpy()
+                st[:,3] = imax.cpu().numpy()
+                st[:,4] = ibatch
+                st[:,5] = xy[:,0].cpu().numpy()
+                store.append(st=st, tF=tF)
+            
+                if progress_bar is not None:
+                    progress_bar.emit(int((i+1) / n_batches * 100))
+        except:
+            logger.exception(f'Error in spikedetect.run on batch {ibatch}')
+            try:
+                logger.debug(f'X shape: {X.shape}')
+                logger.debug(f'xy shape: {xy.shape}')
+            except UnboundLocalError:
+                # Error happened before one or both of these was assigned,
+                # no need to raise an additional error for this.
+                pass
+            raise
             
-    log_performance(logger, 'debug', f'Batch {ibatch}')
+        log_performance(logger, 'debug', f'Batch {ibatch}')
 
-    st = st[:k]
-    tF = tF[:k]
+        spikes = store.to_arrays()
+    st = spikes['st']
+    tF = spikes['tF']
     ops['iC'] = iC
     ops['iC2'] = iC2
     ops['weigh'] = weigh
@@ -6,7 +6,8 @@ from torch.nn.functional import conv1d, max_pool2d, max_pool1d
 from tqdm import tqdm
 
 from kilosort import CCG
-from kilosort.utils import log_performance
+from kilosort.utils import log_performance, compute_dtype
+from kilosort.spike_store import spike_store_from_ops
 
 logger = logging.getLogger(__name__)
 
@@ -66,61 +67,60 @@ def extract(ops, bfile, U, device=torch.device('cuda'), progress_bar=None):
     
     tiwave = torch.arange(-(nt//2), nt//2+1, device=device) 
     ctc = prepare_matching(ops, U)
-    st = np.zeros((10**6, 3), 'float64')
-    tF  = torch.zeros((10**6, nC , ops['settings']['n_pcs']))
-    k = 0
-    prog = tqdm(
-        np.arange(bfile.n_batches, dtype=np.int64),
-        miniters=200 if progress_bar else None, 
-        mininterval=60 if progress_bar else None
-        )
+    # the store is closed (removing any spilled files) even if a batch fails
+    with spike_store_from_ops(ops, {
+        'st': ((3,), 'float64'),
+        'tF': ((nC, ops['settings']['n_pcs']), 'float32')
+        }) as store:
+        prog = tqdm(
+            np.arange(bfile.n_batches, dtype=np.int64),
+            miniters=200 if progress_bar else None, 
+            mininterval=60 if progress_bar else None
+            )
     
-    try:
-        for ibatch in prog:
-            if ibatch % 100 == 0:
-                log_performance(logger, 'debug', f'Batch {ibatch}')
-
-            X = bfile.padded_batch_to_torch(ibatch, ops)
-            stt, amps, th_amps, Xres = run_matching(ops, X, U, ctc, device=device)
-            xfeat = Xres[iCC[:, iU[stt[:,1:2]]],stt[:,:1] + tiwave] @ ops['wPCA'].T
-            xfeat += amps * Ucc[:,stt[:,1]]
-
-            if ibatch == 0:
-                # Can sometimes get negative spike times for first batch since
-                # we're aligning to nt0min, not nt//2, but these should be discarded.
-                neg_spikes = (stt[:,0] - nt - nt//2 + ops['nt0min']) < 0
-                stt = stt[~neg_spikes,:]
-                xfeat = xfeat[:,~neg_spikes,:]
-                amps = amps[~neg_spikes,:]
-                th_amps = th_amps[~neg_spikes,:]
-
-            nsp = len(stt) 
-            if k+nsp>st.shape[0]:                     
-                st = np.concatenate((st, np.zeros_like(st)), 0)
-                tF  = torch.cat((tF,  torch.zeros_like(tF)), 0)
-
-            stt = stt.double()
-            st[k:k+nsp,0] = ((stt[:,0]-nt) + ibatch * (ops['batch_size'])).cpu().numpy() - nt//2 + ops['nt0min']
-            st[k:k+nsp,1] = stt[:,1].cpu().numpy()
-            st[k:k+nsp,2] = th_amps.cpu().numpy().squeeze()
+        try:
+            batches = bfile.iter_batches(ops=ops, out_dtype=compute_dtype(ops))
+            for ibatch, X in zip(prog, batches):
+                if ibatch % 100 == 0:
+                    log_performance(logger, 'debug', f'Batch {ibatch}')
+
+                stt, amps, th_amps, Xres = run_matching(ops, X, U, ctc, device=device)
+                xfeat = Xres[iCC[:, iU[stt[:,1:2]]],stt[:,:1] + tiwave] @ ops['wPCA'].T
+                xfeat += amps * Ucc[:,stt[:,1]]
+
+                if ibatch == 0:
+                    # Can sometimes get negative spike times for first batch since
+                    # we're aligning to nt0min, not nt//2, but these should be discarded.
+                    neg_spikes = (stt[:,0] - nt - nt//2 + ops['nt0min']) < 0
+                    stt = stt[~neg_spikes,:]
+                    xfeat = xfeat[:,~neg_spikes,:]
+                    amps = amps[~neg_spikes,:]
+                    th_amps = th_amps[~neg_spikes,:]
+
+                nsp = len(stt) 
+                stt = stt.double()
+                st = np.zeros((nsp, 3), 'float64')
+                st[:,0] = ((stt[:,0]-nt) + ibatch * (ops['batch_size'])).cpu().numpy() - nt//2 + ops['nt0min']
+                st[:,1] = stt[:,1].cpu().numpy()
+                st[:,2] = th_amps.cpu().numpy().squeeze()
             
-            tF[k:k+nsp]  = xfeat.transpose(0,1).cpu()
-
-            k+= nsp
+                tF = xfeat.transpose(0,1).cpu().numpy()
+                store.append(sort_key=st[:,0], st=st, tF=tF)
             
-            if progress_bar is not None:
-                progress_bar.emit(int((ibatch+1) / bfile.n_batches * 100))
-    except:
-        logger.exception(f'Error in template_matching.extract on batch {ibatch}')
-        logger.debug(f'X shape: {X.shape}')
-        logger.debug(f'stt shape: {stt.shape}')
-        raise
+                if progress_bar is not None:
+                    progress_bar.emit(int((ibatch+1) / bfile.n_batches * 100))
+        except:
+            logger.exception(f'Error in template_matching.extract on batch {ibatch}')
+            logger.debug(f'X shape: {X.shape}')
+            logger.debug(f'stt shape: {stt.shape}')
+            raise
 
-    log_performance(logger, 'debug', f'Batch {ibatch}')
+        log_performance(logger, 'debug', f'Batch {ibatch}')
 
-    isort = np.argsort(st[:k,0])
-    st = st[isort]
-    tF = tF[isort]
+        # Spikes are sorted by time
+        spikes = store.to_arrays(sort=True)
+    st = spikes['st']
+    tF = torch.from_numpy(spikes['tF'])
 
     return st, tF, ops
 
@@ -174,8 +174,18 @@ def run_matching(ops, X, U, ctc, device=torch.device('cuda')):
     #mu = nm**.5 
     #U2 = U / mu.unsqueeze(-1).unsqueeze(-1)
 
-    B = conv1d(X.unsqueeze(1), W.unsqueeze(1), padding=nt//2)
-    B = torch.einsum('ijk, kjl -> il', U, B)
+    # The convolution is done in `precision` (X is usually already converted
+    # by `bfile`), and so is its output. That is converted to float32 one chunk
+    # at a time before projecting onto templates, since rounded projections
+    # would cause ties between neighboring peaks.
+    dtype = compute_dtype(ops)
+    XW = conv1d(X.to(dtype).unsqueeze(1), W.to(dtype).unsqueeze(1), padding=nt//2)
+    NT = X.shape[-1]
+    nb = (NT-1)//40 + 1
+    B = torch.zeros((U.shape[0], NT), device=device)
+    for t in range(0, NT, nb):
+        B[:, t:t+nb] = torch.einsum('ijk, kjl -> il', U, XW[:, :, t:t+nb].float())
+    del XW
 
     trange = torch.arange(-nt, nt+1, device=device) 
     tiwave = torch.arange(-(nt//2), nt//2+1, device=device) 
@@ -185,7 +195,8 @@ def run_matching(ops, X, U, ctc, device=torch.device('cuda')):
     th_amps = torch.zeros((100000,1), dtype = torch.float, device = device)
     k = 0
 
-    Xres = X.clone()
+    # residuals are always float32, copying X even if it already is
+    Xres = X.to(torch.float32, copy=True)
     lam = 20
 
     for t in range(max_peels):
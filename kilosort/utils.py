@@ -1,4 +1,7 @@
 import os, tempfile, shutil, pathlib, psutil
+import threading
+import contextvars
+from contextlib import contextmanager
 import importlib.util
 import logging
 import pprint
@@ -37,13 +40,17 @@ def template_path(basename='wTEMP.npz'):
     """ currently only one set of example templates to use"""
     return cache_template_path(basename)
 
+# Prevents concurrent runs from downloading the same file at the same time.
+_download_lock = threading.Lock()
+
 def cache_template_path(basename):
     DOWNLOADS_DIR.mkdir(parents=True, exist_ok=True)
     url = f'{_DOWNLOADS_URL}/{basename}'
     cached_file = os.fspath(DOWNLOADS_DIR.joinpath(basename)) 
-    if not os.path.exists(cached_file):
-        logger.info('Downloading: "{}" to {}\n'.format(url, cached_file))
-        download_url_to_file(url, cached_file, progress=True)
+    with _download_lock:
+        if not os.path.exists(cached_file):
+            logger.info('Downloading: "{}" to {}\n'.format(url, cached_file))
+            download_url_to_file(url, cached_file, progress=True)
     return cached_file
 
 def download_probes(probe_dir=None):
@@ -103,6 +110,108 @@ def download_url_to_file(url, dst, progress=True):
             os.remove(f.name)
 
 
+def compute_dtype(ops):
+    """Torch dtype for convolutions with batch data, set by `precision`."""
+    precision = ops['settings'].get('precision', 'float32')
+    return getattr(torch, precision)
+
+
+# Random state of the sorting run in the current context, only set for runs
+# started by `run_kilosort_multi` (see `seed_rng` and `run_rng`).
+_run_rng_state = contextvars.ContextVar('kilosort_run_rng_state', default=None)
+_rng_lock = threading.Lock()
+_rng_local = threading.local()
+
+
+def _global_rng_state():
+    state = {'numpy': np.random.get_state(),
+             'torch': torch.random.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def _set_global_rng_state(state):
+    np.random.set_state(state['numpy'])
+    torch.random.set_rng_state(state['torch'])
+    if 'cuda' in state:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _seed_global_rng(seed):
+    np.random.seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    torch.random.manual_seed(seed)
+
+
+def seed_rng(seed, isolated=False):
+    """Seed the numpy and torch random number generators for a sorting run.
+
+    If `isolated` is True, the global generators are not changed. Instead,
+    the seeded state is kept for the current context (i.e. the current run),
+    and loaded into the global generators only inside `run_rng`.
+
+    """
+    if not isolated:
+        _seed_global_rng(seed)
+        return
+    with _rng_lock:
+        saved = _global_rng_state()
+        _seed_global_rng(seed)
+        _run_rng_state.set(_global_rng_state())
+        _set_global_rng_state(saved)
+
+
+@contextmanager
+def run_rng():
+    """Draw from the global generators with the current run's random state.
+
+    Steps that use the global numpy or torch generators (directly, or through
+    libraries like scikit-learn) are wrapped with this. For runs seeded with
+    `seed_rng(..., isolated=True)`, the run's state is loaded into the global
+    generators while holding a lock. Afterwards, the run's state is saved
+    and the previous global state is restored. Concurrent runs then get the
+    same random numbers as when sorted one at a time, at the cost of not
+    running these steps at the same time. Otherwise, this does nothing.
+
+    """
+    state = _run_rng_state.get()
+    if state is None or getattr(_rng_local, 'active', False):
+        yield
+        return
+    with _rng_lock:
+        saved = _global_rng_state()
+        _set_global_rng_state(state)
+        _rng_local.active = True
+        try:
+            yield
+        finally:
+            _rng_local.active = False
+            state.update(_global_rng_state())
+            _set_global_rng_state(saved)
+
+
+def get_rng_state():
+    """Random state of the current run, or of the global generators."""
+    state = _run_rng_state.get()
+    if state is None:
+        return _global_rng_state()
+    return dict(state)
+
+
+def set_rng_state(state):
+    """Set the random state of the current run, or of the global generators.
+
+    Missing entries of `state` (like 'cuda') are left unchanged.
+
+    """
+    run_state = _run_rng_state.get()
+    if run_state is None:
+        _set_global_rng_state(state)
+    else:
+        run_state.update(state)
+
+
 def log_performance(log=None, level=None, header=None):
     """Log usage information for cpu, memory, gpu, and gpu memory.
 
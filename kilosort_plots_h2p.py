@@ -5,17 +5,16 @@ import re
 import matplotlib.pyplot as plt
 from matplotlib import gridspec
 from scipy.ndimage import gaussian_filter1d
-from kilosort.io import load_ops
 from kilosort.data_tools import (
-    mean_waveform, cluster_templates, get_good_cluster, get_cluster_spikes, mean_waveform_with_bounds,
+    load_results, mean_waveform, cluster_templates, get_good_cluster, get_cluster_spikes, mean_waveform_with_bounds,
     get_spike_waveforms, get_best_channels)
 
 ######################################################################################
 def plot_all_cluster_waveforms(results_dir, save_path, job_id=0, n_chunks=50):
     results_dir = Path(results_dir)
 
-    clu = np.load(results_dir / 'spike_clusters.npy')
-    cluster_ids, _ = np.sort(np.unique(clu, return_counts=True))
+    # Cluster index and arrays are cached for the calls below.
+    cluster_ids = load_results(results_dir).cluster_ids
     
     chunks = np.array_split(cluster_ids, n_chunks)
     this_chunk = chunks[job_id]
@@ -35,7 +34,7 @@ def plot_cluster_waveforms(results_dir, cluster_id=False, save_path=False):
     run_type = results_dir.name.replace("kilosort4_", "") if results_dir.name.startswith("kilosort4_") else "unknown"
     session_name = results_dir.parent.parent.name
 
-    ops = load_ops(results_dir / 'ops.npy')
+    ops = load_results(results_dir).ops
     t = (np.arange(ops['nt']) / ops['fs']) * 1000
 
     #all_spike_times = np.load(results_dir / 'spike_times.npy')
@@ -5,7 +5,10 @@ import numpy as np
 import os
 
 from kilosort import run_kilosort, DEFAULT_SETTINGS
-from kilosort.io import load_probe, save_preprocessing, load_ops
+from kilosort.io import (
+    load_probe, save_preprocessing, load_ops, find_binary, find_spikeglx_meta,
+    spikeglx_settings
+    )
 import helpers
 
 def kilosort_sweep(save_path,probe_path,line_id=0):
@@ -28,8 +31,14 @@ def kilosort_sweep(save_path,probe_path,line_id=0):
     
     # constant parameters
     settings['probe']                 =  probe
-    settings['n_chan_bin']            =  probe['n_chan']+1
-    settings['fs']                    =  30000
+    binary_path = find_binary(SAVE_PATH.parent)
+    if find_spikeglx_meta(binary_path) is not None:
+        meta_settings = spikeglx_settings(binary_path)
+        settings['n_chan_bin']        =  meta_settings['n_chan_bin']
+        settings['fs']                =  meta_settings['fs']
+    else:
+        settings['n_chan_bin']        =  probe['n_chan']+1
+        settings['fs']                =  30000
     settings['dminx']                 =  103
     settings['nblocks']               =  0
     settings['duplicate_spike_ms']    =  0
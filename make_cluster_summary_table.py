@@ -6,8 +6,7 @@ import time
 import os
 import matplotlib.pyplot as plt
 from sklearn.metrics import mean_squared_error
-from kilosort.io import load_ops
-from kilosort.data_tools import (get_cluster_spikes, get_spike_waveforms, get_best_channels, get_best_channel)
+from kilosort.data_tools import (SortingResults, get_cluster_spikes, get_spike_waveforms, get_best_channels, get_best_channel)
 
 def make_cluster_summary_table(results_dir, job_id=0, n_chunks=1, n_spikes=np.inf):
     # Initialize cluster_summary 
@@ -17,27 +16,29 @@ def make_cluster_summary_table(results_dir, job_id=0, n_chunks=1, n_spikes=np.in
     clusters_dir = results_dir / 'clusters'
     clusters_dir.mkdir(exist_ok=True)
 
-    # Pull out details from kilosort results
-    ops = load_ops(results_dir / 'ops.npy')
+    # Pull out details from kilosort results. Arrays are memory-mapped once and
+    # shared with get_cluster_snr, along with the per-cluster spike index.
+    results = SortingResults(results_dir)
+    ops = results.ops
 
     fs = ops['fs']
-    chan_map = np.load(results_dir / 'channel_map.npy')
-    templates = np.load(results_dir / 'templates.npy')
-    chan_best = (templates**2).sum(axis=1).argmax(axis=-1)
-    chan_best = chan_map[chan_best]
+    chan_map = results.channel_map
+    templates = np.asarray(results.templates)
+    chan_best = chan_map[results.best_channels]
 
     template_amplitudes = np.sqrt((templates**2).sum(axis=(-2, -1)))
-    st = np.load(results_dir / 'spike_times.npy')
-    clu = np.load(results_dir / 'spike_clusters.npy')
-    pos = np.load(results_dir / 'spike_positions.npy')
+    st = results.spike_times
+    pos = results.spike_positions
 
     # Identify cluster_ids 
-    cluster_ids, spike_counts = np.unique(clu, return_counts=True)
+    cluster_ids = results.cluster_ids
+    spike_idx = [results.cluster_spikes(i) for i in cluster_ids]
+    spike_counts = np.array([idx.size for idx in spike_idx])
     print(f"There are {len(cluster_ids)} clusters total.")
 
     firing_rates = spike_counts * fs / st.max()
-    xpos = np.array([pos[clu == i, 0].mean() if np.any(clu == i) else np.nan for i in cluster_ids])
-    ypos = np.array([pos[clu == i, 1].mean() if np.any(clu == i) else np.nan for i in cluster_ids])
+    xpos = np.array([pos[idx, 0].mean() for idx in spike_idx])
+    ypos = np.array([pos[idx, 1].mean() for idx in spike_idx])
     
     chunks = np.array_split(cluster_ids, n_chunks)
     this_chunk = chunks[job_id]
@@ -47,7 +48,7 @@ def make_cluster_summary_table(results_dir, job_id=0, n_chunks=1, n_spikes=np.in
         cluster_file = clusters_dir / f'cluster_{int(cluster_id):04d}.npy'
         if not cluster_file.exists():
             print(f".....Cluster {cluster_id}.....\n")
-            snr, mean_wf, std_wf, spike_times, waves, first_spike, last_spike, drift_mses= get_cluster_snr(results_dir, cluster_id)
+            snr, mean_wf, std_wf, spike_times, waves, first_spike, last_spike, drift_mses= get_cluster_snr(results, cluster_id)
             
             max_drift_mse = np.max(drift_mses[1:]) if len(drift_mses) > 1 else 0  # skip first self-comparison
 
@@ -78,9 +79,7 @@ def make_cluster_summary_table(results_dir, job_id=0, n_chunks=1, n_spikes=np.in
             print(f"Cluster {cluster_id} already exists\n")
 
 def get_cluster_snr(results_dir, cluster_id, fs=30000, drift_bin_sec=600):
-    results_dir = Path(results_dir)
-    ops = load_ops(results_dir / 'ops.npy')
-
+    # results_dir can also be a SortingResults object, to reuse loaded arrays.
     chan = get_best_channel(results_dir, cluster_id)
 
     spike_times, _ = get_cluster_spikes(cluster_id, results_dir, n_spikes=np.inf)
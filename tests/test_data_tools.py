@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import pytest
+
+from kilosort.data_tools import (
+    SortingResults, load_results, get_best_channels, get_cluster_spikes,
+    cluster_templates
+    )
+
+
+@pytest.fixture()
+def results_dir(tmp_path):
+    rng = np.random.default_rng(0)
+    n_spikes, n_clusters, nt, n_chans = 500, 12, 61, 8
+    # Cluster 7 has no spikes.
+    clu = rng.choice(np.delete(np.arange(n_clusters), 7), n_spikes)
+    np.save(tmp_path / 'spike_clusters.npy', clu.astype(np.int32))
+    np.save(tmp_path / 'spike_times.npy', np.sort(rng.integers(0, 10**6, n_spikes)))
+    np.save(tmp_path / 'amplitudes.npy', rng.random(n_spikes).astype(np.float32))
+    np.save(tmp_path / 'templates.npy',
+            rng.standard_normal((n_clusters, nt, n_chans)).astype(np.float32))
+    return tmp_path
+
+
+def test_sorting_results(results_dir):
+    results = SortingResults(results_dir)
+    clu = np.load(results_dir / 'spike_clusters.npy')
+    st = np.load(results_dir / 'spike_times.npy')
+    templates = np.load(results_dir / 'templates.npy')
+    amplitudes = np.load(results_dir / 'amplitudes.npy')
+
+    assert isinstance(results.spike_times, np.memmap)
+    assert results.spike_times is results.spike_times
+    assert np.array_equal(results.cluster_ids, np.unique(clu))
+    with pytest.raises(AttributeError):
+        results.not_a_file
+
+    best = (templates**2).sum(axis=1).argmax(axis=-1)
+    assert np.array_equal(results.best_channels, best)
+    assert np.array_equal(get_best_channels(results), best)
+
+    for i in range(templates.shape[0]):
+        idx = (clu == i).nonzero()[0]
+        assert np.array_equal(results.cluster_spikes(i), idx)
+
+        spikes, subset = get_cluster_spikes(i, results, n_spikes=10)
+        assert np.array_equal(spikes, np.sort(st[idx[subset]]))
+
+        temps = cluster_templates(i, results, best=True)
+        expected = amplitudes[idx, None] * templates[i, :, best[i]]
+        assert np.allclose(temps, expected)
+
+
+def test_load_results(results_dir):
+    results = load_results(results_dir)
+    assert load_results(results) is results
+    assert load_results(str(results_dir)) is results
+    _ = results.best_channels
+
+    # Results are reloaded if sorting output has changed.
+    clu = np.load(results_dir / 'spike_clusters.npy')
+    np.save(results_dir / 'spike_clusters.npy', np.zeros_like(clu))
+    stat = os.stat(results_dir / 'spike_clusters.npy')
+    os.utime(results_dir / 'spike_clusters.npy',
+             ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    new_results = load_results(results_dir)
+    assert new_results is not results
+    assert np.array_equal(new_results.cluster_ids, [0])
@@ -1,10 +1,12 @@
 import pytest
+import os
 import tempfile
 from pathlib import Path
 
 import numpy as np
+import torch
 
-from kilosort import io
+from kilosort import io, preprocessing
 
 
 def test_probe_io():
@@ -244,3 +246,477 @@ def test_tmax_only(torch_device, data_directory):
         # Delete memmap file and re-raise exception
         bfile.close()
         path.unlink()
+
+
+def test_prefetch_batches(torch_device):
+    N, C = (1000, 10)
+    data = np.random.randint(-1000, 1000, (N, C)).astype(np.int16)
+    bfile = io.BinaryRWFile('dummy', n_chan_bin=C, NT=200, nt=21,
+                            device=torch_device, file_object=data, prefetch=2)
+
+    # Prefetched batches should match batches read one at a time.
+    batches = list(bfile.iter_batches(return_inds=True))
+    assert len(batches) == bfile.n_batches
+    for ibatch, (X, inds) in enumerate(batches):
+        X2, inds2 = bfile.padded_batch_to_torch(ibatch, return_inds=True)
+        assert torch.equal(X, X2)
+        assert inds == inds2
+
+    # Subsets of batches, and stopping early, should also work.
+    subset = list(bfile.iter_batches([3, 1]))
+    assert torch.equal(subset[0], bfile.padded_batch_to_torch(3))
+    assert torch.equal(subset[1], bfile.padded_batch_to_torch(1))
+    for X in bfile.iter_batches():
+        break
+    assert len(bfile._pending) == 0
+
+
+def test_batch_cache(torch_device, tmp_path):
+    N, C = (1000, 10)
+    data = np.random.randint(-1000, 1000, (N, C)).astype(np.int16)
+    hp_filter = preprocessing.get_highpass_filter(device=torch_device)
+    whiten_mat = torch.eye(C, device=torch_device) * 0.01
+    kwargs = dict(n_chan_bin=C, NT=200, nt=21, hp_filter=hp_filter,
+                  whiten_mat=whiten_mat, device=torch_device, file_object=data)
+    bfile = io.BinaryFiltered('dummy', **kwargs)
+    cache = io.FilteredBatchCache(tmp_path, max_gb=1)
+    cached_bfile = io.BinaryFiltered('dummy', cache=cache, prefetch=2, **kwargs)
+
+    # First pass fills the cache, second pass should only read from it.
+    first_pass = []
+    for i in range(2):
+        for ibatch, (X, inds) in enumerate(cached_bfile.iter_batches(return_inds=True)):
+            X2, inds2 = bfile.padded_batch_to_torch(ibatch, return_inds=True)
+            assert torch.allclose(X, X2, atol=1e-3, rtol=1e-3)
+            assert inds == inds2
+            if i == 0:
+                first_pass.append(X.clone())
+            else:
+                # Cache hits are identical to newly computed batches.
+                assert torch.equal(X, first_pass[ibatch])
+        cache.flush()
+    assert cache.hits == bfile.n_batches
+    assert len(list(tmp_path.glob('*/*.npy'))) == bfile.n_batches
+
+    # Batches can be converted to a reduced-precision format once, both for
+    # cache hits and newly filtered batches.
+    for f in [cached_bfile, bfile]:
+        for ibatch, X in enumerate(f.iter_batches(out_dtype=torch.bfloat16)):
+            assert X.dtype == torch.bfloat16
+            assert torch.equal(X, first_pass[ibatch].to(torch.bfloat16))
+
+    # Different preprocessing variables should not re-use cached batches.
+    other_bfile = io.BinaryFiltered(
+        'dummy', cache=cache, **{**kwargs, 'whiten_mat': whiten_mat*2}
+        )
+    X = other_bfile.padded_batch_to_torch(0)
+    assert torch.allclose(X, bfile.padded_batch_to_torch(0)*2, atol=1e-3)
+    other_bfile.close()
+    rfft_bfile = io.BinaryFiltered('dummy', cache=cache, use_rfft=False, **kwargs)
+    assert rfft_bfile._get_cache_key() != cached_bfile._get_cache_key()
+
+    # Batches that fail to load count as misses, not hits.
+    hits, misses = cache.hits, cache.misses
+    key = cached_bfile._get_cache_key()
+    cache._path(key, 0).write_bytes(b'not a numpy file')
+    assert cache.get(key, 0) is None
+    assert (cache.hits, cache.misses) == (hits, misses + 1)
+
+    # Closing the cache stops its writer thread.
+    with io.FilteredBatchCache(tmp_path / 'closed', max_gb=1) as closed_cache:
+        closed_cache.put('key', 0, X)
+    assert (tmp_path / 'closed' / 'key' / '0000000.npy').is_file()
+    assert closed_cache._writer._shutdown
+
+    # Least recently used batches are removed when the cache is full.
+    batch_bytes = max(p.stat().st_size for p in tmp_path.glob('*/*.npy'))
+    small_cache = io.FilteredBatchCache(tmp_path, max_gb=3*batch_bytes/1024**3)
+    assert len(list(tmp_path.glob('*/*.npy'))) == bfile.n_batches + 1
+    small_cache.put('new_key', 0, X)
+    small_cache.flush()
+    assert len(list(tmp_path.glob('*/*.npy'))) <= 3
+    assert (tmp_path / 'new_key' / '0000000.npy').is_file()
+
+
+@pytest.mark.parametrize('dtype', ['int16', 'uint16', 'float32'])
+def test_reuse_buffers(torch_device, dtype):
+    N, C = (1000, 10)
+    data = np.random.randint(0, 1000, (N, C)).astype(dtype)
+    kwargs = dict(n_chan_bin=C, NT=200, nt=21, device=torch_device,
+                  file_object=data)
+    if dtype == 'float32':
+        kwargs.update(scale=0.5, shift=1.0)
+    bfile = io.BinaryRWFile('dummy', **kwargs)
+    reuse_bfile = io.BinaryRWFile('dummy', reuse_buffers=True, prefetch=2, **kwargs)
+
+    X0 = None
+    for ibatch, (X, inds) in enumerate(reuse_bfile.iter_batches(return_inds=True)):
+        X2, inds2 = bfile.padded_batch_to_torch(ibatch, return_inds=True)
+        assert torch.allclose(X, X2)
+        assert inds == inds2
+        # Same device memory should be used for every batch.
+        if X0 is None:
+            X0 = X
+        assert X.data_ptr() == X0.data_ptr()
+
+    # Single batch shorter than NT, remainder should be zero-padded.
+    short_kwargs = {**kwargs, 'file_object': data[:150]}
+    short_bfile = io.BinaryRWFile('dummy', **short_kwargs)
+    short_reuse = io.BinaryRWFile('dummy', reuse_buffers=True, **short_kwargs)
+    assert torch.allclose(short_bfile.padded_batch_to_torch(0),
+                          short_reuse.padded_batch_to_torch(0))
+
+
+@pytest.mark.parametrize('dtype', ['int16', 'float32'])
+def test_compressed_binary(torch_device, tmp_path, dtype):
+    N, C = (2500, 12)
+    # Random walk, so that delta coding is effective. Also make sure values
+    # wrap around for int16.
+    data = np.cumsum(np.random.randint(-50, 50, (N, C)), axis=0) * 100
+    data = data.astype(dtype)
+    filename = tmp_path / 'data.bin'
+    data.tofile(filename)
+    path = io.compress_binary(filename, C, dtype=dtype, chunk_samples=300)
+    assert path.suffix == '.ksc'
+    if dtype == 'int16':
+        assert path.stat().st_size < filename.stat().st_size
+
+    # Slices within chunks, across chunk boundaries, and with channel indexing
+    compressed = io.CompressedBinary(path, max_cached_chunks=2)
+    assert compressed.shape == data.shape
+    assert compressed.dtype == data.dtype
+    for idx in [slice(None), slice(10, 20), slice(250, 950), slice(2400, None),
+                slice(-5, None), slice(100, 50), 0, -1]:
+        assert np.array_equal(compressed[idx], data[idx])
+    assert np.array_equal(compressed[290:310, [1, 5]], data[290:310, [1, 5]])
+    assert np.array_equal(compressed[::7, 3], data[::7, 3])
+    for idx in [slice(None, None, -1), slice(950, 250, -3), slice(None, 5, -7),
+                slice(10, 20, -1)]:
+        assert np.array_equal(compressed[idx], data[idx])
+
+    # Unknown versions or codecs should fail when the file is opened.
+    raw = bytearray(path.read_bytes())
+    bad_version = tmp_path / 'bad_version.ksc'
+    bad_version.write_bytes(b'KSC2' + raw[4:])
+    with pytest.raises(ValueError, match='version'):
+        io.CompressedBinary(bad_version)
+    bad_codec = tmp_path / 'bad_codec.ksc'
+    bad_codec.write_bytes(raw.replace(b'"zlib"', b'"zstd"', 1))
+    with pytest.raises(ValueError, match='codec'):
+        io.CompressedBinary(bad_codec)
+
+    # BinaryRWFile should detect compressed files by extension.
+    bfile = io.BinaryRWFile(filename, C, NT=200, nt=21, device=torch_device,
+                            dtype=dtype)
+    cfile = io.BinaryRWFile(path, C, NT=200, nt=21, device=torch_device)
+    assert cfile.n_batches == bfile.n_batches
+    for ibatch in range(bfile.n_batches):
+        assert torch.equal(cfile.padded_batch_to_torch(ibatch),
+                           bfile.padded_batch_to_torch(ibatch))
+
+
+def test_binary_file_group():
+    C = 4
+    sizes = [100, 1, 250, 50]
+    arrays = [np.random.randint(-1000, 1000, (n, C)).astype(np.int16)
+              for n in sizes]
+    data = np.concatenate(arrays, axis=0)
+    group = io.BinaryFileGroup(arrays)
+    assert group.shape == data.shape
+
+    indices = [
+        slice(None), slice(10, 20), slice(90, 120), slice(50, 360),
+        slice(-30, None), slice(None, None, 7), slice(300, 20, -3),
+        slice(20, 10), 0, 100, 101, -1, np.array([0, 101, 99, 350, -2]),
+        np.arange(data.shape[0]) % 3 == 0
+        ]
+    for idx in indices:
+        assert np.array_equal(group[idx], data[idx])
+        assert np.array_equal(group[idx, 2], data[idx, 2])
+        assert np.array_equal(group[idx, [3, 0]], data[idx][..., [3, 0]])
+    with pytest.raises(IndexError):
+        group[data.shape[0]]
+
+    # Reads spanning files written directly to a preallocated buffer.
+    out = np.zeros((500, C), dtype=np.int16)
+    n = group.read_into(out, 80, 380)
+    assert n == 300
+    assert np.array_equal(out[:n], data[80:380])
+    n = group.read_into(out, 390, 500)
+    assert n == 11
+    assert np.array_equal(out[:n], data[390:])
+
+    # BinaryRWFile should use `read_into` when reusing buffers.
+    bfile = io.BinaryRWFile('dummy', C, NT=100, nt=11, file_object=data,
+                            device=torch.device('cpu'))
+    gfile = io.BinaryRWFile('dummy', C, NT=100, nt=11, file_object=group,
+                            device=torch.device('cpu'), reuse_buffers=True)
+    for ibatch in range(bfile.n_batches):
+        assert torch.equal(gfile.padded_batch_to_torch(ibatch),
+                           bfile.padded_batch_to_torch(ibatch))
+
+
+@pytest.mark.parametrize('dtype', ['int16', 'float16'])
+def test_save_preprocessing(torch_device, tmp_path, dtype):
+    N, C, NT, nt = (2000, 6, 200, 21)
+    data = np.random.randint(-1000, 1000, (N, C)).astype(np.int16)
+    chan_map = np.array([0, 2, 3, 5])
+    whiten_mat = torch.eye(chan_map.size, device=torch_device) * 0.05
+    hp_filter = preprocessing.get_highpass_filter(device=torch_device)
+    bfile = io.BinaryFiltered(
+        'dummy', C, NT=NT, nt=nt, chan_map=chan_map, hp_filter=hp_filter,
+        whiten_mat=whiten_mat, device=torch_device, file_object=data
+        )
+    ops = {
+        'Nbatches': bfile.n_batches, 'nt': nt, 'batch_size': NT,
+        'preprocessing': {'whiten_mat': whiten_mat, 'hp_filter': hp_filter},
+        'dshift': None, 'chanMap': chan_map, 'data_dtype': 'int16',
+        'n_chan_bin': C, 'settings': {'prefetch_batches': 2}
+        }
+    filename = tmp_path / 'temp_wh.dat'
+    io.save_preprocessing(filename, ops, bfile, dtype=dtype, flush_every=2)
+    assert ops['preprocessed_dtype'] == dtype
+    z = np.memmap(filename, dtype=dtype, mode='r').reshape(-1, C)
+    assert z.shape == (NT*bfile.n_batches, C)
+
+    # Compare to batches written one at a time, with linear blending of
+    # overlapping batch edges.
+    weights = np.linspace(1, 0, 2*nt+2)[1:-1]
+    expected = np.zeros(z.shape, dtype=np.float32)
+    batches = [bfile.padded_batch_to_torch(i).cpu().numpy()
+               for i in range(bfile.n_batches)]
+    expected[:nt, chan_map] = batches[0][:, nt:2*nt].T
+    for i, X in enumerate(batches):
+        expected[i*NT+nt : (i+1)*NT, chan_map] = X[:, 2*nt:NT+nt].T
+        if i < bfile.n_batches - 1:
+            y = X[:, NT:]*weights + batches[i+1][:, :2*nt]*np.flip(weights)
+            expected[(i+1)*NT-nt : (i+1)*NT+nt, chan_map] = y.T
+    expected = (expected*200).astype(dtype)
+    assert np.allclose(z.astype(np.float32), expected.astype(np.float32), atol=1)
+
+
+def test_save_preprocessing_error(torch_device, tmp_path):
+    # Errors in a pipeline stage should be raised, not cause a deadlock.
+    class BadFile:
+        n_batches = 10
+        def iter_batches(self, ops=None):
+            for i in range(self.n_batches):
+                if i == 5:
+                    raise RuntimeError('bad batch')
+                yield torch.zeros((4, 242))
+    ops = {
+        'Nbatches': 10, 'nt': 21, 'batch_size': 200,
+        'preprocessing': {'whiten_mat': None, 'hp_filter': None},
+        'dshift': None, 'chanMap': np.arange(4), 'data_dtype': 'int16',
+        'n_chan_bin': 4, 'settings': {'prefetch_batches': 0}
+        }
+    with pytest.raises(RuntimeError, match='bad batch'):
+        io.save_preprocessing(tmp_path / 'temp_wh.dat', ops, BadFile(),
+                              queue_size=1)
+
+
+def test_ops_store(torch_device, tmp_path):
+    rng = np.random.default_rng(0)
+    wrot = torch.from_numpy(rng.standard_normal((8, 8)).astype(np.float32))
+    settings = {
+        'filename': tmp_path / 'data.bin', 'data_dir': tmp_path, 'fs': 30000,
+        'tmax': np.inf, 'drift_smoothing': [0.5, 0.5, 0.5], 'shift': None,
+        'probe': {'chanMap': np.arange(8), 'xc': np.zeros(8, np.float32)},
+        }
+    ops = settings
+    ops['settings'] = settings
+    ops['Wrot'] = wrot
+    ops['preprocessing'] = {'whiten_mat': wrot, 'hp_filter': torch.ones(5)}
+    ops['dmin'] = np.float32(20.0)
+    ops['Nbatches'] = np.int64(3)
+    ops['dshift'] = rng.standard_normal((3, 1))
+    ops['runtime'] = 1.5
+    ops['bad'] = {1: 'not json'}
+    io.save_ops(ops, tmp_path)
+    assert (tmp_path / 'ops' / 'ops.json').is_file()
+
+    new_ops = io.load_ops(tmp_path / 'ops.npy', device=torch_device)
+    assert isinstance(new_ops, io.LazyOps)
+    old_ops = np.load(tmp_path / 'ops.npy', allow_pickle=True).item()
+    assert set(new_ops.keys()) == set(old_ops.keys())
+    assert torch.equal(new_ops['Wrot'].cpu(), wrot)
+    assert torch.equal(new_ops['preprocessing']['whiten_mat'].cpu(), wrot)
+    assert new_ops['Wrot'].device == torch_device
+    assert np.array_equal(new_ops['dshift'], ops['dshift'])
+    assert np.array_equal(new_ops['probe']['chanMap'], np.arange(8))
+    assert isinstance(new_ops['dmin'], np.float32)
+    assert isinstance(new_ops['Nbatches'], np.int64)
+    assert new_ops['tmax'] == np.inf
+    assert new_ops['shift'] is None
+    assert new_ops['filename'] == str(tmp_path / 'data.bin')
+    assert new_ops['drift_smoothing'] == [0.5, 0.5, 0.5]
+    assert new_ops['bad'] == {1: 'not json'}
+    assert new_ops['settings']['settings'] is new_ops['settings']
+    # Shared arrays are only saved once.
+    assert len(list((tmp_path / 'ops').glob('*Wrot*.npy'))) == 1
+
+    # Saved copy is plain dictionary.
+    np.save(tmp_path / 'ops_copy.npy', np.array(new_ops))
+    ops_copy = np.load(tmp_path / 'ops_copy.npy', allow_pickle=True).item()
+    assert type(ops_copy) is dict
+    assert torch.equal(ops_copy['Wrot'].cpu(), wrot)
+
+    # Copying to a regular dictionary also loads stored values.
+    fresh_ops = io.load_ops(tmp_path / 'ops.npy', device=torch_device)
+    assert torch.equal({**fresh_ops}['Wrot'].cpu(), wrot)
+    assert np.array_equal(dict(fresh_ops)['dshift'], ops['dshift'])
+
+    # Falls back to ops.npy if it was modified after the store was saved.
+    np.save(tmp_path / 'ops.npy', np.array(old_ops))
+    stat = (tmp_path / 'ops.npy').stat()
+    os.utime(tmp_path / 'ops.npy', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert type(io.load_ops(tmp_path / 'ops.npy', device=torch_device)) is dict
+
+
+class _ArrayRecording:
+    """Minimal stand-in for a SpikeInterface recording, backed by an array."""
+
+    def __init__(self, data):
+        self.data = data
+        self.channel_ids = np.array([f'ch{i}' for i in range(data.shape[1])])
+        self.reads = []
+
+    def get_num_segments(self):
+        return 1
+
+    def get_total_samples(self):
+        return self.data.shape[0]
+
+    def get_num_samples(self, segment_index=None):
+        return self.data.shape[0]
+
+    def get_sampling_frequency(self):
+        return 30000.0
+
+    def get_dtype(self):
+        return self.data.dtype
+
+    def get_traces(self, start_frame=None, end_frame=None, channel_ids=None,
+                   segment_index=None):
+        self.reads.append((start_frame, end_frame))
+        data = self.data[start_frame:end_frame]
+        if channel_ids is not None:
+            idx = [list(self.channel_ids).index(c) for c in channel_ids]
+            data = data[:, idx]
+        return data
+
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_recording_read_ahead(prefetch):
+    data = np.random.default_rng(0).integers(-100, 100, (1000, 6), dtype=np.int16)
+    recording = _ArrayRecording(data)
+    as_array = io.RecordingExtractorAsArray(
+        recording, chunk_size=128, cache_chunks=3, prefetch=prefetch
+        )
+    uncached = io.RecordingExtractorAsArray(recording, cache_chunks=0)
+
+    for i, j in [(0, 10), (5, 300), (250, 400), (100, 100), (900, 1000),
+                 (-50, None), (3, 4)]:
+        expected = data[i:j]
+        assert np.array_equal(as_array[i:j], expected)
+        assert np.array_equal(uncached[i:j], expected)
+    assert np.array_equal(as_array[130:260, 2:4], data[130:260, 2:4])
+    assert np.array_equal(as_array[130:260, 5], data[130:260, 5:6])
+    assert np.array_equal(as_array[7], data[7:8])
+
+    # Batches with overlapping padding only read each chunk once.
+    recording.reads = []
+    as_array.close()
+    for b in range(0, 1000, 100):
+        assert np.array_equal(
+            as_array[max(b-10, 0):b+110], data[max(b-10, 0):b+110]
+            )
+    assert sorted(recording.reads) == [(a, min(a+128, 1000)) for a in range(0, 1000, 128)]
+    as_array.close()
+
+
+def test_spikeinterface_to_binary(tmp_path):
+    data = np.random.default_rng(0).integers(-100, 100, (1000, 6), dtype=np.int16)
+    recording = _ArrayRecording(data)
+    filename, N, c, _, _, _ = io.spikeinterface_to_binary(
+        recording, tmp_path, chunksize=64, export_probe=False, max_workers=2,
+        flush_every=2
+        )
+    assert (N, c) == data.shape
+    y = np.memmap(filename, dtype=np.int16, mode='r', shape=(N, c))
+    assert np.array_equal(y, data)
+    assert not (tmp_path / 'data.bin.progress.json').exists()
+    del(y)
+
+
+def test_spikeinterface_to_binary_resume(tmp_path):
+    data = np.random.default_rng(0).integers(-100, 100, (1000, 6), dtype=np.int16)
+
+    class _FailingRecording(_ArrayRecording):
+        def get_traces(self, start_frame=None, end_frame=None, **kwargs):
+            if start_frame >= 640:
+                raise RuntimeError('Job killed')
+            return super().get_traces(start_frame, end_frame, **kwargs)
+
+    with pytest.raises(RuntimeError):
+        io.spikeinterface_to_binary(
+            _FailingRecording(data), tmp_path, chunksize=64,
+            export_probe=False, max_workers=1, max_in_flight=1, flush_every=4
+            )
+    progress_file = tmp_path / 'data.bin.progress.json'
+    assert progress_file.is_file()
+
+    recording = _ArrayRecording(data)
+    filename, N, c, _, _, _ = io.spikeinterface_to_binary(
+        recording, tmp_path, chunksize=64, export_probe=False, max_workers=1,
+        max_in_flight=1
+        )
+    # All 10 chunks before the error were saved, so only the rest are copied
+    # (the first read is for the number of channels).
+    assert recording.reads[0] == (0, 1)
+    assert min(r[0] for r in recording.reads[1:]) == 640
+    y = np.memmap(filename, dtype=np.int16, mode='r', shape=(N, c))
+    assert np.array_equal(y, data)
+    assert not progress_file.exists()
+    del(y)
+
+
+def test_byte_offset(torch_device, tmp_path):
+    data = np.random.default_rng(0).integers(-100, 100, (5000, 4), dtype=np.int16)
+    filename = tmp_path / 'data.bin'
+    with open(filename, 'wb') as f:
+        f.write(b'header' * 10)
+        f.write(data.tobytes())
+    assert io.get_total_samples(filename, 4, offset=60) == 5000
+    with pytest.raises(ValueError):
+        io.get_total_samples(filename, 4)
+
+    bfile = io.BinaryRWFile(filename, 4, NT=1000, nt=61, offset=60,
+                            device=torch_device)
+    assert bfile.n_samples == 5000
+    assert np.array_equal(bfile[100:200], data[100:200])
+    X = bfile.padded_batch_to_torch(1).cpu().numpy()
+    assert np.array_equal(X[:, :1000 + 2*61], data[1000-61 : 2000+61].T)
+    bfile.close()
+
+
+def test_spikeglx_meta(tmp_path):
+    filename = tmp_path / 'run_g0_t0.imec0.ap.bin'
+    np.zeros((100, 385), dtype=np.int16).tofile(filename)
+    meta = ['imSampRate=30000.0837', 'nSavedChans=385', 'snsApLfSy=384,0,1',
+            'typeThis=imec', f'fileSizeBytes={100*385*2}',
+            '~imroTbl=(0,384)(0 0 0 500 250 1)']
+    (tmp_path / 'run_g0_t0.imec0.ap.meta').write_text('\n'.join(meta) + '\n')
+
+    assert io.find_spikeglx_meta(filename) == tmp_path / 'run_g0_t0.imec0.ap.meta'
+    assert io.read_spikeglx_meta(filename)['imroTbl'] == '(0,384)(0 0 0 500 250 1)'
+    info = io.spikeglx_settings(filename)
+    assert info == {'n_chan_bin': 385, 'fs': 30000.0837, 'sync_channel': 384,
+                    'n_samples': 100}
+
+    nidq = ['niSampRate=25000', 'nSavedChans=9', 'snsMnMaXaDw=0,0,8,1',
+            'typeThis=nidq']
+    (tmp_path / 'run_g0_t0.nidq.meta').write_text('\n'.join(nidq))
+    info = io.spikeglx_settings(tmp_path / 'run_g0_t0.nidq.meta')
+    assert (info['n_chan_bin'], info['fs'], info['sync_channel']) == (9, 25000, 8)
+    assert io.find_spikeglx_meta(tmp_path / 'other.bin') is None
@@ -0,0 +1,77 @@
+import numpy as np
+import torch
+
+from kilosort.postprocessing import make_pc_features, save_pc_features
+
+
+def _simulate_features(rng, n_spikes, n_templates, n_chans, n_pcs):
+    # Each template uses a contiguous block of channels, with a distinct mean
+    # waveform so that the ordering of channels by norm is well defined.
+    iCC = torch.from_numpy(
+        np.arange(n_templates)[np.newaxis,:] + np.arange(n_chans)[:,np.newaxis]
+        )
+    ops = {'iU': torch.arange(n_templates), 'iCC': iCC, 'nearest_chans': n_chans,
+           'xc': np.arange(n_templates+n_chans), 'yc': np.zeros(n_templates+n_chans),
+           'dmin': 20, 'dminx': 32}
+    spike_templates = rng.integers(0, n_templates, n_spikes).astype(np.int32)
+    means = rng.uniform(1, 10, (n_templates, n_chans, n_pcs)).astype(np.float32)
+    tF = rng.standard_normal((n_spikes, n_chans, n_pcs)).astype(np.float32)
+    tF = torch.from_numpy(tF + means[spike_templates])
+    return ops, spike_templates, tF
+
+
+def test_save_pc_features(tmp_path):
+    n_spikes, n_templates, n_chans, n_pcs = (5000, 12, 4, 3)
+    rng = np.random.default_rng(0)
+    ops, spike_templates, tF = _simulate_features(
+        rng, n_spikes, n_templates, n_chans, n_pcs
+        )
+    # Clusters made up of one or more templates
+    template_clusters = np.array([0, 0, 1, 1, 1, 2, 3, 3, 4, 4, 4, 4])
+    spike_clusters = template_clusters[spike_templates].astype(np.int32)
+    kept_spikes = rng.random(n_spikes) < 0.9
+
+    expected, expected_ind = make_pc_features(
+        ops, spike_templates[kept_spikes], spike_clusters[kept_spikes],
+        tF[kept_spikes]
+        )
+    tF_copy = tF.clone()
+    feature_ind = save_pc_features(
+        tmp_path / 'pc_features.npy', ops, spike_templates[kept_spikes],
+        spike_clusters[kept_spikes], tF, kept_spikes=kept_spikes,
+        chunk_size=777
+        )
+    pc_features = np.load(tmp_path / 'pc_features.npy')
+
+    assert torch.equal(tF, tF_copy)   # shouldn't be modified
+    assert np.array_equal(feature_ind, expected_ind)
+    assert pc_features.shape == expected.shape
+    assert np.allclose(pc_features, expected.numpy())
+
+
+def test_save_pc_features_shared_templates(tmp_path):
+    n_spikes, n_templates, n_chans, n_pcs = (2000, 6, 4, 3)
+    rng = np.random.default_rng(1)
+    ops, spike_templates, tF = _simulate_features(
+        rng, n_spikes, n_templates, n_chans, n_pcs
+        )
+    # Spikes from template 2 are split between clusters 0 and 1, in which case
+    # features should be arranged according to channels for cluster 1.
+    template_clusters = np.array([0, 0, 0, 1, 1, 2])
+    spike_clusters = template_clusters[spike_templates].astype(np.int32)
+    split = (spike_templates == 2) & (rng.random(n_spikes) < 0.5)
+    spike_clusters[split] = 1
+    feature_ind = save_pc_features(
+        tmp_path / 'pc_features.npy', ops, spike_templates, spike_clusters, tF,
+        chunk_size=300
+        )
+    pc_features = np.load(tmp_path / 'pc_features.npy')
+
+    winner = np.array([0, 0, 1, 1, 1, 2])
+    iC = ops['iCC'].numpy()
+    for s in range(n_spikes):
+        t = spike_templates[s]
+        for k, ch in enumerate(iC[:, t]):
+            j = np.nonzero(feature_ind[winner[t]] == ch)[0]
+            if j.size > 0:
+                assert np.allclose(pc_features[s, :, j[0]], tF[s, k].numpy())
@@ -1,10 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 import numpy as np
 import torch
 from torch.fft import fft, ifft, fftshift
 
 import kilosort.preprocessing as kpp
-from kilosort import datashift, io
+from kilosort import datashift, io, utils
+from kilosort.datashift import kernel2D
 
 
 np.random.seed(123)
@@ -62,6 +65,113 @@ class TestFiltering:
         assert torch.max(x100) < 0.01
         assert torch.max(x500) > 0.9
 
+    def test_rfft_highpass(self):
+        rng = np.random.default_rng(0)
+        X = torch.from_numpy(rng.standard_normal((4, 1001), dtype='float32'))
+        kwargs = dict(filename='dummy', n_chan_bin=4, NT=1001, do_CAR=False,
+                      hp_filter=self.hp_filter, device=torch.device('cpu'),
+                      file_object=X.numpy().T)
+        bfile1 = io.BinaryFiltered(use_rfft=True, **kwargs)
+        bfile2 = io.BinaryFiltered(use_rfft=False, **kwargs)
+
+        # Real and complex transforms should give the same filtered data,
+        # for both even and odd batch lengths.
+        for n in [1001, 1000]:
+            x1 = bfile1.filter(X[:, :n])
+            x2 = bfile2.filter(X[:, :n])
+            assert x1.shape == x2.shape == (4, n)
+            assert torch.allclose(x1, x2, atol=1e-5)
+
+        # Filter is only transformed once per length.
+        fwav = bfile1.get_fft_highpass(1000)
+        assert bfile1.get_fft_highpass(1000) is fwav
+        assert len(bfile1._fwav_cache) == 2
+
+
+class TestCAR:
+
+    def test_common_reference(self, torch_device):
+        rng = np.random.default_rng(0)
+        X = torch.from_numpy(rng.standard_normal((64, 1000))).float()
+        X = X.to(torch_device)
+        median = kpp.common_reference(X, 'median')
+        assert torch.allclose(median, torch.median(X, 0)[0])
+
+        # Approximation should be much closer to the median than to the
+        # spread of the data.
+        approx = kpp.common_reference(X, 'approx')
+        assert approx.shape == median.shape
+        assert (approx - median).abs().mean() < 0.1
+
+        groups = [torch.arange(0, 32, device=torch_device),
+                  torch.arange(32, 64, device=torch_device)]
+        shank = kpp.common_reference(X, 'shank', groups)
+        assert shank.shape == X.shape
+        assert torch.allclose(shank[0], torch.median(X[:32], 0)[0])
+        assert torch.allclose(shank[63], torch.median(X[32:], 0)[0])
+
+        with pytest.raises(ValueError):
+            kpp.common_reference(X, 'mean')
+        with pytest.raises(ValueError):
+            io.BinaryFiltered('dummy', 64, car_method='shank',
+                              file_object=X.cpu().numpy().T)
+
+    def test_benchmark_car(self):
+        from kilosort.bench import benchmark_car
+        rng = np.random.default_rng(0)
+        x = rng.standard_normal((10000, 16)).astype('float32')
+        x[::500, 3] -= 20
+        bfile = io.BinaryFiltered(
+            'dummy', 16, NT=2000, device=torch.device('cpu'), file_object=x,
+            car_method='approx', car_groups=np.repeat([0, 1], 8)
+            )
+        results = benchmark_car(bfile, n_batches=2, n_repeats=1)
+        assert set(results.keys()) == {'median', 'approx', 'shank'}
+        assert results['median']['recall'] == 1
+        assert results['median']['n_peaks'] > 0
+        assert bfile.car_method == 'approx'
+
+
+class TestFusedPreprocessing:
+
+    @pytest.mark.parametrize('invert_sign', [False, True])
+    @pytest.mark.parametrize('car_method', ['median', 'shank'])
+    @pytest.mark.parametrize('whiten', [False, True])
+    def test_fused_filter(self, torch_device, invert_sign, car_method, whiten):
+        rng = np.random.default_rng(0)
+        x = (rng.standard_normal((4000, 20)) * 30).astype('float32')
+        x0 = x.copy()
+        hp_filter = kpp.get_highpass_filter(device=torch_device)
+        whiten_mat = torch.eye(16, device=torch_device) + 0.01 if whiten else None
+        kwargs = dict(
+            filename='dummy', n_chan_bin=20, NT=1000, hp_filter=hp_filter,
+            whiten_mat=whiten_mat, chan_map=np.arange(2, 18), device=torch_device,
+            file_object=x, invert_sign=invert_sign, car_method=car_method,
+            car_groups=np.repeat([0, 1], 8)
+            )
+        bfile = io.BinaryFiltered(**kwargs)
+        fused_bfile = io.BinaryFiltered(fused=True, **kwargs)
+
+        for ibatch in range(bfile.n_batches):
+            X = bfile.padded_batch_to_torch(ibatch)
+            X_fused = fused_bfile.padded_batch_to_torch(ibatch)
+            assert torch.allclose(X, X_fused, atol=1e-3, rtol=1e-4)
+
+        # Raw data should not be modified by in-place steps.
+        assert np.array_equal(x, x0)
+
+    def test_fused_artifact(self, torch_device):
+        a = np.random.default_rng(1).integers(-1000, 1000, (1000, 10))
+        a = a.astype(np.float32)
+        a[900, 4] = 40000
+        kwargs = dict(filename='dummy', n_chan_bin=10, NT=500,
+                      device=torch_device, file_object=a,
+                      artifact_threshold=30000)
+        bfile = io.BinaryFiltered(**kwargs)
+        fused_bfile = io.BinaryFiltered(fused=True, **kwargs)
+        assert torch.allclose(bfile[:500, :], fused_bfile[:500, :], atol=1e-3)
+        assert torch.all(fused_bfile[500:, :] == 0)
+
 
 class TestArtifactRemoval:
     
@@ -102,6 +212,67 @@ class TestWhitening:
             atol=1e-4
             )
 
+    def test_whitening_local(self, torch_device):
+        n_chan, nrange = 64, 8
+        xc = np.tile([0, 32], n_chan//2).astype('float32')
+        yc = (np.arange(n_chan)//2 * 15).astype('float32')
+        rng = np.random.default_rng(0)
+        x = torch.from_numpy(rng.standard_normal((n_chan, 2000))).float()
+        x = (x + 0.5*torch.roll(x, 1, 0)).to(torch_device)
+        cc = (x @ x.T)/2000
+        wm = kpp.whitening_local(cc, xc, yc, nrange=nrange, device=torch_device)
+
+        # Each row should match the ZCA whitening vector computed from that
+        # channel's local neighborhood.
+        for j in range(n_chan):
+            ds = (xc[j] - xc)**2 + (yc[j] - yc)**2
+            ix = np.argsort(ds)[:nrange]
+            wrot = kpp.whitening_from_covariance(cc[np.ix_(ix, ix)])
+            assert torch.allclose(wm[j, ix], wrot[0], atol=1e-4)
+            assert (wm[j] != 0).sum() <= nrange
+
+    def test_whitening_early_stopping(self, torch_device):
+        rng = np.random.default_rng(0)
+        x = rng.standard_normal((200*100, 8)).astype('float32')
+        xc = np.zeros(8, dtype='float32')
+        yc = np.arange(8, dtype='float32')
+        hp_filter = kpp.get_highpass_filter(device=torch_device)
+        bfile = io.BinaryFiltered(
+            filename='dummy', n_chan_bin=8, NT=100, nt=11, file_object=x,
+            chan_map=np.arange(8), hp_filter=hp_filter, device=torch_device
+            )
+
+        # Prefixes of the batch order should be spread across the recording.
+        order = kpp._spread_order(bfile.n_batches - 1)
+        assert sorted(order) == list(range(bfile.n_batches - 1))
+        assert order[:4] == [0, 128, 64, 192]
+
+        loaded = []
+        load_batch = bfile.padded_batch_to_torch
+        def counting_load(ibatch, **kwargs):
+            loaded.append(ibatch)
+            return load_batch(ibatch, **kwargs)
+        bfile.padded_batch_to_torch = counting_load
+
+        wm_full = kpp.get_whitening_matrix(bfile, xc, yc, nskip=1, tol=0)
+        n_full = len(loaded)
+        loaded.clear()
+        wm = kpp.get_whitening_matrix(bfile, xc, yc, nskip=1, tol=0.05)
+        assert n_full == bfile.n_batches - 1
+        assert 20 <= len(loaded) < n_full
+        assert loaded == order[:len(loaded)]
+        assert torch.allclose(wm, wm_full, atol=0.05)
+
+        # With 100 samples per batch, the estimate can't be this precise
+        # before all batches are used.
+        loaded.clear()
+        _ = kpp.get_whitening_matrix(bfile, xc, yc, nskip=1, tol=1e-3)
+        assert len(loaded) == n_full
+
+        loaded.clear()
+        _ = kpp.get_whitening_matrix(bfile, xc, yc, nskip=1, max_batches=5)
+        assert loaded == order[:5]
+
     def test_get_whitening(self, bfile, saved_ops):
         xc = saved_ops['probe']['xc']
         yc = saved_ops['probe']['yc']
@@ -170,3 +341,278 @@ class TestWhitening:
 #     def test_get_drift_matrix(self):
 #         # TODO
 #         pass
+
+
+class TestDriftCorrection:
+
+    def get_ops(self, nblocks):
+        rng = np.random.default_rng(1)
+        xc = (rng.random(16) * 40).astype('float32')
+        yc = (np.arange(16) * 20).astype('float32')
+        xp = np.vstack((xc, yc)).T
+        Kxx = torch.from_numpy(kernel2D(xp, xp, 20))
+        iKxx = torch.linalg.inv(Kxx + 0.01 * torch.eye(16)).float()
+        yblk = np.linspace(50, 250, nblocks)
+        # Only a few distinct shifts, with some float noise.
+        base = rng.choice(np.arange(-4, 5) * 2.5, size=(3, nblocks))
+        dshift = base[rng.integers(0, 3, 10)]
+        dshift = dshift + rng.random((10, nblocks)) * 1e-9
+        ops = {'yblk': yblk, 'nblocks': nblocks, 'iKxx': iKxx,
+               'probe': {'xc': xc, 'yc': yc}, 'settings': {'sig_interp': 20}}
+        return ops, dshift
+
+    @pytest.mark.parametrize('nblocks', [1, 3])
+    @pytest.mark.parametrize('drift_cache_gb', [1.0, 1e-9])
+    def test_drift_operators(self, nblocks, drift_cache_gb):
+        ops, dshift = self.get_ops(nblocks)
+        whiten_mat = torch.eye(16) + 0.1
+        bfile = io.BinaryFiltered(
+            filename='dummy', n_chan_bin=16, NT=100, whiten_mat=whiten_mat,
+            dshift=dshift, device=torch.device('cpu'), drift_cache_gb=drift_cache_gb,
+            file_object=np.zeros((1000, 16), dtype='float32')
+            )
+
+        for ibatch in range(dshift.shape[0]):
+            M = kpp.get_drift_matrix(ops, dshift[ibatch], device=torch.device('cpu'))
+            W = bfile.get_drift_operator(ops, ibatch)
+            assert torch.allclose(W, M @ whiten_mat, atol=1e-5)
+
+        rows = bfile._drift_ops['rows']
+        assert rows.shape[0] < dshift.shape[0]
+        if drift_cache_gb < 1:
+            # Operators did not fit in `drift_cache_gb`, all are kept on CPU.
+            assert bfile._drift_ops['operators'].shape[0] == 0
+            assert bfile._drift_ops['overflow'].shape == (rows.shape[0], 16, 16)
+        else:
+            assert bfile._drift_ops['operators'].shape == (rows.shape[0], 16, 16)
+            assert bfile._drift_ops['overflow'].shape[0] == 0
+
+    @pytest.mark.parametrize('drift_cache_gb', [1.0, 1e-6])
+    def test_drift_operators_reused(self, monkeypatch, drift_cache_gb):
+        # Long recording with smoothly varying, continuous drift estimates
+        # for several blocks, like those from MEDiCINe.
+        nblocks, n_batches = 5, 7000
+        ops, _ = self.get_ops(nblocks)
+        t = np.linspace(0, 1, n_batches)[:,None]
+        dshift = 8*np.sin(2*np.pi*(t + np.arange(nblocks)/10)) + 3*t
+        whiten_mat = torch.eye(16) + 0.1
+        bfile = io.BinaryFiltered(
+            filename='dummy', n_chan_bin=16, NT=100, whiten_mat=whiten_mat,
+            dshift=dshift, device=torch.device('cpu'), drift_cache_gb=drift_cache_gb,
+            file_object=np.zeros((1000, 16), dtype='float32')
+            )
+
+        n_calls = []
+        get_drift_matrices = io.get_drift_matrices
+        def counted(*args, **kwargs):
+            M = get_drift_matrices(*args, **kwargs)
+            n_calls.append(M.shape[0])
+            return M
+        monkeypatch.setattr(io, 'get_drift_matrices', counted)
+
+        # Two passes over all batches, in order.
+        for _ in range(2):
+            for ibatch in range(n_batches):
+                W = bfile.get_drift_operator(ops, ibatch)
+        rows = bfile._drift_ops['rows']
+        # Shifts are quantized to 0.1 microns, so many batches share operators,
+        # and each one is only computed once.
+        assert rows.shape[0] < n_batches / 2
+        assert sum(n_calls) == rows.shape[0]
+        # Quantization changes the operators only slightly.
+        M = kpp.get_drift_matrix(ops, dshift[-1], device=torch.device('cpu'))
+        assert torch.allclose(W, M @ whiten_mat, atol=1e-2)
+
+    def test_bin_spikes(self):
+        rng = np.random.default_rng(2)
+        n_spikes, Nbatches = 5000, 40
+        ops = {'yc': np.arange(16) * 20., 'binning_depth': 5,
+               'Nbatches': Nbatches, 'Th_universal': 9}
+        st = np.zeros((n_spikes, 6))
+        st[:,1] = rng.random(n_spikes) * 300
+        st[:,2] = 9 + rng.exponential(20, n_spikes)
+        # Some batches have no spikes.
+        st[:,4] = rng.choice(np.arange(0, Nbatches, 2), n_spikes)
+        F, ysamp = datashift.bin_spikes(ops, st)
+
+        # Per-batch histograms, binned the same way as bin_spikes.
+        dmin = -1
+        amp_max = np.log10(100) - np.log10(9)
+        expected = np.zeros_like(F)
+        for t in range(Nbatches):
+            sst = st[st[:,4] == t]
+            rows = ((sst[:,1] - dmin) / 5).astype('int32')
+            amp = np.log10(np.minimum(99, sst[:,2])) - np.log10(9)
+            cols = (1e-5 + amp / amp_max * 20).astype('int32')
+            np.add.at(expected[t], (rows, cols), 1)
+        expected = np.log2(1 + expected)
+
+        assert F.shape == (Nbatches, 62, 20)
+        assert ysamp.size == 62
+        assert np.allclose(F, expected)
+        assert np.all(F[1::2] == 0)
+
+    @pytest.mark.parametrize('n', [3, 15, 40])
+    def test_shift_correlation(self, torch_device, n):
+        rng = np.random.default_rng(3)
+        F = torch.from_numpy(rng.random((30, 62, 20))).float().to(torch_device)
+        F0 = F.mean(0)
+        dc = datashift.shift_correlation(F, F0, n)
+        expected = torch.stack([
+            (torch.roll(F, s, 1) * F0).mean(-1).mean(-1)
+            for s in range(-n, n+1)
+            ])
+        assert dc.shape == (2*n+1, 30)
+        assert torch.allclose(dc, expected, atol=1e-5)
+
+        shifts = rng.integers(-n, n+1, 30)
+        Fs = datashift.shift_fingerprints(F, shifts)
+        for i, s in enumerate(shifts):
+            assert torch.equal(Fs[i], torch.roll(F[i], int(s), 0))
+
+    def test_align_max_shift(self, torch_device):
+        # Batches are copies of one fingerprint, half of them shifted by
+        # 40 bins at once.
+        rng = np.random.default_rng(4)
+        F = np.zeros((60, 200, 20))
+        F[:, 60:140] = rng.random((80, 20))
+        true_shift = np.where(np.arange(60) < 30, 0, 40)
+        F = np.stack([np.roll(f, s, 0) for f, s in zip(F, true_shift)])
+        ops = {'Nbatches': 60, 'nblocks': 1, 'binning_depth': 5,
+               'drift_smoothing': [0.5, 0.5, 0.5]}
+        ysamp = np.arange(200) * 5.
+
+        # Default search range of 15 bins is too small.
+        imin, _, _, _ = datashift.align_block2(F, ysamp, ops, device=torch_device)
+        relative = imin[:,0] + true_shift
+        assert np.abs(relative - relative[0]).max() > 1
+
+        ops['max_drift_shift'] = 250
+        imin, _, _, _ = datashift.align_block2(F, ysamp, ops, device=torch_device)
+        relative = imin[:,0] + true_shift
+        assert np.abs(relative - relative[0]).max() < 1
+
+    def fake_detection(self, monkeypatch):
+        rng = np.random.default_rng(5)
+        units = rng.random(40) * 300
+        amps = 9 + rng.exponential(20, 40)
+        calls = []
+
+        def detect(ops, bfile, batch_indices=None, **kwargs):
+            # Same units in every batch, with drift that increases over time.
+            calls.append(batch_indices)
+            st = []
+            for ibatch in batch_indices:
+                u = rng.integers(0, 40, 200)
+                s = np.zeros((200, 6))
+                s[:,1] = np.clip(units[u] + ibatch / 4, 0, 300)
+                s[:,2] = amps[u]
+                s[:,4] = ibatch
+                st.append(s)
+            # Uses the global generator, like KMeans for templates_from_data.
+            np.random.random(10)
+            return np.concatenate(st), None, ops
+
+        monkeypatch.setattr(datashift.spikedetect, 'run', detect)
+        ops = {'Nbatches': 100, 'nblocks': 1, 'binning_depth': 5,
+               'Th_universal': 9, 'drift_smoothing': [0.5, 0.5, 0.5],
+               'sig_interp': 20, 'drift_nskip': 1,
+               'xc': np.zeros(16), 'yc': np.arange(16) * 20.}
+        return ops, calls
+
+    def test_drift_nskip(self, monkeypatch):
+        ops, _ = self.fake_detection(monkeypatch)
+        ops['drift_nskip'] = 10
+        sigmas = []
+        gaussian_filter = datashift.gaussian_filter
+        def recorded(x, sigma, **kwargs):
+            sigmas.append(sigma)
+            return gaussian_filter(x, sigma, **kwargs)
+        monkeypatch.setattr(datashift, 'gaussian_filter', recorded)
+        ops, st = datashift.run(ops, None, device=torch.device('cpu'))
+
+        assert np.array_equal(np.unique(st[:,4]), np.arange(0, 100, 10))
+        # Smoothing across batches spans the same time as without skipping.
+        assert sigmas == [[0.5, 0.05, 0.5]]
+        assert ops['dshift'].shape == (100, 1)
+        # Interpolated shifts follow the drift, which is 25um in total.
+        dshift = ops['dshift'][:,0]
+        assert np.allclose(dshift[5], (dshift[0] + dshift[10]) / 2)
+        assert np.abs((dshift[90] - dshift[0]) - (-22.5)) < 5
+
+    def test_motion_cache(self, monkeypatch, tmp_path):
+        ops, calls = self.fake_detection(monkeypatch)
+        settings = {'cache_motion': True, 'motion_cache_dir': tmp_path,
+                    'Th_universal': 9, 'nblocks': 1}
+        ops['settings'] = settings
+        data = tmp_path / 'data.bin'
+        np.zeros((1000, 16), dtype='float32').tofile(data)
+        bfile = io.BinaryFiltered(
+            filename=str(data), n_chan_bin=16, NT=100, device=torch.device('cpu'),
+            dtype='float32'
+            )
+        device = torch.device('cpu')
+
+        np.random.seed(1)
+        ops1, st1 = datashift.run(dict(ops), bfile, device=device)
+        after1 = np.random.random()
+        assert len(calls) == 1
+        assert len(list(tmp_path.glob('*.tmp'))) == 0
+
+        # Re-used by the next run, which leaves the global generator in the
+        # same state as computing the estimate again would.
+        np.random.seed(1)
+        ops2, st2 = datashift.run(dict(ops), bfile, device=device)
+        assert len(calls) == 1
+        assert np.array_equal(st1, st2)
+        assert np.array_equal(ops1['dshift'], ops2['dshift'])
+        assert np.array_equal(ops1['yblk'], ops2['yblk'])
+        assert np.random.random() == after1
+
+        # Different settings or time range get a new estimate.
+        settings['Th_universal'] = 8
+        datashift.run(dict(ops), bfile, device=device)
+        assert len(calls) == 2
+        bfile.imax = 500
+        datashift.run(dict(ops), bfile, device=device)
+        assert len(calls) == 3
+        assert len(list(tmp_path.glob('*/dshift.npy'))) == 3
+
+        # Disabled
+        settings['cache_motion'] = False
+        datashift.run(dict(ops), bfile, device=device)
+        assert len(calls) == 4
+        settings['cache_motion'] = True
+
+        # Data from a `file_object` can't be identified by file name.
+        other_bfile = io.BinaryFiltered(
+            filename=str(data), n_chan_bin=16, NT=100, device=device,
+            file_object=np.ones((1000, 16), dtype='float32')
+            )
+        for _ in range(2):
+            datashift.run(dict(ops), other_bfile, device=device)
+        assert len(calls) == 6
+        assert len(list(tmp_path.glob('*/dshift.npy'))) == 3
+
+        # Sorting continues without caching if the cache can't be written.
+        settings['motion_cache_dir'] = data / 'cache'
+        ops3, st3 = datashift.run(dict(ops), bfile, device=device)
+        assert len(calls) == 7
+        assert ops3['dshift'].shape == ops1['dshift'].shape
+        settings['motion_cache_dir'] = tmp_path
+
+        # Runs with their own random state (from `run_kilosort_multi`) restore
+        # that instead of the global state.
+        def isolated_run():
+            utils.seed_rng(1, isolated=True)
+            datashift.run(dict(ops), bfile, device=device)
+            return utils.get_rng_state()['numpy'][1]
+        np.random.seed(2)
+        global_state = np.random.get_state()[1].copy()
+        with ThreadPoolExecutor(1) as exe:
+            run_state = exe.submit(isolated_run).result()
+        assert len(calls) == 7
+        assert np.array_equal(np.random.get_state()[1], global_state)
+        np.random.seed(1)
+        np.random.random(10)
+        assert np.array_equal(run_state, np.random.get_state()[1])
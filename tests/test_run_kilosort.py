@@ -0,0 +1,126 @@
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import torch
+
+from kilosort import run_kilosort_multi
+from kilosort.run_kilosort import (
+    setup_logger, close_logger, _RunFilter, get_spikeglx_info
+    )
+from kilosort.utils import seed_rng, run_rng
+
+
+def test_thread_loggers(tmp_path):
+    logger = logging.getLogger('kilosort.test')
+    dirs = [tmp_path / 'imec0', tmp_path / 'imec1']
+    barrier = threading.Barrier(len(dirs))
+
+    # Stands in for handlers added by an earlier run that wasn't thread-only.
+    class ListHandler(logging.Handler):
+        def emit(self, record):
+            earlier_messages.append(record.getMessage())
+    earlier_messages = []
+    earlier = ListHandler()
+    ks_log = logging.getLogger('kilosort')
+    ks_log.addHandler(earlier)
+
+    def run(results_dir):
+        results_dir.mkdir()
+        handlers = setup_logger(results_dir, thread_only=True)
+        barrier.wait()
+        for i in range(20):
+            logger.info(f'{results_dir.name} message {i}')
+        # Records from worker threads started with a copy of the context,
+        # like prefetching batches, belong to the same run.
+        with ThreadPoolExecutor(1) as exe:
+            exe.submit(
+                contextvars.copy_context().run, logger.info,
+                f'{results_dir.name} worker message'
+                ).result()
+        barrier.wait()
+        close_logger(handlers)
+
+    threads = [threading.Thread(target=run, args=(d,)) for d in dirs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for d, other in zip(dirs, dirs[::-1]):
+        text = (d / 'kilosort4.log').read_text()
+        assert text.count(f'{d.name} message') == 20
+        assert text.count(f'{d.name} worker message') == 1
+        assert f'{other.name} message' not in text
+        assert f'{other.name} worker message' not in text
+    assert not any(
+        h for h in logging.getLogger('kilosort').handlers
+        if any(isinstance(f, _RunFilter) for f in h.filters)
+        )
+
+    # Earlier handlers still get records from outside the threaded runs.
+    logger.info('main thread message')
+    ks_log.removeHandler(earlier)
+    assert earlier_messages == ['main thread message']
+
+
+def test_run_rng():
+    def draws():
+        with run_rng():
+            return np.random.random(3), torch.rand(3)
+
+    seed_rng(1)
+    expected = [draws() for _ in range(3)]
+
+    # Concurrent runs interleave their draws, but each gets the same numbers
+    # as a single run, and the global generators are not changed.
+    seed_rng(5)
+    state = np.random.get_state()[1].copy()
+    barrier = threading.Barrier(2)
+    results = [[], []]
+
+    def run(i):
+        seed_rng(1, isolated=True)
+        for _ in range(3):
+            barrier.wait()
+            results[i].append(draws())
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for r in results:
+        for (a, b), (a0, b0) in zip(r, expected):
+            assert np.array_equal(a, a0)
+            assert torch.equal(b, b0)
+    assert np.array_equal(np.random.get_state()[1], state)
+
+
+def test_run_kilosort_multi_results_dir(tmp_path):
+    recordings = [{'filename': tmp_path / 'a' / 'data.bin'},
+                  {'filename': tmp_path / 'a' / 'data2.bin'}]
+    with pytest.raises(ValueError):
+        # Both would be saved to tmp_path / 'a' / 'kilosort4'
+        run_kilosort_multi(recordings, settings={'n_chan_bin': 4})
+
+
+def test_get_spikeglx_info(tmp_path, caplog):
+    filename = tmp_path / 'run_g0_t0.imec0.ap.bin'
+    assert get_spikeglx_info(filename) is None
+
+    meta = tmp_path / 'run_g0_t0.imec0.ap.meta'
+    meta.write_text('imSampRate=30000.0837\nnSavedChans=385\n')
+    assert get_spikeglx_info(filename)['fs'] == 30000.0837
+
+    # Truncated or unexpected files are skipped with a warning.
+    meta.write_text('imSampRate=30000.0837\n')
+    with caplog.at_level(logging.WARNING, logger='kilosort'):
+        assert get_spikeglx_info(filename) is None
+    assert 'nSavedChans' in caplog.text
+    meta.write_text('imSampRate=fast\nnSavedChans=385\n')
+    assert get_spikeglx_info(filename) is None
@@ -0,0 +1,21 @@
+import numpy as np
+
+from kilosort.simulation import match_spikes
+
+
+def test_match_spikes():
+    st0 = np.array([100, 10, 50, 10])
+    st = np.array([10, 11, 49, 200, 10, 300])
+    i0, i = match_spikes(st0, st, dt=6)
+
+    assert i0.size == i.size == 3
+    assert np.all(np.abs(st0[i0] - st[i]) <= 6)
+    # Repeated times are each matched once, to different spikes.
+    assert np.unique(i0).size == i0.size
+    assert np.unique(i).size == i.size
+    assert sorted(st0[i0]) == [10, 10, 50]
+    assert sorted(st[i]) == [10, 10, 49]
+
+    # Nothing to match
+    i0, i = match_spikes(st0, np.array([1000]), dt=6)
+    assert i0.size == i.size == 0
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from kilosort.spike_store import SpikeStore
+
+
+@pytest.mark.parametrize('max_memory_gb', [np.inf, 0])
+def test_spike_store(tmp_path, max_memory_gb):
+    rng = np.random.default_rng(0)
+    columns = {'st': ((3,), 'float64'), 'tF': ((4, 2), 'float32')}
+    store = SpikeStore(columns, block_size=50, max_memory_gb=max_memory_gb,
+                       scratch_dir=tmp_path)
+    st_all, tF_all = [], []
+    for i in range(20):
+        # Batches with overlapping, unsorted spike times and varying sizes
+        n = rng.integers(0, 120)
+        st = rng.standard_normal((n, 3))
+        st[:,0] = rng.integers(i*100, (i+1)*100 + 20, n)
+        tF = rng.standard_normal((n, 4, 2)).astype(np.float32)
+        store.append(sort_key=st[:,0], st=st, tF=tF)
+        st_all.append(st)
+        tF_all.append(tF)
+    st_all = np.concatenate(st_all)
+    tF_all = np.concatenate(tF_all)
+    assert len(store) == st_all.shape[0]
+    if max_memory_gb == 0:
+        assert len(list(tmp_path.glob('*/*.npy'))) == 2*len(store.blocks)
+
+    # Same result as a global stable sort
+    isort = np.argsort(st_all[:,0], kind='stable')
+    spikes = store.to_arrays(sort=True)
+    assert np.array_equal(spikes['st'], st_all[isort])
+    assert np.array_equal(spikes['tF'], tF_all[isort])
+    assert spikes['tF'].dtype == np.float32
+
+    store.close()
+    assert len(list(tmp_path.glob('*/*.npy'))) == 0
+
+
+def test_spike_store_unsorted():
+    store = SpikeStore({'x': ((), 'int64')}, block_size=3)
+    store.append(x=np.array([5, 1, 4, 2]))
+    store.append(x=np.array([], dtype=np.int64))
+    store.append(x=np.array([3, 0]))
+    assert np.array_equal(store.to_arrays()['x'], [5, 1, 4, 2, 3, 0])
+    with pytest.raises(ValueError):
+        store.to_arrays(sort=True)
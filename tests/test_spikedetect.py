@@ -1,4 +1,8 @@
-from kilosort.spikedetect import extract_wPCA_wTEMP
+import numpy as np
+import torch
+
+from kilosort.spikedetect import extract_wPCA_wTEMP, template_match
+from kilosort.template_matching import prepare_matching, run_matching
 
 
 def test_wpca_wtemp(bfile, saved_ops, torch_device):
@@ -9,3 +13,97 @@ def test_wpca_wtemp(bfile, saved_ops, torch_device):
     ops['n_pcs'] = 5
 
     wPCA, wTEMP = extract_wPCA_wTEMP(ops, bfile, device=torch_device)
+
+
+class TestPrecision:
+    # Synthetic batch with isolated spikes spread over three channels.
+    nt, n_chan, NT = 61, 8, 6000
+
+    def get_data(self, device):
+        rng = np.random.default_rng(0)
+        t = np.arange(self.nt) - 20
+        waves = np.stack([
+            -np.exp(-(t-d)**2/(2*w**2)) + 0.4*np.exp(-(t-d-8)**2/(2*(2*w)**2))
+            for w in [2, 3, 4] for d in [0, 2]
+            ])
+        waves /= np.linalg.norm(waves, axis=1, keepdims=True)
+        wPCA = np.linalg.svd(waves, full_matrices=False)[2][:3]
+
+        X = 0.3 * rng.standard_normal((self.n_chan, self.NT))
+        times = np.arange(200, self.NT-200, 250)
+        chans = rng.integers(1, self.n_chan-1, times.size)
+        for ti, c in zip(times, chans):
+            w = waves[rng.integers(len(waves))]
+            for dc, a in [(-1, 0.5), (0, 1), (1, 0.5)]:
+                X[c+dc, ti-20:ti-20+self.nt] += 20 * a * w
+
+        wTEMP = torch.from_numpy(waves).float().to(device)
+        wPCA = torch.from_numpy(wPCA).float().to(device)
+        X = torch.from_numpy(X).float().to(device)
+        return X, times, waves, wTEMP, wPCA
+
+    def get_ops(self, precision, wTEMP, wPCA):
+        return {'nt': self.nt, 'wTEMP': wTEMP, 'wPCA': wPCA,
+                'Th_universal': 9, 'Th_learned': 8, 'max_peels': 100,
+                'settings': {'nt0min': 20, 'n_templates': 6,
+                             'precision': precision}}
+
+    def test_template_match(self, torch_device):
+        X, times, _, wTEMP, wPCA = self.get_data(torch_device)
+        # One template centered on each channel, with its two neighbors,
+        # and two template sizes.
+        iC = torch.stack([
+            torch.clamp(torch.arange(self.n_chan) + d, 0, self.n_chan-1)
+            for d in [0, -1, 1]
+            ]).to(torch_device)
+        ds = torch.tensor([0., 1., 1.])[:,None].expand(3, self.n_chan)
+        sizes = torch.tensor([1., 2.])
+        weigh = torch.exp(-ds.unsqueeze(-1) / sizes**2).permute(2, 0, 1)
+        weigh = weigh / (weigh**2).sum(1).unsqueeze(1)**.5
+        weigh = weigh.contiguous().to(torch_device)
+
+        best = {}
+        for p in ['float32', 'bfloat16']:
+            ops = self.get_ops(p, wTEMP, wPCA)
+            # Batches are converted by `bfile` in the pipeline.
+            xy, imax, amp, adist = template_match(
+                X.to(getattr(torch, p)), ops, iC, iC, weigh, device=torch_device
+                )
+            # Every detection should belong to one of the spikes, and every
+            # spike should be detected.
+            d = xy[:,1].cpu().numpy()[:,None] - times
+            nearest = np.abs(d).argmin(1)
+            assert np.abs(d).min(1).max() <= ops['settings']['nt0min']
+            assert np.unique(nearest).size == times.size
+            best[p] = np.zeros(times.size)
+            np.maximum.at(best[p], nearest, amp.cpu().numpy())
+
+        # Neighboring templates can tie for the peak differently after
+        # rounding, but the largest amplitude for each spike should agree.
+        assert np.allclose(best['bfloat16'], best['float32'], rtol=1e-2)
+
+    def test_run_matching(self, torch_device):
+        X, times, waves, wTEMP, wPCA = self.get_data(torch_device)
+        U = torch.zeros(3, 3, self.n_chan)
+        for j, c in enumerate([2, 4, 5]):
+            u = torch.from_numpy(waves[2*j] @ wPCA.cpu().numpy().T).float()
+            U[j, :, c-1:c+2] = 20 * u[:,None] * torch.tensor([0.5, 1, 0.5])
+        U = U.to(torch_device)
+
+        results = {}
+        for p in ['float32', 'bfloat16']:
+            ops = self.get_ops(p, wTEMP, wPCA)
+            ctc = prepare_matching(ops, U)
+            results[p] = run_matching(
+                ops, X.to(getattr(torch, p)), U, ctc, device=torch_device
+                )
+
+        st0, amps0, _, Xres0 = results['float32']
+        st, amps, _, Xres = results['bfloat16']
+        assert Xres.dtype == torch.float32
+        assert st0.shape[0] > 0
+        assert torch.equal(st, st0)
+        # Inputs to the convolution really were rounded.
+        assert not torch.equal(amps, amps0)
+        assert torch.allclose(amps, amps0, rtol=1e-2)
+        assert torch.allclose(Xres, Xres0, atol=0.1)